@@ -0,0 +1,58 @@
+"""
+Measure broadcast latency as the number of peers grows, with every peer but one stalled.
+
+    python3 benchmarks/broadcast_bench.py --peers 1 10 100 500
+
+For each peer count, a message is broadcast repeatedly; the table shows how long the broadcasting
+thread is held up per call, and how long the one reading peer waits for each message.
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.p2p import Transport
+from src.message import Message
+
+def measure(num_peers, rounds, payload_size):
+    transport = Transport()
+    remotes = []
+    conns = []
+    for _ in range(num_peers):
+        local, remote = socket.socketpair()
+        remotes.append(remote)
+        conns.append(transport.wrap(local))
+    reader = remotes[0] # the only peer that keeps up, all others never read
+
+    payload = b'x' * payload_size
+    call_time = delivery_time = 0.0
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        transport.broadcast(conns, Message('M', payload))
+        call_time += time.perf_counter() - start_time
+        Message.recv_from(reader)
+        delivery_time += time.perf_counter() - start_time
+    dropped = sum(stats['dropped'] for stats in transport.queue_stats())
+
+    transport.close()
+    for remote in remotes:
+        remote.close()
+    return call_time / rounds, delivery_time / rounds, dropped
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast fan-out benchmark")
+    parser.add_argument('--peers', type=int, nargs='+', default=[1, 10, 100, 500], help="peer counts to measure")
+    parser.add_argument('--rounds', type=int, default=2000, help="broadcasts per peer count")
+    parser.add_argument('--payload_size', type=int, default=1024, help="bytes per message")
+    args = parser.parse_args()
+
+    print(f"{'peers':>6} {'call (us)':>10} {'delivery (us)':>14} {'dropped':>8}")
+    for num_peers in args.peers:
+        call_time, delivery_time, dropped = measure(num_peers, args.rounds, args.payload_size)
+        print(f"{num_peers:>6} {call_time * 1e6:>10.1f} {delivery_time * 1e6:>14.1f} {dropped:>8}")
+
+if __name__ == '__main__':
+    main()
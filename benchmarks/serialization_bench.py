@@ -0,0 +1,63 @@
+"""
+Time Blockchain.encode / Blockchain.decode on chains of increasing length.
+
+    python3 benchmarks/serialization_bench.py --sizes 10000 100000 1000000
+
+Blocks are built at difficulty 0 so that constructing a 1M-block chain doesn't require mining;
+decode still runs the full linkage check over every block.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.blockchain import Blockchain, Block
+
+class BenchBlockchain(Blockchain):
+    difficulty = 0
+
+def build_chain(size, data_size):
+    blocks = []
+    previous_hash = "0" * 64
+    for i in range(size):
+        block = Block(previous_hash, str(i).encode().ljust(data_size, b'.'))
+        blocks.append(block)
+        previous_hash = block.hash()
+    return BenchBlockchain(blocks)
+
+def legacy_encode(bc):
+    # the former implementation, kept to show the quadratic growth
+    res = b''
+    for block in bc.chain:
+        res += block.encode()
+    return res
+
+def timed(func, *args):
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+def main():
+    parser = argparse.ArgumentParser(description="Blockchain serialization benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="chain lengths to measure")
+    parser.add_argument('--data_size', type=int, default=64, help="bytes of data per block")
+    parser.add_argument('--legacy_limit', type=int, default=10000, help="largest chain to also encode the old way")
+    args = parser.parse_args()
+
+    print(f"{'blocks':>10} {'bytes':>12} {'encode (s)':>11} {'decode (s)':>11} {'legacy encode (s)':>18}")
+    for size in args.sizes:
+        bc = build_chain(size, args.data_size)
+        encoded, encode_time = timed(bc.encode)
+        decoded, decode_time = timed(BenchBlockchain.decode, encoded)
+        assert decoded.height == size and decoded.tip_hash == bc.tip_hash
+        legacy = "-"
+        if size <= args.legacy_limit:
+            legacy_encoded, legacy_time = timed(legacy_encode, bc)
+            assert legacy_encoded == encoded
+            legacy = f"{legacy_time:.3f}"
+        print(f"{size:>10} {len(encoded):>12} {encode_time:>11.3f} {decode_time:>11.3f} {legacy:>18}")
+
+if __name__ == '__main__':
+    main()
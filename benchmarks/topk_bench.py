@@ -0,0 +1,83 @@
+"""
+Time the tracker's heartbeats (`H`) and top-k queries (`T`) with many registered clients, against
+sorting every client for each query as the tracker used to.
+
+    python3 benchmarks/topk_bench.py --clients 1000 10000 --top_k 5
+
+Clients are simulated in the tracker's tables, without sockets, so only the bookkeeping is measured.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.p2p.tracker import ChainHeap
+
+def legacy_top_k(clients_sockets, top_k):
+    # the former implementation: sort all clients for each query
+    top_k_list = sorted(clients_sockets.values(), key=lambda x: x[2], reverse=True)[:top_k]
+    return [socket.inet_aton(addr) + node_addr[4:] for addr, _, _, node_addr in top_k_list]
+
+def heap_top_k(clients_sockets, chain_heap, top_k):
+    top_k_list = [clients_sockets[key] for key in chain_heap.top(top_k)]
+    return [socket.inet_aton(addr) + node_addr[4:] for addr, _, _, node_addr in top_k_list]
+
+def simulate(num_clients, rounds, top_k, use_heap, seed):
+    rng = random.Random(seed)
+    clients_sockets = {}
+    chain_heap = ChainHeap()
+    for key in range(num_clients):
+        clients_sockets[key] = ('127.0.0.1', key % 65536, 0, bytes(4) + (key % 65536).to_bytes(2, 'big'))
+        chain_heap.push(key, 0)
+    heartbeat_time = query_time = 0
+    result = None
+    for _ in range(rounds):
+        # every client heartbeats, most chains grow by a block, then a webserver asks for the top k
+        start_time = time.perf_counter()
+        for key in range(num_clients):
+            addr, port_num, chain_len, node_addr = clients_sockets[key]
+            chain_len += rng.random() < 0.9
+            clients_sockets[key] = (addr, port_num, chain_len, node_addr)
+            if use_heap:
+                chain_heap.update(key, chain_len)
+        heartbeat_time += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        result = heap_top_k(clients_sockets, chain_heap, top_k) if use_heap else legacy_top_k(clients_sockets, top_k)
+        query_time += time.perf_counter() - start_time
+    return result, heartbeat_time / rounds, query_time / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracker top-k benchmark")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1000, 10000], help="numbers of simulated clients")
+    parser.add_argument('--rounds', type=int, default=20, help="heartbeat rounds, each followed by a top-k query")
+    parser.add_argument('--queries', type=int, default=1000, help="extra top-k queries timed on the final state")
+    parser.add_argument('--top_k', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'impl':>7} {'heartbeats/round (ms)':>22} {'query (us)':>11}")
+    for num_clients in args.clients:
+        for use_heap in (False, True):
+            result, heartbeat_time, query_time = simulate(num_clients, args.rounds, args.top_k, use_heap, seed=num_clients)
+            print(f"{num_clients:>8} {'heap' if use_heap else 'sort':>7} {heartbeat_time * 1000:>22.2f} {query_time * 1e6:>11.1f}")
+        # both must agree on the same state (ties are in registration order in both)
+        clients_sockets = {key: ('127.0.0.1', key % 65536, (key * 7919) % 1000, bytes(6)) for key in range(num_clients)}
+        chain_heap = ChainHeap()
+        for key, (_, _, chain_len, _) in clients_sockets.items():
+            chain_heap.push(key, chain_len)
+        assert heap_top_k(clients_sockets, chain_heap, args.top_k) == legacy_top_k(clients_sockets, args.top_k)
+        start_time = time.perf_counter()
+        for _ in range(args.queries):
+            legacy_top_k(clients_sockets, args.top_k)
+        sort_time = (time.perf_counter() - start_time) / args.queries
+        start_time = time.perf_counter()
+        for _ in range(args.queries):
+            heap_top_k(clients_sockets, chain_heap, args.top_k)
+        heap_time = (time.perf_counter() - start_time) / args.queries
+        print(f"{num_clients:>8} {'':>7} {'top-k query speedup':>22} {sort_time / heap_time:>10.0f}x")
+
+if __name__ == '__main__':
+    main()
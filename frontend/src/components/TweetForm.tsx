@@ -1,14 +1,12 @@
 import React, {useState} from 'react';
 import {Button, Form, Message, Popup, TextArea} from 'semantic-ui-react';
-import {ALGORITHM, readFileAsync} from "../util";
+import {ALGORITHM, API_BASE, readFileAsync} from "../util";
 import {usePublicKey} from "../context/PublicKeyProvider";
-import {fetchPosts, usePosts} from "../context/PostsProvider";
 
 
 const TweetForm = () => {
     const [content, setContent] = useState('');
     const {publicKey} = usePublicKey();
-    const {setPosts} = usePosts();
 
     /**
      * Process a private key file.
@@ -51,8 +49,7 @@ const TweetForm = () => {
             const signature = await window.crypto.subtle.sign(
                 ALGORITHM, privateKey, new TextEncoder().encode(content));
 
-            // FIXME: Hardcoded link
-            fetch('http://127.0.0.1:8080/message', {
+            fetch(`${API_BASE}/message`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -65,8 +62,7 @@ const TweetForm = () => {
             })
                 .then(response => response.json())
                 .then(_ => {
-                    // FIXME: Right now 500ms seems to be a safe delay
-                    setTimeout(() => fetchPosts().then(posts => setPosts(posts)), 500);
+                    // the post shows up through the live feed once it is mined
                     setContent('');
                 })
                 .catch(error => console.error('Error:', error));
@@ -1,5 +1,6 @@
 import React, {createContext, useContext, useEffect, useState} from 'react';
-import {IPost} from '../types';
+import {IChainEvent, IPost} from '../types';
+import {API_BASE} from '../util';
 
 interface PostsContextType {
     posts: IPost[];
@@ -22,7 +23,7 @@ interface PostsProviderProps {
 
 export const fetchPosts = async (): Promise<Array<IPost>> => {
     try {
-        const response = await fetch('http://127.0.0.1:8080/chain');  // FIXME
+        const response = await fetch(`${API_BASE}/chain`);
         if (!response.ok)
             throw new Error(`Failed to fetch posts: ${response.statusText}`);
         const posts: Array<IPost> = await response.json();
@@ -34,11 +35,34 @@ export const fetchPosts = async (): Promise<Array<IPost>> => {
     }
 };
 
+// Same as the cursors of /chain: the block's hash, and the position of the post in a batch
+const postId = (post: IPost): string =>
+    post.position ? `${post.hash}:${post.position}` : `${post.hash}`;
+
 export const PostsProvider = ({children}: PostsProviderProps) => {
     const [posts, setPosts] = useState<IPost[]>([]);
 
     useEffect(() => {
         fetchPosts().then(posts => setPosts(posts));
+        // the webserver pushes new posts, and the ones a reorg removed, instead of being polled
+        const events = new EventSource(`${API_BASE}/chain/live`);
+        events.onmessage = (message: MessageEvent) => {
+            const event: IChainEvent = JSON.parse(message.data);
+            setPosts(posts => {
+                const removed = new Set(event.removed);
+                const known = new Set(posts.map(postId));
+                const added = event.posts.filter(post => !known.has(postId(post))).reverse();
+                return [...added, ...posts.filter(post => !removed.has(postId(post)))];
+            });
+        };
+        // the browser reconnects by itself; reload in case events were missed meanwhile
+        let connected = false;
+        events.onopen = () => {
+            if (connected)
+                fetchPosts().then(posts => setPosts(posts));
+            connected = true;
+        };
+        return () => events.close();
     }, []);
 
     return (
@@ -11,4 +11,13 @@ export interface ITweet {
 export interface IPost {
     author: string;
     content: string;
+    hash?: string;
+    position?: number;
+}
+
+// A change of the chain pushed by /chain/live
+export interface IChainEvent {
+    tip: string | null;
+    removed: string[];
+    posts: IPost[];
 }
\ No newline at end of file
@@ -1,5 +1,8 @@
 export const ALGORITHM = 'RSASSA-PKCS1-v1_5';
 
+// FIXME: Hardcoded link; every request to the webserver is built from it
+export const API_BASE = 'http://127.0.0.1:8080';
+
 export function download(data: BlobPart, filename: string) {
     const blob = new Blob([data], {type: 'text/plain'});
     const url = window.URL.createObjectURL(blob);
@@ -1,2 +1,8 @@
 from .worker import *
-from .blockchain import *
\ No newline at end of file
+from .blockchain import *
+from .miner import *
+from .store import *
+from .gossip import *
+from .index import *
+from .ledger import *
+from .mempool import *
@@ -1,6 +1,30 @@
 from hashlib import sha256
 import struct
 
+from .index import PostIndex
+from .ledger import Ledger, valid_rewards
+
+# Canonical binary block header that the proof-of-work hashes:
+#   previous block hash (32 bytes) | Merkle root of the block's posts (32 bytes) | nonce (4 bytes, big-endian)
+# The Merkle root of a block that carries a single post is the sha256 of its data.
+# The first 64 bytes are fixed for a given block, so miners hash them once and only feed the nonce per attempt.
+HEADER_PREFIX_FORMAT = '>32s32s'
+NONCE_FORMAT = '>I'
+NONCE_STRUCT = struct.Struct(NONCE_FORMAT)
+MAX_NONCE = 2 ** 32 # nonce is packed as a 4-byte unsigned int
+
+# Wire framing of an encoded block: 64-byte hex previous hash, 4-byte nonce, 4-byte data size, then the data
+ENCODE_FORMAT = '64sII'
+ENCODE_STRUCT = struct.Struct(ENCODE_FORMAT)
+
+ROOT_HASH = "0" * 64 # previous_hash of the first block of every chain
+
+# The data of a block that carries a batch of posts is BATCH_MARKER, then each post's size and data.
+# Posts start with their author's key hash, so no single post starts with the marker.
+BATCH_MARKER = b'\x00BATCH'
+BATCH_SIZE_FORMAT = '>I'
+BATCH_SIZE_STRUCT = struct.Struct(BATCH_SIZE_FORMAT)
+
 # Stringify and concatenate all arguments and produces a sha256 hash as a result
 def hash(*args):
     hashing_text = ""; h = sha256()
@@ -11,9 +35,83 @@ def hash(*args):
     h.update(hashing_text.encode('utf-8'))
     return h.hexdigest()
 
+# Id of a post: the sha256 of its bytes. Chains, mempools and inventory announcements all use it.
+def entry_hash(entry):
+    return sha256(entry).hexdigest()
+
+def encode_batch(entries):
+    """the data of a block that carries several posts; a single post is its own block data"""
+    if len(entries) == 1:
+        return entries[0]
+    return BATCH_MARKER + b''.join(BATCH_SIZE_STRUCT.pack(len(entry)) + entry for entry in entries)
+
+def decode_batch(data):
+    """the posts carried by a block's data; data that isn't a well-formed batch is a single post"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:len(BATCH_MARKER)] != BATCH_MARKER:
+        return [data]
+    entries = []
+    start = len(BATCH_MARKER)
+    while start < len(data):
+        if start + BATCH_SIZE_STRUCT.size > len(data):
+            return [data]
+        size, = BATCH_SIZE_STRUCT.unpack_from(data, start)
+        start += BATCH_SIZE_STRUCT.size
+        if start + size > len(data):
+            return [data]
+        entries.append(data[start:start + size])
+        start += size
+    return entries if entries else [data]
+
+# Root of the Merkle tree over the sha256 of each post; an odd node out is paired with itself
+def merkle_root(entries):
+    level = [sha256(entry).digest() for entry in entries]
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+# Largest header digest (exclusive) accepted for a difficulty, i.e. `difficulty` leading zero hex digits
+def difficulty_target(difficulty):
+    if difficulty == 0:
+        return b'\xff' * 33 # every 32-byte digest compares below it
+    return (1 << (256 - 4 * difficulty)).to_bytes(32, 'big')
+
+def find_nonce(header_prefix, target, nonce_start=0, count=MAX_NONCE):
+    """
+    Search nonces in [nonce_start, nonce_start + count) for a header digest below target.
+    The sha256 state over the header prefix is computed once and copied for each attempt,
+    so the cost per nonce doesn't depend on the size of the block data.
+    return (nonce, hashes_tried), where nonce is None if the range has no valid nonce
+    """
+    midstate = sha256(header_prefix)
+    pack_nonce = NONCE_STRUCT.pack
+    for nonce in range(nonce_start, min(nonce_start + count, MAX_NONCE)):
+        h = midstate.copy()
+        h.update(pack_nonce(nonce))
+        if h.digest() < target:
+            return nonce, nonce - nonce_start + 1
+    return None, max(0, min(nonce_start + count, MAX_NONCE) - nonce_start)
+
+# Indices of the blocks in a chain of the given height that make up its locator (see Blockchain.locator)
+def locator_indices(height):
+    indices = []
+    step = 1
+    idx = height - 1
+    while idx > 0:
+        indices.append(idx)
+        if len(indices) >= 10:
+            step *= 2
+        idx -= step
+    if height > 0:
+        indices.append(0)
+    return indices
+
 # The "block" of the blockchain. Points to the previous block by its unique hash in previous_hash.
 class Block():
-    def __init__(self, previous_hash="0"*64, data=None, nonce=0):
+    def __init__(self, previous_hash=ROOT_HASH, data=None, nonce=0):
         if isinstance(data, str):
             data = data.encode('utf-8')
 
@@ -21,31 +119,45 @@ class Block():
         self.previous_hash = previous_hash
         self.nonce = nonce
 
-    # Compute a sha256 hash for the block's data.
+    # Any change to a hashed field invalidates the memoized hash
+    def __setattr__(self, name, value):
+        if name in ('previous_hash', 'data', 'nonce'):
+            object.__setattr__(self, '_hash', None)
+        if name == 'data':
+            object.__setattr__(self, '_entries', None)
+        object.__setattr__(self, name, value)
+
+    # The posts the block carries: one, or a batch. The result is memoized until the data changes.
+    def entries(self):
+        if self._entries is None:
+            self._entries = decode_batch(self.data)
+        return self._entries
+
+    # The fixed part of the binary header, shared by every nonce attempt
+    def header_prefix(self):
+        return struct.pack(HEADER_PREFIX_FORMAT, bytes.fromhex(self.previous_hash), merkle_root(self.entries()))
+
+    # The canonical binary header of the block
+    def header(self):
+        return self.header_prefix() + NONCE_STRUCT.pack(self.nonce)
+
+    # Compute a sha256 hash for the block's header. The result is memoized until the block is mutated.
     def hash(self):
-        data = self.data
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        return hash(
-            self.previous_hash,
-            data,
-            self.nonce
-        )
+        if self._hash is None:
+            self._hash = sha256(self.header()).hexdigest()
+        return self._hash
 
     def encode(self):
-        format_string = '64sII'  # 64-byte SHA256, 4-byte unsigned int, 4-byte unsigned int
         data = self.data
         if isinstance(data, str):
             data = data.encode('utf-8')
-        header = struct.pack(format_string, self.previous_hash.encode('utf-8'), self.nonce, len(data))
+        header = ENCODE_STRUCT.pack(self.previous_hash.encode('utf-8'), self.nonce, len(data))
         return header + data
     
     @classmethod
     def decode(cls, encoded_block):
-        format_string = '64sII'
-        header_size = struct.calcsize(format_string)
-        prev_hs, nonce, _ = struct.unpack(format_string, encoded_block[:header_size])
-        return cls(prev_hs.decode(), encoded_block[header_size:], nonce)
+        prev_hs, nonce, _ = ENCODE_STRUCT.unpack_from(encoded_block)
+        return cls(prev_hs.decode(), encoded_block[ENCODE_STRUCT.size:], nonce)
 
     def __eq__(self, other):
         if not isinstance(other, Block):
@@ -78,45 +190,81 @@ class Blockchain():
             chain = []  # This creates a new list for each instance
         self.chain = chain
         self.block_table = {} # [(mined_block_hash, index_of_the_block_in_chain)]
-        self.block_hash_pool = set() # records all block's pure data hash
+        self.block_hash_pool = set() # entry_hash() of every post on the chain
+        self.post_index = PostIndex() # posts by author and by word
+        self.ledger = Ledger() # account balances at the tip
+        self.on_tip_change = None # called after the tip changed, e.g. to notify subscribers; must not block
+        self.tip_hash = None
+        self._update_tip()
+
+    # keep the tip's hash and the chain's height as state, so that readers don't need to touch the chain
+    def _update_tip(self):
+        tip_hash = self.chain[-1].hash() if self.chain else None
+        self.height = len(self.chain)
+        changed = tip_hash != self.tip_hash
+        self.tip_hash = tip_hash
+        if changed and self.on_tip_change is not None:
+            self.on_tip_change()
 
     # add a new block to the chain
     def add(self, block):
         if self.isAttachableBlock(block):
             print("[Blockchain] Add new block")
             self.block_table[block.hash()] = len(self.chain)
+            self.post_index.add(len(self.chain), block)
+            self.ledger.apply(len(self.chain), block)
             self.chain.append(block)
-            self.block_hash_pool.add(hash(block.data))
+            self.block_hash_pool.update(entry_hash(entry) for entry in block.entries())
+            self._update_tip()
 
-    # remove a block from the chain
+    # remove a block from the chain; the blocks after it move one position down
     def remove(self, block):
-        del self.block_table[block.hash()]
+        idx = self.block_table[block.hash()]
+        tail = self.chain[idx + 1:]
+        # the post index and the ledger only roll back from the tip: undo down to the block, then redo the tail
+        for j in range(len(self.chain) - 1, idx - 1, -1):
+            self.post_index.rollback(j, self.chain[j])
+            del self.block_table[self.chain[j].hash()]
+        self.ledger.truncate(idx, self.chain)
         self.chain.remove(block)
-        self.block_hash_pool.remove(hash(block.data))
+        self.block_hash_pool.difference_update(entry_hash(entry) for entry in block.entries())
+        for j, tail_block in enumerate(tail, idx):
+            self.block_table[tail_block.hash()] = j
+            self.post_index.add(j, tail_block)
+            self.ledger.apply(j, tail_block)
+        self._update_tip()
 
     # find the nonce of the block that satisfies the difficulty and add to chain
-    def mine(self, block):
+    # if a miner is given, the search is delegated to it and returns None when cancelled, or once
+    # the tip moves away from the block's parent (or is_stale() returns True)
+    def mine(self, block, miner=None, is_stale=None):
         # attempt to get the hash of the previous block.
-        if len(self.chain) > 0:
-            block.previous_hash = self.chain[-1].hash()
-        # this should raise an IndexError if this is the first block.
-        # try: block.previous_hash = self.chain[-1].hash()
-        # except IndexError: pass
-
-        # loop until nonce that satisifeis difficulty is found
-        while True:
-            if block.hash()[:self.difficulty] == "0" * self.difficulty:
-                return block
-            else:
-                # increase the nonce by one and try again
-                block.nonce += 1
+        if self.tip_hash is not None:
+            block.previous_hash = self.tip_hash
+
+        if miner is not None:
+            def stale():
+                return (self.tip_hash or ROOT_HASH) != block.previous_hash or (is_stale is not None and is_stale())
+            return miner.mine(block, self.difficulty, stale)
+
+        # search from the current nonce until one that satisfies difficulty is found
+        nonce, _ = find_nonce(block.header_prefix(), difficulty_target(self.difficulty), block.nonce)
+        if nonce is None:
+            raise RuntimeError("Nonce space exhausted")
+        block.nonce = nonce
+        return block
+
+    # a block pays at most one reward, as its first post, see valid_rewards()
+    def hasValidRewards(self, block):
+        return valid_rewards(block.entries())
 
     # check if a block is valid to attach
     def isAttachableBlock(self, block):
-        if len(self.chain) == 0:
+        if not self.hasValidRewards(block):
+            return False
+        if self.tip_hash is None:
             return True
-        cur_hash = block.hash()
-        return self.chain[-1].hash() == block.previous_hash and cur_hash[:self.difficulty] == "0" * self.difficulty
+        return self.tip_hash == block.previous_hash and block.hash()[:self.difficulty] == "0" * self.difficulty
 
     # check if blockchain is valid
     def isValid(self, start_idx=1):
@@ -129,12 +277,50 @@ class Blockchain():
                 return False
 
         return True
+
+    # check that the blocks link to each other and satisfy the difficulty, e.g. a suffix of a remote chain
+    def isValidSubchain(self, blocks):
+        for i, block in enumerate(blocks):
+            if block.hash()[:self.difficulty] != "0" * self.difficulty or not self.hasValidRewards(block):
+                return False
+            if i > 0 and block.previous_hash != blocks[i-1].hash():
+                return False
+        return True
+
+    def locator(self):
+        """
+        return the hashes of the tip and the 9 blocks before it, followed by exponentially
+        sparser blocks down to the first block. A peer finds the most recent common block
+        of both chains with the first of these hashes that it knows.
+        """
+        return [self.chain[idx].hash() for idx in locator_indices(self.height)]
+
+    # index of the most recent block in the locator that is also in the local chain; otherwise -1
+    def findForkPoint(self, locator):
+        for block_hash in locator:
+            if block_hash in self.block_table:
+                return self.block_table[block_hash]
+        return -1
     
+    def isPreferredFork(self, fork_point, remote_len, remote_tip_hash):
+        """
+        whether a fork of remote_len blocks after the block at fork_point (-1 for the root), ending at
+        remote_tip_hash, replaces the local blocks after it: the longer fork wins, and forks of equal length
+        are settled by the lower tip hash. Without the tie-break, two nodes that mined competing blocks at
+        the same height would each keep their own until a further block is mined, which on an idle network
+        may be never; every node compares the same two hashes, so they all converge on the same fork.
+        """
+        local_len = self.height - fork_point - 1
+        return remote_len > local_len or (remote_len == local_len and remote_tip_hash < self.tip_hash)
+
     def mergeChain(self, remote_chain):
         """
         merge the remote chain into local chain by finding the fork point
         return (fork_point: INT, discarded_blocks: List[BLock])
-            - fork_point: the fork point's index if any; otherwise -1
+            - fork_point: the fork point's index if merged, or None if nothing was merged, e.g. the remote
+              chain is shorter or one of its new blocks pays a misplaced reward. -1 is a merge too: the
+              chains share no block, and the remote chain replaced the whole local chain. Callers test
+              `fork_point is not None`, never the sign of fork_point.
             - discarded_blocks: list of blocks that originally in local chain but get discarded after merge
         """
         for i, remote_block in enumerate(reversed(remote_chain)):
@@ -142,30 +328,42 @@ class Blockchain():
             # it means local chain must be longer than remote chain => nothing to merge
             # therefore, we can just start from checking the second last block
             remote_subchain_len = i + 1
-            if remote_block.previous_hash in self.block_table:
-                fork_point = self.block_table[remote_block.previous_hash]
-                # if length of forked remote subchain > forked local subchain, replace subchain
-                if remote_subchain_len > len(self.chain) - fork_point - 1:
-                    discarded_blocks = self.chain[fork_point + 1:]
+            if remote_block.previous_hash in self.block_table or remote_block.previous_hash == ROOT_HASH:
+                fork_point = self.block_table.get(remote_block.previous_hash, -1)
+                if self.isPreferredFork(fork_point, remote_subchain_len, remote_chain[-1].hash()):
                     remote_idx = len(remote_chain) - remote_subchain_len
+                    if not all(self.hasValidRewards(block) for block in remote_chain[remote_idx:]):
+                        return None, []
+                    discarded_blocks = self.chain[fork_point + 1:]
+                    self.ledger.truncate(fork_point + 1, self.chain)
                     # Remove indice of replaced local subchain (keep fork point)
-                    for j in range(fork_point + 1, len(self.chain)):
+                    for j in range(len(self.chain) - 1, fork_point, -1):
                         del self.block_table[self.chain[j].hash()]
-                        self.block_hash_pool.remove(hash(self.chain[j].data))
-                    self.chain = self.chain[:fork_point + 1]
+                        self.block_hash_pool.difference_update(entry_hash(entry) for entry in self.chain[j].entries())
+                        self.post_index.rollback(j, self.chain[j])
+                    del self.chain[fork_point + 1:]
                     self.chain.extend(remote_chain[remote_idx:])
                     # Add indice of merged remote subchain
                     for j in range(remote_idx, len(remote_chain)):
                         self.block_table[remote_chain[j].hash()] = (fork_point + 1) + (j - remote_idx)
-                        self.block_hash_pool.add(hash(remote_chain[j].data))
+                        self.block_hash_pool.update(entry_hash(entry) for entry in remote_chain[j].entries())
+                        self.post_index.add((fork_point + 1) + (j - remote_idx), remote_chain[j])
+                        self.ledger.apply((fork_point + 1) + (j - remote_idx), remote_chain[j])
+                    self._update_tip()
                     return fork_point, discarded_blocks
-        return -1, []
+        return None, []
     
-    def encode(self):
-        res = b''
-        for block in self.chain:
-            res += block.encode()
-        return res
+    # encode the blocks in [start, end), the whole chain by default
+    def encode(self, start=0, end=None):
+        # a chain backed by a BlockStore already holds its blocks encoded back to back
+        if hasattr(self.chain, 'encode_range'):
+            return self.chain.encode_range(start, end)
+        return b''.join([block.encode() for block in self.chain[start:end]])
+
+    # release the storage behind the chain, if any
+    def close(self):
+        if hasattr(self.chain, 'close'):
+            self.chain.close()
 
     def __eq__(self, other):
         if not isinstance(other, Blockchain):
@@ -185,19 +383,52 @@ class Blockchain():
                 res += block.data.decode() + "->"
         return res
     
+    # decode blocks encoded back to back, without checking whether they form a chain
+    @staticmethod
+    def decode_blocks(encoded_blocks):
+        # walk the buffer through a memoryview, so only each block's data is copied out of it
+        view = memoryview(encoded_blocks)
+        header_size = ENCODE_STRUCT.size
+        blocks = []
+        start = 0
+        while start < len(view):
+            if start + header_size > len(view):
+                raise RuntimeError("The encoded blocks are truncated")
+            prev_hs, nonce, data_size = ENCODE_STRUCT.unpack_from(view, start)
+            data_start = start + header_size
+            start = data_start + data_size
+            if start > len(view):
+                raise RuntimeError("The encoded blocks are truncated")
+            blocks.append(Block(prev_hs.decode(), view[data_start:start].tobytes(), nonce))
+        return blocks
+
+    # decode a whole chain that arrives in chunks of complete blocks, yielding one block at a time;
+    # each block is checked against the one before it, so only the current chunk is held in memory
+    @classmethod
+    def iter_decode(cls, chunks):
+        previous_hash = ROOT_HASH
+        for chunk in chunks:
+            for block in cls.decode_blocks(chunk):
+                block_hash = block.hash()
+                if block.previous_hash != previous_hash or block_hash[:cls.difficulty] != "0" * cls.difficulty:
+                    raise RuntimeError("The encoded blockchain is not valid")
+                previous_hash = block_hash
+                yield block
+
     @classmethod
     def decode(cls, encoded_blockchain):
-        format_string = '64sII'
-        header_size = struct.calcsize(format_string)
-        bc = cls([])
-        start = 0
-        while start < len(encoded_blockchain):
-            prev_hs, nonce, data_size = struct.unpack(format_string, encoded_blockchain[start:start + header_size])
-            block = Block(prev_hs.decode(), encoded_blockchain[start + header_size:start + header_size + data_size], nonce)
-            if not bc.isAttachableBlock(block):
-                raise RuntimeError("The encoded blockchain is not valid")
-            bc.add(block)
-            start += header_size + data_size
+        blocks = cls.decode_blocks(encoded_blockchain)
+        bc = cls()
+        # verify the whole chain in one pass, then build the lookup tables in bulk instead of add() per block
+        if not bc.isValidSubchain(blocks):
+            raise RuntimeError("The encoded blockchain is not valid")
+        bc.chain = blocks
+        bc.block_table = {block.hash(): i for i, block in enumerate(blocks)}
+        bc.block_hash_pool = {entry_hash(entry) for block in blocks for entry in block.entries()}
+        for i, block in enumerate(blocks):
+            bc.post_index.add(i, block)
+            bc.ledger.apply(i, block)
+        bc._update_tip()
         return bc
 
 if __name__ == '__main__':
@@ -233,8 +464,8 @@ if __name__ == '__main__':
         bc1.add(mined_block)
 
     bc2 = Blockchain()
-    bc2.chain = list(bc1.chain)
-    bc2.block_table = bc1.block_table.copy()
+    for block in bc1.chain:
+        bc2.add(block)
     database2 = [b"changed", b"changed DATA here", b"I'm longer than the other chain"]
 
     for data in database1:
@@ -251,7 +482,8 @@ if __name__ == '__main__':
     # for block in bc2.chain:
     #     print(block)
 
-    bc1.mergeChain(bc2.chain)
+    fork_point, _ = bc1.mergeChain(bc2.chain)
+    print(f"merged at fork point {fork_point}" if fork_point is not None else "remote chain is shorter, not merged")
     print(f"merged list is valid? {bc1.isValid()}")
     print("merged list: ")
     for block in bc1.chain:
@@ -0,0 +1,82 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# inventory items are announced as (kind, id) pairs, where kind is the message type that carries the item's body
+INV_POST = b'N'
+INV_BLOCK = b'M'
+INV_ID_LEN = 32 # raw sha256
+INV_ENTRY_LEN = 1 + INV_ID_LEN
+
+GOSSIP_FANOUT = 8 # number of peers a new item is announced to; 0 for all peers
+REQUEST_TIMEOUT = 5 # seconds before an item that was requested but never delivered is requested again
+
+def encode_inventory(items):
+    """encode [(kind, id)] as the payload of an `I` or `D` message"""
+    return b''.join(kind + item_id for kind, item_id in items)
+
+def decode_inventory(payload):
+    return [(payload[i:i + 1], payload[i + 1:i + INV_ENTRY_LEN]) for i in range(0, len(payload) - INV_ENTRY_LEN + 1, INV_ENTRY_LEN)]
+
+class Inventory():
+    """
+    Bodies of the posts and blocks a node has seen recently, so that it can serve them to peers
+    that ask for them after an announcement, and the items it has asked a peer for, so that an item
+    announced by several peers is only fetched once.
+    """
+    def __init__(self, capacity=4096, fanout=GOSSIP_FANOUT):
+        self.lock = threading.Lock()
+        self.items = OrderedDict() # (kind, id) -> body, least recently seen first
+        self.requested = {} # (kind, id) -> time of the request
+        self.capacity = capacity
+        self.fanout = fanout
+
+    def add(self, kind, item_id, body):
+        """remember an item's body; return False if it was already known"""
+        with self.lock:
+            key = (kind, item_id)
+            self.requested.pop(key, None)
+            if key in self.items:
+                self.items.move_to_end(key)
+                return False
+            self.items[key] = body
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+            return True
+
+    def get(self, kind, item_id):
+        with self.lock:
+            return self.items.get((kind, item_id))
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def to_request(self, items, is_known):
+        """
+        pick the announced items that are neither known (to the inventory, or by is_known(kind, id))
+        nor already requested from another peer, and mark them as requested
+        """
+        now = time.monotonic()
+        wanted = []
+        with self.lock:
+            for key in items:
+                if key in self.items or now - self.requested.get(key, -REQUEST_TIMEOUT) < REQUEST_TIMEOUT:
+                    continue
+                wanted.append(key)
+        wanted = [key for key in wanted if not is_known(*key)]
+        with self.lock:
+            for key in wanted:
+                self.requested[key] = now
+            # forget requests that were never answered
+            for key in [key for key, requested_at in self.requested.items() if now - requested_at >= REQUEST_TIMEOUT]:
+                del self.requested[key]
+        return wanted
+
+    def pick_peers(self, peers, exclude=None):
+        """choose the peers to announce a new item to"""
+        peers = [peer for peer in peers if peer is not exclude]
+        if self.fanout <= 0 or len(peers) <= self.fanout:
+            return peers
+        return random.sample(peers, self.fanout)
@@ -0,0 +1,141 @@
+import re
+import struct
+from bisect import bisect_left
+
+from .ledger import AUTHOR_LEN, TX_MARKER
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# `Q` query: kind, limit, height to search below (NO_HEIGHT for the newest posts), then the author or the text
+QUERY_FORMAT = '>cII'
+QUERY_STRUCT = struct.Struct(QUERY_FORMAT)
+QUERY_AUTHOR = b'a'
+QUERY_TEXT = b't'
+NO_HEIGHT = 2 ** 32 - 1
+MAX_QUERY_RESULTS = 100 # blocks in one answer to a query
+# `R` results: each post is the block's height and size, then the encoded block
+RESULT_FORMAT = '>II'
+RESULT_STRUCT = struct.Struct(RESULT_FORMAT)
+
+def tokenize(text):
+    """the distinct lower-cased words of a text"""
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+def encode_query(kind, argument, limit, before=None):
+    return QUERY_STRUCT.pack(kind, limit, NO_HEIGHT if before is None else before) + argument.encode('utf-8')
+
+def decode_query(payload):
+    """return (kind, argument, limit, before)"""
+    kind, limit, before = QUERY_STRUCT.unpack_from(payload)
+    return kind, payload[QUERY_STRUCT.size:].decode('utf-8'), limit, None if before == NO_HEIGHT else before
+
+def encode_results(results):
+    """encode [(height, encoded block)] as the payload of an `R` message"""
+    return b''.join(RESULT_STRUCT.pack(height, len(encoded_block)) + encoded_block for height, encoded_block in results)
+
+def decode_results(payload):
+    """return [(height, encoded block)]"""
+    results = []
+    start = 0
+    while start < len(payload):
+        height, size = RESULT_STRUCT.unpack_from(payload, start)
+        start += RESULT_STRUCT.size
+        results.append((height, payload[start:start + size]))
+        start += size
+    return results
+
+class PostIndex():
+    """
+    Secondary indices of the posts on a chain: author -> heights of the blocks with their posts, and
+    word -> heights of the blocks with posts that contain it. A block that carries a batch of posts is
+    listed once per author and word. Posting lists are kept in ascending order of height, and blocks are
+    only ever added or discarded at the tip, so both are appends and pops at the end of the lists.
+    """
+    def __init__(self):
+        self.authors = {} # author key hash (hex) -> heights
+        self.tokens = {} # word -> heights
+
+    @staticmethod
+    def post_terms(entry):
+        """(author, words) of a post"""
+        author = entry[:AUTHOR_LEN].decode('utf-8', errors='replace')
+        # transactions are listed under their sender, but have no words
+        if entry[AUTHOR_LEN:AUTHOR_LEN + len(TX_MARKER)] == TX_MARKER:
+            return author, set()
+        return author, tokenize(entry[AUTHOR_LEN:].decode('utf-8', errors='replace'))
+
+    @classmethod
+    def _terms(cls, block):
+        authors, tokens = set(), set()
+        for entry in block.entries():
+            author, words = cls.post_terms(entry)
+            authors.add(author)
+            tokens |= words
+        return authors, tokens
+
+    def add(self, height, block):
+        authors, tokens = self._terms(block)
+        for author in authors:
+            self.authors.setdefault(author, []).append(height)
+        for token in tokens:
+            self.tokens.setdefault(token, []).append(height)
+
+    def rollback(self, height, block):
+        """remove the block at height, which must be the most recently added one"""
+        authors, tokens = self._terms(block)
+        for author in authors:
+            self._pop(self.authors, author, height)
+        for token in tokens:
+            self._pop(self.tokens, token, height)
+
+    def state(self):
+        """the posting lists, as JSON-serializable data for restore()"""
+        return {'authors': self.authors, 'tokens': self.tokens}
+
+    def restore(self, state):
+        self.authors = state['authors']
+        self.tokens = state['tokens']
+
+    @staticmethod
+    def _pop(postings, key, height):
+        heights = postings[key]
+        if heights[-1] != height:
+            raise ValueError(f"Only the block at the tip can be rolled back, not height {height}")
+        heights.pop()
+        if not heights:
+            del postings[key]
+
+    @staticmethod
+    def _newest(heights, limit, before):
+        end = len(heights) if before is None else bisect_left(heights, before)
+        return heights[max(0, end - limit):end][::-1]
+
+    def by_author(self, author, limit, before=None):
+        """heights of the newest `limit` blocks below height `before` with posts by the author, newest first"""
+        return self._newest(self.authors.get(author, []), limit, before)
+
+    def search(self, text, limit, before=None):
+        """
+        heights of the newest `limit` blocks below height `before` whose posts contain every word of text,
+        newest first. In a batch, the words may come from different posts, so callers match each post again.
+        """
+        postings = [self.tokens.get(token, []) for token in tokenize(text)]
+        if not postings:
+            return []
+        # walk the rarest word's blocks from the newest, and look each one up in the other lists
+        postings.sort(key=len)
+        rarest, others = postings[0], postings[1:]
+        end = len(rarest) if before is None else bisect_left(rarest, before)
+        heights = []
+        for i in range(end - 1, -1, -1):
+            if len(heights) >= limit:
+                break
+            height = rarest[i]
+            if all(self._contains(other, height) for other in others):
+                heights.append(height)
+        return heights
+
+    @staticmethod
+    def _contains(heights, height):
+        i = bisect_left(heights, height)
+        return i < len(heights) and heights[i] == height
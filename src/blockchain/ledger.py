@@ -0,0 +1,164 @@
+from hashlib import sha256
+import struct
+
+from ..crypto import SIGNATURE_LEN
+
+# A post (a block's data, or one post of a batch, see Block.entries()) is its author's key hash (64 hex
+# chars) followed by its content. A transaction's content is TX_MARKER and a transaction; any other post
+# is a plain post. A donation's transaction is followed by the sender's signature of it and the sender's
+# public key, so that every node can check it was made by the account it spends from.
+AUTHOR_LEN = 64
+BLOCK_POST = 'post'
+BLOCK_TRANSACTION = 'transaction'
+TX_MARKER = b'\x00TX'
+# kind, recipient key hash (hex), amount, and a reference that makes each transaction unique
+# (a nonce chosen by the sender of a donation, or anything a miner picks for its reward)
+TX_FORMAT = '>c64sQ32s'
+TX_STRUCT = struct.Struct(TX_FORMAT)
+TX_SIZE = len(TX_MARKER) + TX_STRUCT.size
+TX_DONATION = b'D' # from the post's author to the recipient
+TX_REWARD = b'R' # from the coinbase to the miner of the block, which pays for it with its proof of work
+COINBASE = "0" * 64 # author of reward transactions
+BLOCK_REWARD = 50
+
+SNAPSHOT_INTERVAL = 128 # blocks between snapshots of the balances
+MAX_SNAPSHOTS = 8
+
+def encode_transaction(kind, recipient, amount, reference):
+    """the content of a transaction post"""
+    return TX_MARKER + TX_STRUCT.pack(kind, recipient.encode('utf-8'), amount, reference)
+
+def decode_transaction(data):
+    """return (sender, kind, recipient, amount) of a transaction, or None for a plain post"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    content = data[AUTHOR_LEN:]
+    if content[:len(TX_MARKER)] != TX_MARKER or len(content) < TX_SIZE:
+        return None
+    kind, recipient, amount, _ = TX_STRUCT.unpack_from(content, len(TX_MARKER))
+    return data[:AUTHOR_LEN].decode('utf-8', errors='replace'), kind, recipient.decode('utf-8', errors='replace'), amount
+
+def is_transaction(entry):
+    """whether a post claims to be a transaction; one that doesn't decode is malformed, not a plain post"""
+    return entry[AUTHOR_LEN:AUTHOR_LEN + len(TX_MARKER)] == TX_MARKER
+
+def transaction_signature(entry):
+    """
+    return (signed content, signature, public key bytes) of a transaction signed with its sender's own key,
+    or None. The signature itself is checked by nodes, see Worker._check_signatures().
+    """
+    content = entry[AUTHOR_LEN:]
+    if decode_transaction(entry) is None or len(content) <= TX_SIZE + SIGNATURE_LEN:
+        return None
+    public_key = content[TX_SIZE + SIGNATURE_LEN:]
+    # the sender is the author key hash of the key, as blockchain.hash() computes it
+    if sha256(str(public_key).encode('utf-8')).hexdigest() != entry[:AUTHOR_LEN].decode('utf-8', errors='replace'):
+        return None
+    return content[:TX_SIZE], content[TX_SIZE:TX_SIZE + SIGNATURE_LEN], public_key
+
+def encode_reward(account, reference):
+    """the reward post of a block, paid to the account (key hash) of its miner"""
+    return COINBASE.encode('utf-8') + encode_transaction(TX_REWARD, account, BLOCK_REWARD, reference)
+
+def valid_rewards(entries):
+    """whether the posts of a block carry at most one reward, as their first post, of BLOCK_REWARD from the coinbase"""
+    for i, entry in enumerate(entries):
+        transaction = decode_transaction(entry)
+        if transaction is None:
+            continue
+        sender, kind, _, amount = transaction
+        if (kind == TX_REWARD or sender == COINBASE) and (i > 0 or kind != TX_REWARD or sender != COINBASE or amount != BLOCK_REWARD):
+            return False
+    return True
+
+def entry_type(entry):
+    return BLOCK_POST if decode_transaction(entry) is None else BLOCK_TRANSACTION
+
+class Ledger():
+    """
+    Balances of all accounts after the first `height` blocks of a chain, updated block by block.
+    - A donation the sender can't cover is left on the chain but moves nothing, so every node
+      reaches the same balances whatever order it saw the blocks in.
+    - Each applied block records the balances it changed, so rolling back the tip is as cheap as
+      applying it. The balances are also copied every SNAPSHOT_INTERVAL blocks; the undo records are
+      only kept since the latest snapshot, and a reorg below it restores the closest snapshot under
+      the fork point and replays at most SNAPSHOT_INTERVAL blocks.
+    """
+    def __init__(self, snapshot_interval=SNAPSHOT_INTERVAL, max_snapshots=MAX_SNAPSHOTS):
+        self.snapshot_interval = snapshot_interval
+        self.max_snapshots = max_snapshots
+        self.height = 0 # number of blocks applied
+        self.balances = {} # account key hash -> balance
+        self.undo = [] # for each block since the latest snapshot: [(account, balance before the block or None)]
+        self.snapshots = [(0, {})] # (height, balances), oldest first
+
+    def balance(self, account):
+        return self.balances.get(account, 0)
+
+    def can_donate(self, sender, amount):
+        return amount > 0 and self.balance(sender) >= amount
+
+    def _transfers(self, entry):
+        """[(account, change in balance)] of a post, against the balances so far"""
+        transaction = decode_transaction(entry)
+        if transaction is None:
+            return []
+        sender, kind, recipient, amount = transaction
+        if kind == TX_REWARD and sender == COINBASE and amount == BLOCK_REWARD:
+            return [(recipient, amount)]
+        # a donation only moves funds with the signature and key of its sender; nodes check the signature before
+        # they take a block, see Worker._check_signatures()
+        if kind == TX_DONATION and sender != COINBASE and transaction_signature(entry) is not None and self.can_donate(sender, amount):
+            return [(sender, -amount), (recipient, amount)]
+        return []
+
+    def apply(self, height, block):
+        """apply the block at height, which must be right above the blocks applied so far"""
+        if height != self.height:
+            raise ValueError(f"Expected the block at height {self.height}, got height {height}")
+        changes = []
+        # the posts of a batch are applied in order, so a donation can spend what an earlier one brought in
+        for entry in block.entries():
+            for account, change in self._transfers(entry):
+                changes.append((account, self.balances.get(account)))
+                self.balances[account] = self.balance(account) + change
+        self.undo.append(changes)
+        self.height += 1
+        if self.height % self.snapshot_interval == 0:
+            self.snapshots.append((self.height, dict(self.balances)))
+            if len(self.snapshots) > self.max_snapshots:
+                self.snapshots.pop(0)
+            self.undo = []
+
+    def state(self):
+        """everything restore() needs to rebuild the ledger, as JSON-serializable data"""
+        return {'height': self.height, 'balances': self.balances, 'undo': self.undo, 'snapshots': self.snapshots}
+
+    def restore(self, state):
+        self.height = state['height']
+        self.balances = state['balances']
+        self.undo = [[tuple(change) for change in changes] for changes in state['undo']]
+        self.snapshots = [(height, balances) for height, balances in state['snapshots']]
+
+    def truncate(self, height, chain):
+        """roll the balances back to after the first `height` blocks of chain"""
+        while self.height > height and self.undo:
+            for account, balance in reversed(self.undo.pop()):
+                if balance is None:
+                    del self.balances[account]
+                else:
+                    self.balances[account] = balance
+            self.height -= 1
+        if self.height == height:
+            return
+        # below the latest snapshot: start over from the closest snapshot, or from scratch
+        while self.snapshots and self.snapshots[-1][0] > height:
+            self.snapshots.pop()
+        snapshot_height, balances = self.snapshots[-1] if self.snapshots else (0, {})
+        if not self.snapshots:
+            self.snapshots.append((0, {}))
+        self.height = snapshot_height
+        self.balances = dict(balances)
+        self.undo = []
+        for i in range(snapshot_height, height):
+            self.apply(i, chain[i])
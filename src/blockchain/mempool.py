@@ -0,0 +1,118 @@
+import time
+from collections import OrderedDict
+
+from .blockchain import entry_hash
+from .ledger import decode_transaction
+
+MAX_ENTRIES = 10000 # max number of posts waiting to be mined
+MAX_BYTES = 16 * 1024 * 1024 # max total size of the posts waiting to be mined
+ENTRY_TTL = 3600 # seconds a post may wait to be mined before it is dropped
+
+PRIORITY_POST = 0
+PRIORITY_TRANSACTION = 1 # transactions move balances, so they are mined before posts
+
+def entry_priority(entry):
+    return PRIORITY_POST if decode_transaction(entry) is None else PRIORITY_TRANSACTION
+
+class Mempool():
+    """
+    The posts waiting to be mined, in mining order: highest priority first, then
+    first in, first out. Entries are indexed by entry_hash(entry), the same hash a chain keeps in
+    block_hash_pool, so duplicates are found without scanning.
+    The pool is bounded by max_entries and max_bytes: when it is full, the lowest priority, most recent
+    entry is evicted, and a new entry that would be that entry is rejected instead, so a flood of posts
+    can't push out the posts that are about to be mined. Entries older than ttl seconds are dropped.
+    Not thread-safe: the worker guards it with its pool lock.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=ENTRY_TTL, priority=entry_priority):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.priority = priority
+        self.queues = {} # priority -> OrderedDict(entry hash -> (entry, time added)), oldest first
+        self.priorities = {} # entry hash -> priority
+        self.nbytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def __contains__(self, entry):
+        return entry_hash(entry) in self.priorities
+
+    def has_id(self, entry_id):
+        """whether the entry with this hash is pending"""
+        return entry_id in self.priorities
+
+    def __iter__(self):
+        """entries in mining order"""
+        for priority in sorted(self.queues, reverse=True):
+            for entry, _ in list(self.queues[priority].values()):
+                yield entry
+
+    def add(self, entry, now=None):
+        """add an entry; return False if it is already pending, or rejected because the pool is full"""
+        entry_id = entry_hash(entry)
+        if entry_id in self.priorities:
+            return False
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        priority = self.priority(entry)
+        self.queues.setdefault(priority, OrderedDict())[entry_id] = (entry, now)
+        self.priorities[entry_id] = priority
+        self.nbytes += len(entry)
+        while len(self.priorities) > self.max_entries or self.nbytes > self.max_bytes:
+            victim_id = next(reversed(self.queues[min(self.queues)]))
+            self._remove(victim_id)
+            if victim_id == entry_id:
+                return False
+            self.evicted += 1
+        return True
+
+    def _remove(self, entry_id):
+        priority = self.priorities.pop(entry_id)
+        queue = self.queues[priority]
+        entry, _ = queue.pop(entry_id)
+        if not queue:
+            del self.queues[priority]
+        self.nbytes -= len(entry)
+
+    def discard(self, entry):
+        entry_id = entry_hash(entry)
+        if entry_id in self.priorities:
+            self._remove(entry_id)
+
+    def expire(self, now=None):
+        """drop the entries that have waited longer than ttl"""
+        now = time.monotonic() if now is None else now
+        for priority in list(self.queues):
+            queue = self.queues[priority]
+            # each queue is in the order entries were added, so the stale entries are at its front
+            while priority in self.queues and now - next(iter(queue.values()))[1] > self.ttl:
+                self._remove(next(iter(queue)))
+                self.expired += 1
+
+    def peek(self, now=None):
+        """the next entry to mine, or None if the pool is empty"""
+        self.expire(now)
+        if not self.queues:
+            return None
+        entry, _ = next(iter(self.queues[max(self.queues)].values()))
+        return entry
+
+    def batch(self, max_entries, max_bytes, now=None):
+        """the next entries to mine together: as many as fit in max_entries and max_bytes, at least one"""
+        self.expire(now)
+        entries = []
+        nbytes = 0
+        for priority in sorted(self.queues, reverse=True):
+            for entry, _ in self.queues[priority].values():
+                if len(entries) >= max_entries or (entries and nbytes + len(entry) > max_bytes):
+                    return entries
+                entries.append(entry)
+                nbytes += len(entry)
+        return entries
+
+    def stats(self):
+        return {'entries': len(self.priorities), 'bytes': self.nbytes, 'evicted': self.evicted, 'expired': self.expired}
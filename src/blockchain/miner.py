@@ -0,0 +1,118 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from .blockchain import MAX_NONCE, difficulty_target, find_nonce
+
+class Miner():
+    """
+    Single-threaded proof-of-work search, run on the calling thread.
+    mine() returns None if cancel() is called before a valid nonce is found, or once is_stale()
+    returns True, e.g. because the chain tip moved and the block no longer extends it. Both are
+    polled between batches of nonces, so a stale search stops within one batch.
+    A cancel() while no search runs stops the next one, so a cancel that races with the start of
+    a search isn't lost; the cancellation is used up when the search it stopped ends.
+    """
+    def __init__(self):
+        self._cancel_event = threading.Event()
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    @property
+    def hash_rate(self):
+        """Hashes per second over all searches done by this miner."""
+        return self.hashes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _stopped(self, is_stale):
+        return self._cancel_event.is_set() or (is_stale is not None and is_stale())
+
+    def mine(self, block, difficulty, is_stale=None, batch_size=1024):
+        start_time = time.perf_counter()
+        header_prefix = block.header_prefix()
+        target = difficulty_target(difficulty)
+        try:
+            # checking the event is costly compared to one hash, so only poll it between batches
+            for nonce_start in range(block.nonce, MAX_NONCE, batch_size):
+                nonce, tried = find_nonce(header_prefix, target, nonce_start, batch_size)
+                self.hashes += tried
+                if nonce is not None:
+                    block.nonce = nonce
+                    return block
+                if self._stopped(is_stale):
+                    return None
+            return None
+        finally:
+            self._cancel_event.clear()
+            self.elapsed += time.perf_counter() - start_time
+
+    def close(self):
+        self.cancel()
+
+class ParallelMiner(Miner):
+    """
+    Proof-of-work search split over a pool of processes.
+    The nonce space is handed out in chunks of chunk_size; as soon as one chunk yields a
+    valid nonce, the remaining chunks are cancelled. Cancellation latency is bounded by
+    the time a process needs to scan one chunk.
+    """
+    def __init__(self, processes=None, chunk_size=2 ** 14):
+        super().__init__()
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        # spawn instead of fork: the node forks from a process that already runs several threads
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def mine(self, block, difficulty, is_stale=None):
+        start_time = time.perf_counter()
+        next_nonce = block.nonce
+        header_prefix = block.header_prefix()
+        target = difficulty_target(difficulty)
+        pending = set()
+
+        def submit_chunk():
+            nonlocal next_nonce
+            if next_nonce >= MAX_NONCE:
+                return
+            # only the 64-byte header prefix crosses the process boundary, never the block data
+            pending.add(self.executor.submit(find_nonce, header_prefix, target, next_nonce, self.chunk_size))
+            next_nonce += self.chunk_size
+
+        try:
+            # keep two chunks queued per process so that no process idles between chunks
+            for _ in range(self.processes * 2):
+                submit_chunk()
+            while pending:
+                done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                if self._stopped(is_stale):
+                    return None
+                found = None
+                for future in done:
+                    nonce, tried = future.result()
+                    self.hashes += tried
+                    if nonce is not None and (found is None or nonce < found):
+                        found = nonce
+                if found is not None:
+                    block.nonce = found
+                    return block
+                for _ in done:
+                    submit_chunk()
+            return None
+        finally:
+            for future in pending:
+                future.cancel()
+            self._cancel_event.clear()
+            self.elapsed += time.perf_counter() - start_time
+
+    def close(self):
+        super().close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+def create_miner(processes=1):
+    """Return a Miner for processes == 1, or a ParallelMiner over the given number of processes (0 or None = all cores)."""
+    if processes == 1:
+        return Miner()
+    return ParallelMiner(processes)
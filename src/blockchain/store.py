@@ -0,0 +1,275 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from .blockchain import Block, Blockchain, entry_hash, merkle_root
+
+INDEX_FORMAT = '>QI32s32s' # offset in the log, size of the encoded block, block hash, Merkle root of its posts
+INDEX_RECORD_SIZE = struct.calcsize(INDEX_FORMAT)
+POST_COUNT_FORMAT = '>I' # number of posts of a block in posts.idx, followed by their hashes
+POST_COUNT_STRUCT = struct.Struct(POST_COUNT_FORMAT)
+POST_HASH_SIZE = 32
+STATE_FILE = 'state.json'
+
+class BlockStore():
+    """
+    Durable, append-only storage of a chain of blocks in a directory:
+    - blocks.dat: Block.encode() records back to back, i.e. exactly the bytes of Blockchain.encode()
+    - blocks.idx: one fixed-size INDEX_FORMAT record per block, so that a restarted node can
+      rebuild its lookup tables without touching the log
+    - posts.idx: for each block, the number of its posts and the raw entry_hash() of each, so that
+      block_hash_pool is rebuilt without decoding the blocks either
+    - state.json: whatever else the chain saves when it is closed, see StoredBlockchain
+    The log is read through a memory map, so ranges of blocks can be served without decoding them.
+    """
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.log_file = open(os.path.join(directory, 'blocks.dat'), 'a+b')
+        self.index_file = open(os.path.join(directory, 'blocks.idx'), 'a+b')
+        self.posts_file = open(os.path.join(directory, 'posts.idx'), 'a+b')
+        self.offsets = [] # offset of each block in the log, plus the end of the log as last item
+        self.block_hashes = []
+        self.post_offsets = [] # offset of each block's record in posts.idx, plus the end of the file as last item
+        self.post_hashes = [] # entry_hash() of the posts of each block
+        self.closed = False
+        self._map = None
+        self._load_index()
+        self._load_post_hashes()
+
+    def _load_index(self):
+        self.index_file.seek(0)
+        index_bytes = self.index_file.read()
+        # drop a partially written trailing record
+        index_bytes = index_bytes[:len(index_bytes) - len(index_bytes) % INDEX_RECORD_SIZE]
+        log_size = os.fstat(self.log_file.fileno()).st_size
+        offset = 0
+        for block_offset, size, block_hash, _ in struct.iter_unpack(INDEX_FORMAT, index_bytes):
+            # an index record is only valid if its block was fully written to the log before it
+            if block_offset != offset or block_offset + size > log_size:
+                break
+            self.offsets.append(block_offset)
+            self.block_hashes.append(block_hash.hex())
+            offset = block_offset + size
+        self.offsets.append(offset)
+        # roll back whatever a crash left behind after the last complete block
+        self._truncate_files(len(self.block_hashes))
+
+    def _load_post_hashes(self):
+        self.posts_file.seek(0)
+        posts_bytes = self.posts_file.read()
+        offset = 0
+        while len(self.post_hashes) < len(self.block_hashes) and offset + POST_COUNT_STRUCT.size <= len(posts_bytes):
+            count, = POST_COUNT_STRUCT.unpack_from(posts_bytes, offset)
+            start = offset + POST_COUNT_STRUCT.size
+            end = start + count * POST_HASH_SIZE
+            if end > len(posts_bytes):
+                break
+            self.post_offsets.append(offset)
+            self.post_hashes.append([posts_bytes[i:i + POST_HASH_SIZE].hex() for i in range(start, end, POST_HASH_SIZE)])
+            offset = end
+        self.post_offsets.append(offset)
+        self.posts_file.truncate(offset)
+        # blocks whose record didn't make it before a crash, or that were stored before posts.idx existed
+        for idx in range(len(self.post_hashes), len(self.block_hashes)):
+            self._append_post_hashes(self.read_block(idx))
+
+    def _append_post_hashes(self, block):
+        post_hashes = [entry_hash(entry) for entry in block.entries()]
+        record = POST_COUNT_STRUCT.pack(len(post_hashes)) + b''.join(bytes.fromhex(post_hash) for post_hash in post_hashes)
+        self.posts_file.write(record)
+        self.posts_file.flush()
+        self.post_offsets.append(self.post_offsets[-1] + len(record))
+        self.post_hashes.append(post_hashes)
+
+    def _truncate_files(self, height):
+        self._unmap()
+        self.log_file.truncate(self.offsets[height])
+        self.index_file.truncate(height * INDEX_RECORD_SIZE)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _mapped(self, end):
+        # a memory map can't grow with the file, so map again once a read goes past its end
+        if self._map is None or len(self._map) < end:
+            self._unmap()
+            self.log_file.flush()
+            self._map = mmap.mmap(self.log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __len__(self):
+        return len(self.block_hashes)
+
+    def append(self, block):
+        encoded_block = block.encode()
+        with self.lock:
+            offset = self.offsets[-1]
+            self.log_file.write(encoded_block)
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.index_file.write(struct.pack(INDEX_FORMAT, offset, len(encoded_block), bytes.fromhex(block.hash()), merkle_root(block.entries())))
+            self.index_file.flush()
+            self.offsets.append(offset + len(encoded_block))
+            self.block_hashes.append(block.hash())
+            self._append_post_hashes(block)
+
+    def truncate(self, height):
+        """Discard every block from the given height on."""
+        with self.lock:
+            if height >= len(self.block_hashes):
+                return
+            del self.offsets[height + 1:]
+            del self.block_hashes[height:]
+            self._truncate_files(height)
+            self.posts_file.truncate(self.post_offsets[height])
+            del self.post_offsets[height + 1:]
+            del self.post_hashes[height:]
+
+    def read_range(self, start, end):
+        """return the encoded blocks in [start, end) as one bytes object, sliced straight from the map"""
+        with self.lock:
+            start_offset, end_offset = self.offsets[start], self.offsets[end]
+            if start_offset == end_offset:
+                return b''
+            return self._mapped(end_offset)[start_offset:end_offset]
+
+    def read_block(self, idx):
+        return Block.decode(self.read_range(idx, idx + 1))
+
+    def save_state(self, state):
+        """write state (JSON-serializable) to state.json, replacing it whole even if the node crashes meanwhile"""
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(path + '.tmp', path)
+
+    def load_state(self):
+        """the state last saved, or None"""
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._unmap()
+            self.log_file.close()
+            self.index_file.close()
+            self.posts_file.close()
+
+class StoredChain():
+    """
+    List-like view of the blocks in a BlockStore, used as Blockchain.chain.
+    Blocks are decoded from the store on access and only the most recently used ones stay in memory;
+    appending or deleting a tail of the chain writes through to the store.
+    """
+    def __init__(self, store, cache_size=1024):
+        self.store = store
+        self.cache = OrderedDict() # block index -> decoded Block
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self.store)
+
+    def _cache(self, idx, block):
+        self.cache[idx] = block
+        self.cache.move_to_end(idx)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _get(self, idx):
+        block = self.cache.get(idx)
+        if block is None:
+            block = self.store.read_block(idx)
+        self._cache(idx, block)
+        return block
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._get(i) for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("chain index out of range")
+        return self._get(key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def __delitem__(self, key):
+        # only a tail of the chain can be discarded, since the store is append-only
+        start, stop, step = key.indices(len(self)) if isinstance(key, slice) else (key, len(self), 1)
+        if step != 1 or stop != len(self):
+            raise ValueError("StoredChain only supports deleting a tail of the chain")
+        self.store.truncate(start)
+        for idx in [idx for idx in self.cache if idx >= start]:
+            del self.cache[idx]
+
+    def append(self, block):
+        self.store.append(block)
+        self._cache(len(self) - 1, block)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def remove(self, block):
+        idx = self.store.block_hashes.index(block.hash())
+        tail = self[idx + 1:]
+        del self[idx:]
+        self.extend(tail)
+
+    def encode_range(self, start=0, end=None):
+        return self.store.read_range(start, len(self) if end is None else end)
+
+    def close(self):
+        self.store.close()
+
+class StoredBlockchain(Blockchain):
+    """
+    A Blockchain backed by a BlockStore. Closing it saves the post index and the ledger next to the store,
+    with the height and tip they were built for, so that the next load_blockchain() restores them
+    instead of decoding every block.
+    """
+    def close(self):
+        store = self.chain.store
+        if store.closed:
+            return
+        store.save_state({
+            'height': self.height,
+            'tip_hash': self.tip_hash,
+            'post_index': self.post_index.state(),
+            'ledger': self.ledger.state()
+        })
+        super().close()
+
+def load_blockchain(directory):
+    """
+    Open (or create) the block store in directory and return a Blockchain backed by it.
+    block_table and block_hash_pool are rebuilt from the indices alone, without decoding any block. The post
+    index and the ledger are restored from the state saved by the last close(); if the chain changed after
+    it, e.g. the node crashed, they are rebuilt with one pass over the blocks.
+    """
+    store = BlockStore(directory)
+    bc = StoredBlockchain(StoredChain(store))
+    bc.block_table = {block_hash: i for i, block_hash in enumerate(store.block_hashes)}
+    bc.block_hash_pool = {post_hash for post_hashes in store.post_hashes for post_hash in post_hashes}
+    state = store.load_state()
+    if state is not None and state['height'] == bc.height and state['tip_hash'] == bc.tip_hash:
+        bc.post_index.restore(state['post_index'])
+        bc.ledger.restore(state['ledger'])
+        return bc
+    for i, block in enumerate(bc.chain):
+        bc.post_index.add(i, block)
+        bc.ledger.apply(i, block)
+    return bc
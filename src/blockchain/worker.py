@@ -1,34 +1,81 @@
+import concurrent.futures
+import os
 import socket
-import select
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .blockchain import Block, Blockchain, hash
+from .blockchain import ROOT_HASH, Block, Blockchain, encode_batch, entry_hash, hash
+from .miner import create_miner
+from .store import load_blockchain
+from .ledger import TX_DONATION, TX_SIZE, decode_transaction, encode_reward, is_transaction, transaction_signature
+from .mempool import ENTRY_TTL, MAX_BYTES, MAX_ENTRIES, Mempool
+from .gossip import GOSSIP_FANOUT, INV_BLOCK, INV_POST, Inventory, decode_inventory, encode_inventory
 from ..message import Message
-from ..crypto import SIGNATURE_LEN, RSA_KEY_SIZE, verify_signature, sign_data
+from ..crypto import SIGNATURE_LEN, RSA_KEY_SIZE, SignatureVerifier, sign_data
 from ..utils import AtomicBool
+from ..p2p.peers import PeerManager
+from ..p2p.transport import OVERFLOW_DROP, Connection, Transport, create_dispatcher
+
+SYNC_BATCH_SIZE = 128 # max number of blocks in one `B` message
+EXPORT_CHUNK_SIZE = 64 * 1024 # bytes of encoded blocks in one `X` message of a chain export
+EXPORT_TIMEOUT = 30 # seconds to wait for the reader of an export to take the next chunk
+EXPORT_WORKERS = 4 # chain exports streamed at the same time
+# flag byte in front of each `X` chunk
+EXPORT_MORE = b'\x01'
+EXPORT_LAST = b'\x00'
+EXPORT_ABORTED = b'\x02' # the chain was reorganized under the export; ask again
+# a block carries up to MAX_BLOCK_POSTS posts of the mempool, and up to MAX_BLOCK_BYTES of them
+MAX_BLOCK_POSTS = 64
+MAX_BLOCK_BYTES = 1024 * 1024
+BATCH_WAIT = 0 # seconds mining waits for more posts when there aren't enough for a full block
+PEER_QUEUE_SIZE = 1024 # max number of messages waiting to be sent to one peer
+# a peer that falls that far behind misses broadcasts rather than slowing down the node; it
+# catches up with a block sync once it sees a block it can't attach
+PEER_QUEUE_OVERFLOW = OVERFLOW_DROP
 
 class Worker():
-    def __init__(self, enable_mining=True, name="default", log_filepath=None):
+    def __init__(self, enable_mining=True, name="default", log_filepath=None, mining_processes=1, data_dir=None, gossip_fanout=GOSSIP_FANOUT, mempool_size=MAX_ENTRIES, mempool_bytes=MAX_BYTES, mempool_ttl=ENTRY_TTL, max_block_posts=MAX_BLOCK_POSTS, max_block_bytes=MAX_BLOCK_BYTES, batch_wait=BATCH_WAIT, reward_account=None):
         self.log_lock = threading.Lock()
         self.log_file = None
         self.log_file = open(f"{log_filepath}.log", 'w') if log_filepath else None
         self.running = AtomicBool(True)
         self.name = name
-        self.bc = Blockchain()
+        # with a data_dir, the chain survives restarts in an on-disk block store
+        self.bc = load_blockchain(data_dir) if data_dir else Blockchain()
         self.peer_socket_lock = threading.Lock()
-        self.has_peer_cond = threading.Condition(self.peer_socket_lock)
-        self.peer_sockets = set()
+        self.peer_sockets = set() # Connections to peers
+        self.sync_buffers = {} # peer -> blocks of the remote chain received so far in a sync
+        # peers are rated by their blocks and round trips, so that the P2P client keeps the best ones
+        self.peer_manager = PeerManager()
+        # all sockets of the node are served by one event loop; messages from peers are handled
+        # one at a time on the dispatcher thread
+        self.transport = Transport(f"{name}-transport", PEER_QUEUE_SIZE, PEER_QUEUE_OVERFLOW)
+        self.dispatcher = create_dispatcher(f"{name}-peers")
+        # exports wait on slow readers for up to EXPORT_TIMEOUT per chunk, so they run on their own threads
+        # rather than holding up the dispatchers
+        self.exports = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix=f"{name}-exports")
+        # posts and blocks are announced by hash to gossip_fanout peers, which fetch the bodies they miss
+        self.inventory = Inventory(fanout=gossip_fanout)
+        # signatures of posts from peers are checked on a pool, so that the dispatcher keeps receiving
+        self.verifier = SignatureVerifier()
 
-        self.mempool = set()
+        # posts waiting to be mined, bounded and in a predictable mining order
+        self.mempool = Mempool(mempool_size, mempool_bytes, mempool_ttl)
+        self.max_block_posts = max_block_posts
+        self.max_block_bytes = max_block_bytes
+        self.batch_wait = batch_wait
+        # key hash the reward of each mined block is paid to; blocks carry no reward without it
+        self.reward_account = reward_account
         self.pool_lock = threading.Lock()
         self.pool_has_job_cond = threading.Condition(self.pool_lock)
 
         self.enable_mining = AtomicBool(enable_mining)
+        # mining_processes > 1 (or 0 for all cores) searches nonces on a process pool
+        self.mining_processes = mining_processes
+        self.miner = create_miner(mining_processes)
         self.worker_thread = threading.Thread(target=self._mine_worker)
         self.worker_thread.start()
-        self.event_thread = threading.Thread(target=self._recv_handler)
-        self.event_thread.start()
 
     def _log(self, *args):
         if self.log_file:
@@ -39,111 +86,170 @@ class Worker():
             for arg in args:
                 print(f"{arg}")
 
-    def _recv_handler(self):
+    def _recv_handler(self, peer, recv_msg):
         """
-        _recv_handler() thread is dedicated to recieve incoming messages
-        from the P2P network, and forward them to their corresponding handler function:
+        _recv_handler() is called on the worker's dispatcher thread for each message received
+        from a peer of the P2P network, and forwards it to its corresponding handler function:
         1. [UPDATE PEER](addr) => __peer_update()
-        2. [NEW BLOCK](signature, content) => _new_pending_block(), from another peer
-        3. [APP BLOCK](signature, content) => _new_pending_block(), from app
+        2. [NEW BLOCK](signature, content) => _relay_post(), from another peer
+        3. [APP BLOCK](signature, content) => _relay_post(), from app
         4. [MINED BLOCK](block) => __mined_block()
         5. [PULL REQUEST](addr) => __push_local_chain()
         6. [CHAIN](addr) => merge remote chain
+        7. [GET BLOCKS](locator) => reply with a batch of blocks after the common ancestor
+        8. [BLOCKS](has_more, blocks) => __synced_blocks()
+        9. [INVENTORY](kind, hash)* => ask for the announced items this node hasn't seen
+        10. [GET DATA](kind, hash)* => reply with the bodies of the requested items
+        11. [EXPORT]() => _export_chain(), stream the whole chain in chunks
+        12. [HELLO](port) => _peer_hello(), the listen port of a peer that dialed this node, or its answer
         """
-        while True:
-            with self.has_peer_cond:
-                while len(self.peer_sockets) == 0:
-                    self.has_peer_cond.wait()
-                    if not self.running.get():
-                        return
-                ready_to_read, _, _ = select.select(list(self.peer_sockets), [], [], 0.1)
-            # nothing to read and asked to stop => terminate
-            if len(ready_to_read) == 0 and not self.running.get():
-                return
-            for sock in ready_to_read:
-                # recv_msg = Message.recv_from(sock)
-                try:
-                    recv_msg = Message.recv_from(sock)
-                    self._log(f"[Worker] Recieved message with type {recv_msg.type_char}")
-                    if recv_msg.type_char == b'N':
-                        public_key_msg, data = Message.unpack(recv_msg.payload)
-                        public_key_bytes = public_key_msg.payload
-                        signature = data[:SIGNATURE_LEN]
-                        block_data = data[SIGNATURE_LEN:]
-                        self._new_pending_block(signature, public_key_bytes, block_data)
-                    elif recv_msg.type_char == b'M':
-                        block = Block.decode(recv_msg.payload)
-                        self.__mined_block(block, sock)
-                    elif recv_msg.type_char == b'P':
-                        with self.pool_lock:
-                            local_chain_msg = Message('C', self.bc.encode())
-                        sock.sendall(local_chain_msg.pack())
-                    elif recv_msg.type_char == b'C':
-                        remote_bc = Blockchain.decode(recv_msg.payload)
-                        with self.pool_lock:
-                            fork_point, discarded_blocks = self.bc.mergeChain(remote_bc.chain)
-                            # if blocks are acquired from remote, remove them from mempool to avoid to mine them again
-                            for remote_idx in range(fork_point, len(self.bc.chain)):
-                                remote_block = self.bc.chain[remote_idx]
-                                if remote_block.data in self.mempool:
-                                    self.mempool.remove(remote_block.data)
-                            # re-mine discarded blocks
-                            # self._log(f"[Worker] # hash pool: {self.bc.block_hash_pool}")
-                            for block in discarded_blocks:
-                                if hash(block.data) not in self.bc.block_hash_pool:
-                                    self.mempool.add(block.data)
-                        self._log("[Worker] remote chain merged" if fork_point != -1 else "[Worker] remote is shorter, reject to merge")
-                        # print(f"isValid: {self.bc.isValid()}")
-                    else:
-                        raise TypeError("Invalid message type")
-                    # with self.pool_lock:
-                    #     self._log(self.bc)
-                    #     self._log(self.mempool)
-                    #     self._log("-------------")
-
-                except ConnectionAbortedError:
-                    self._peer_leave(sock)
+        self._log(f"[Worker] Recieved message with type {recv_msg.type_char}")
+        if recv_msg.type_char == b'N':
+            self._relay_post(recv_msg.payload, peer)
+        elif recv_msg.type_char == b'I':
+            wanted = self.inventory.to_request(decode_inventory(recv_msg.payload), self._has_item)
+            if wanted:
+                peer.send(Message('D', encode_inventory(wanted)))
+        elif recv_msg.type_char == b'D':
+            for kind, item_id in decode_inventory(recv_msg.payload):
+                body = self._get_item(kind, item_id)
+                if body is not None:
+                    peer.send(Message(kind.decode(), body))
+        elif recv_msg.type_char == b'M':
+            block = Block.decode(recv_msg.payload)
+            self.__mined_block(block, peer)
+        elif recv_msg.type_char == b'P':
+            with self.pool_lock:
+                local_chain_msg = Message('C', self.bc.encode())
+            peer.send(local_chain_msg)
+        elif recv_msg.type_char == b'C':
+            remote_bc = Blockchain.decode(recv_msg.payload)
+            if self._check_signatures(remote_bc.chain):
+                self._merge_remote_chain(remote_bc.chain)
+        elif recv_msg.type_char == b'G':
+            peer.send(self._get_blocks(recv_msg.payload))
+        elif recv_msg.type_char == b'B':
+            self.__synced_blocks(recv_msg.payload, peer)
+        elif recv_msg.type_char == b'E':
+            self.exports.submit(self._export_chain, peer)
+        elif recv_msg.type_char == b'F':
+            self._peer_hello(peer, recv_msg.payload)
+        else:
+            raise TypeError("Invalid message type")
 
+    # the mining thread only returns once the worker stops, or when mining is disabled and nothing is pending
     def _mine_worker(self):
-        while True:
-            with self.pool_has_job_cond:
-                while len(self.mempool) == 0:
-                    if not self.enable_mining.get():
-                        return
-                    self.pool_has_job_cond.wait()
-                pending_block_data = next(iter(self.mempool))
-
-            mined_block = self.bc.mine(Block(data=pending_block_data))
-            self._log(f"[Worker] mined a block: {pending_block_data[:10]}...")
-            is_first = False
+        while self.running.get():
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._mine_batch(batch)
+            except (concurrent.futures.CancelledError, concurrent.futures.BrokenExecutor) as e:
+                # the search was cancelled under the miner, or a process of its pool died: the posts stay
+                # pending, and are mined again on a new miner
+                self._log(f"[Worker] failed to mine a block of {len(batch)} posts, retrying: {e!r}")
+                self._requeue(batch)
+                self.miner.close()
+                self.miner = create_miner(self.mining_processes)
+            except BaseException:
+                self._requeue(batch)
+                raise
+
+    # put back the posts of a batch that wasn't mined, unless they made it to the chain meanwhile
+    def _requeue(self, batch):
+        with self.pool_lock:
+            for entry in batch:
+                self._admit(entry)
+
+    # wait for the posts of the next block; return None if the mining thread should exit
+    def _next_batch(self):
+        with self.pool_has_job_cond:
+            batch = self.mempool.batch(self.max_block_posts, self.max_block_bytes)
+            while not batch:
+                if not self.enable_mining.get() or not self.running.get():
+                    return None
+                self.pool_has_job_cond.wait()
+                batch = self.mempool.batch(self.max_block_posts, self.max_block_bytes)
+            # give a partial batch up to batch_wait seconds to fill up, so that one proof of work covers more posts
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_block_posts and self.running.get():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.pool_has_job_cond.wait(remaining)
+                batch = self.mempool.batch(self.max_block_posts, self.max_block_bytes)
+            return batch
+
+    def _mine_batch(self, batch):
+        # the miner's reward comes first; its random reference keeps it distinct from every other reward
+        entries = ([encode_reward(self.reward_account, os.urandom(32))] if self.reward_account else []) + batch
+        # the search stops as soon as the tip moves, e.g. a peer's block or a merge extended it, or the worker stops;
+        # the batch is then taken from the mempool again and mined on the new tip
+        mined_block = self.bc.mine(Block(data=encode_batch(entries)), self.miner, lambda: not self.running.get())
+        if mined_block is None:
+            return
+        self._log(f"[Worker] mined a block of {len(batch)} posts: {batch[0][:10]}... ({self.miner.hash_rate:.0f} H/s)")
+        is_first = False
+        with self.pool_lock:
+            # otherwise, some of the posts might have already been mined and propagate to this node
+            if any(entry_hash(entry) in self.bc.block_hash_pool for entry in batch):
+                for entry in batch:
+                    if entry_hash(entry) in self.bc.block_hash_pool:
+                        self.mempool.discard(entry)
+                return
+            if self.bc.isAttachableBlock(mined_block):
+                is_first = True
+                for entry in batch:
+                    self.mempool.discard(entry)
+                self.bc.add(mined_block)
+        # if this node is the first one who successfully mined this block, announce it
+        if is_first:
+            self._announce_block(mined_block)
+
+    # remember a new item and announce it to a fan-out of peers, without waiting for any of them
+    def _announce(self, kind, item_id, body, exclude=None):
+        if not self.inventory.add(kind, item_id, body):
+            return
+        with self.peer_socket_lock:
+            peers = self.inventory.pick_peers(self.peer_sockets, exclude)
+        self.transport.broadcast(peers, Message('I', encode_inventory([(kind, item_id)])))
+
+    def _announce_block(self, block, exclude=None):
+        self._announce(INV_BLOCK, bytes.fromhex(block.hash()), block.encode(), exclude)
+
+    # whether an announced item is already on the local chain, or a post is already waiting to be mined
+    def _has_item(self, kind, item_id):
+        if kind == INV_BLOCK:
+            return item_id.hex() in self.bc.block_table
+        with self.pool_lock:
+            return item_id.hex() in self.bc.block_hash_pool or self.mempool.has_id(item_id.hex())
+
+    # body of an item for a peer that asked for it, or None if unknown
+    def _get_item(self, kind, item_id):
+        body = self.inventory.get(kind, item_id)
+        if body is None and kind == INV_BLOCK:
             with self.pool_lock:
-                # otherwise, the block might have already been mined and propagates to this node
-                if hash(pending_block_data) in self.bc.block_hash_pool:
-                    return
-                if pending_block_data in self.mempool and self.bc.isAttachableBlock(mined_block):
-                    is_first = True
-                    self.mempool.remove(pending_block_data)
-                    self.bc.add(mined_block)
-            # if this node is the first one who successfully mined this block, broadcast it
-            if is_first:
-                mined_block_msg = Message('M', mined_block.encode())
-                with self.peer_socket_lock:
-                    for peer_sock in self.peer_sockets:
-                        peer_sock.sendall(mined_block_msg.pack())
-
-    # def broadcast(self, )
+                idx = self.bc.block_table.get(item_id.hex())
+                body = self.bc.chain[idx].encode() if idx is not None else None
+        return body
 
     def stop(self):
         self.enable_mining.set(False)
         self.running.set(False)
+        self.miner.cancel()
         # invoke all conditional waiting threads
         with self.pool_has_job_cond:
             self.pool_has_job_cond.notify_all()
-        with self.has_peer_cond:
-            self.has_peer_cond.notify_all()
         self.worker_thread.join()
+        self.miner.close()
         # print(f"remaining pending blocks: {len(self.mempool)}")
-        self.event_thread.join()
+        self.transport.close()
+        self.dispatcher.shutdown(wait=True)
+        # the transport is closed, so exports waiting on a reader give up right away
+        self.exports.shutdown(wait=True)
+        self.verifier.close()
+        self.bc.close()
         if self.log_file:
             self.log_file.close()
     
@@ -154,43 +260,136 @@ class Worker():
         with self.peer_socket_lock:
             return len(self.peer_sockets)
         
+    # depth, high watermark and drops of the write queue of each peer
+    def _get_queue_stats(self):
+        with self.peer_socket_lock:
+            return [peer.stats() for peer in self.peer_sockets]
+
+    # height is maintained by the blockchain itself, so heartbeats don't have to wait on pool_lock
     def _get_chain_len(self):
-        with self.pool_lock:
-            return len(self.bc.chain)
+        return self.bc.height
 
     # add/remove the peer in local graph
-    def _peer_join(self, sock):
-        self._log(f"[Worker] new peer connected at {sock}")
-        with self.has_peer_cond:
-            self.peer_sockets.add(sock)
-            self.has_peer_cond.notify(1)
+    # a peer is a Connection of the worker's transport, or a connected socket that the transport adopts
+    def _peer_join(self, peer):
+        if not isinstance(peer, Connection):
+            peer = self.transport.wrap(peer)
+        self._log(f"[Worker] new peer connected at {peer}")
+        with self.peer_socket_lock:
+            self.peer_sockets.add(peer)
+        peer.start(self._recv_handler, self._peer_leave, self.dispatcher)
+        return peer
 
-    def _peer_leave(self, sock):
+    def _peer_leave(self, peer):
         with self.peer_socket_lock:
-            self.peer_sockets.remove(sock)
+            self.peer_sockets.discard(peer)
+        self.sync_buffers.pop(peer, None)
+        self.peer_manager.remove(peer)
+
+    # a peer that dialed this node says which port it listens on; it is answered with ours, which times the round trip
+    def _peer_hello(self, peer, payload):
+        peer_addr = (peer.peername[0], int.from_bytes(payload[:2], 'big'))
+        reply, duplicate = self.peer_manager.hello(peer, peer_addr)
+        if duplicate is not None:
+            self._log(f"[Worker] closing duplicate connection to {peer_addr}")
+            duplicate.close()
+        if reply and duplicate is not peer and self.peer_manager.port is not None:
+            peer.send(Message('F', self.peer_manager.port.to_bytes(2, 'big')))
+
+    # validate a post (`N` payload: public key message, signature, data) on the verifier's pool,
+    # then push it to mempool and announce it
+    def _relay_post(self, payload, peer=None):
+        public_key_msg, data = Message.unpack(payload)
+        public_key_bytes = public_key_msg.payload
+        signature = data[:SIGNATURE_LEN]
+        block_data = data[SIGNATURE_LEN:]
+
+        def verified(future):
+            if not future.result():
+                print("invalid signature")
+                return
+            entry = self._add_pending_block(public_key_bytes, block_data, signature)
+            if entry:
+                self._announce(INV_POST, bytes.fromhex(entry_hash(entry)), payload, exclude=peer)
+        self.verifier.submit(block_data, signature, public_key_bytes).add_done_callback(verified)
 
     # validate the signature, and push to mempool
+    # return the mempool entry, or None if the post is invalid or already known
     def _new_pending_block(self, signature, public_key_bytes, data):
-        if not verify_signature(data, signature, public_key_bytes):
+        if not self.verifier.verify(data, signature, public_key_bytes):
             print("invalid signature")
-            return False
+            return None
+        return self._add_pending_block(public_key_bytes, data, signature)
+
+    # the signature must be valid; a donation carries it with the public key, so that other nodes can check it
+    def _add_pending_block(self, public_key_bytes, data, signature=None):
+        entry = hash(public_key_bytes).encode('utf-8') + data
+        if is_transaction(entry):
+            # the signature is over the whole data, so it only signs a transaction that is all of it
+            if signature is None or len(data) != TX_SIZE:
+                print("invalid transaction")
+                return None
+            entry += signature + public_key_bytes
         with self.pool_lock:
-            # discard any duplicated block
-            if hash(data) in self.bc.block_hash_pool:
-                return
-            self.mempool.add(hash(public_key_bytes).encode('utf-8') + data)
-            self.pool_has_job_cond.notify(1)
+            return entry if self._admit(entry) else None
+
+    # push an entry to mempool if it may be mined on the current tip; the caller holds pool_lock
+    # new posts and the posts of blocks a reorg discarded go through the same checks
+    def _admit(self, entry):
+        # discard any duplicated block; the chain records the hash of the whole entry, author included
+        if entry_hash(entry) in self.bc.block_hash_pool or entry in self.mempool:
+            return False
+        # only donations signed by their sender, who can cover them at the tip, are accepted; rewards aren't posted by users
+        if is_transaction(entry):
+            transaction = decode_transaction(entry)
+            if transaction is None or transaction[1] != TX_DONATION or transaction_signature(entry) is None \
+                    or not self.bc.ledger.can_donate(transaction[0], transaction[3]):
+                print("invalid transaction")
+                return False
+        if not self.mempool.add(entry):
+            self._log("[Worker] mempool is full, dropping post")
+            return False
+        self.pool_has_job_cond.notify(1)
+        return True
+
+    # whether every donation in the blocks is signed by its sender; the ledger moves funds without checking
+    # the signatures are checked together on the verifier's pool, and those of donations relayed to this node
+    # before are answered from its cache
+    def _check_signatures(self, blocks):
+        items = []
+        for block in blocks:
+            for entry in block.entries():
+                transaction = decode_transaction(entry)
+                if transaction is None or transaction[1] != TX_DONATION:
+                    continue
+                signed = transaction_signature(entry)
+                if signed is None:
+                    return False
+                items.append(signed)
+        return all(self.verifier.verify_many(items))
 
     # validate the block, and add it to local blockchain
-    def __mined_block(self, block, peer_sock):
-        if hash(block.data) in self.bc.block_hash_pool:
+    def __mined_block(self, block, peer):
+        if block.hash() in self.bc.block_table:
             return
+        # a competing block for data the local chain already has may still come from a winning fork,
+        # so only a block that would extend the local tip is dropped for duplicated data
         if self.bc.isAttachableBlock(block):
+            if any(entry_hash(entry) in self.bc.block_hash_pool for entry in block.entries()):
+                return
+            if not self._check_signatures([block]):
+                self._log("[Worker] block with a forged donation, reject to attach")
+                self.peer_manager.record_block(peer, False)
+                return
             with self.pool_lock:
-                # remove this valid block in mempool, and attach it to the current blockchain
-                if block.data in self.mempool:
-                    self.mempool.remove(block.data)
+                # remove this valid block's posts from mempool, and attach it to the current blockchain
+                for entry in block.entries():
+                    self.mempool.discard(entry)
                 self.bc.add(block)
+                height = self.bc.height
+            self.peer_manager.record_block(peer, True, height)
+            # the tip moved: an in-progress search notices by itself, see _mine_batch()
+            self._announce_block(block, exclude=peer)
         else:
             self._log("block unattachable")
             """
@@ -202,8 +401,116 @@ class Worker():
                 the fork point by comparing the local chain with each hash value in the subchain.
             For case 3) => must contains invalid block on the way back to root and will be detected.
             """
-            pull_msg = Message('P', b'')
-            peer_sock.sendall(pull_msg.pack())
+            self._request_blocks(peer)
+
+    # reply to a `G` request (raw 32-byte hashes of a locator) with a batch of the blocks after the common ancestor
+    def _get_blocks(self, payload):
+        locator = [payload[i:i + 32].hex() for i in range(0, len(payload), 32)]
+        with self.pool_lock:
+            start = self.bc.findForkPoint(locator) + 1
+            end = min(start + SYNC_BATCH_SIZE, self.bc.height)
+            has_more = end < self.bc.height
+            return Message('B', (b'\x01' if has_more else b'\x00') + self.bc.encode(start, end))
+
+    def _export_chain(self, conn):
+        """
+        stream the whole chain to conn as `X` messages of about EXPORT_CHUNK_SIZE bytes of blocks each.
+        The pool lock is only held while a chunk is encoded, and the next chunk is encoded once the
+        previous one is written, so the export costs one chunk of memory however long the chain is.
+        If a reorg replaces blocks that were already sent, the export ends with EXPORT_ABORTED.
+        Runs on the export pool; an export whose reader leaves or stalls for EXPORT_TIMEOUT is dropped.
+        """
+        try:
+            self._stream_chain(conn)
+        except (ConnectionError, concurrent.futures.TimeoutError) as e:
+            self._log(f"[Worker] chain export to {conn.peername} stopped: {e!r}")
+
+    def _stream_chain(self, conn):
+        idx = 0
+        last_hash = None
+        while True:
+            with self.pool_lock:
+                reorganized = last_hash is not None and self.bc.block_table.get(last_hash) != idx - 1
+                if not reorganized:
+                    chunk = []
+                    chunk_size = 0
+                    while idx < self.bc.height and chunk_size < EXPORT_CHUNK_SIZE:
+                        chunk.append(self.bc.encode(idx, idx + 1))
+                        chunk_size += len(chunk[-1])
+                        idx += 1
+                    if idx > 0:
+                        last_hash = self.bc.chain[idx - 1].hash()
+                    has_more = idx < self.bc.height
+            if reorganized:
+                conn.send_wait(Message('X', EXPORT_ABORTED), EXPORT_TIMEOUT)
+                return
+            conn.send_wait(Message('X', (EXPORT_MORE if has_more else EXPORT_LAST) + b''.join(chunk)), EXPORT_TIMEOUT)
+            if not has_more:
+                return
+
+    # ask the peer for the blocks after the most recent block both chains have in common
+    def _request_blocks(self, peer, locator=None):
+        if locator is None:
+            with self.pool_lock:
+                locator = self.bc.locator()
+        get_blocks_msg = Message('G', b''.join(bytes.fromhex(block_hash) for block_hash in locator))
+        self.peer_manager.ping(peer)
+        peer.send(get_blocks_msg)
+
+    # buffer a batch of a remote chain's suffix, and merge the suffix once the last batch arrives
+    def __synced_blocks(self, payload, peer):
+        self.peer_manager.pong(peer)
+        has_more = payload[:1] == b'\x01'
+        blocks = Blockchain.decode_blocks(payload[1:])
+        buffer = self.sync_buffers.setdefault(peer, [])
+        # a batch that doesn't continue the buffered blocks starts over, e.g. the peer reorganized in between
+        if buffer and blocks and blocks[0].previous_hash != buffer[-1].hash():
+            buffer.clear()
+        buffer.extend(blocks)
+        if has_more:
+            self._request_blocks(peer, [buffer[-1].hash()])
+            return
+        self.sync_buffers.pop(peer, None)
+        if not self.bc.isValidSubchain(buffer) or not self._check_signatures(buffer):
+            self._log("[Worker] invalid remote subchain, reject to merge")
+            self.peer_manager.record_block(peer, False)
+            return
+        if not buffer:
+            return
+        fork_point = self._merge_remote_chain(buffer)
+        if fork_point is not None:
+            self.peer_manager.record_block(peer, True, fork_point + 1 + len(buffer))
+            # let the other peers know about the new tip, so that they sync as well
+            self._announce_block(buffer[-1], exclude=peer)
+            return
+        # the peer's chain loses against the local one: announce the local tip, so that the peer syncs from this node
+        with self.pool_lock:
+            fork_point = -1 if buffer[0].previous_hash == ROOT_HASH else self.bc.block_table.get(buffer[0].previous_hash)
+            is_better = fork_point is not None and self.bc.tip_hash != buffer[-1].hash() and \
+                not self.bc.isPreferredFork(fork_point, len(buffer), buffer[-1].hash())
+            tip_block = self.bc.chain[-1] if is_better else None
+        if fork_point is not None:
+            self.peer_manager.record_block(peer, True, fork_point + 1 + len(buffer))
+        if tip_block is not None:
+            peer.send(Message('M', tip_block.encode()))
+
+    # merge a remote chain, or a suffix of it, and update the mempool with the blocks that came and went
+    # return the fork point, or None if the remote chain wasn't merged (-1 is a merge that replaced the whole chain)
+    def _merge_remote_chain(self, remote_chain):
+        with self.pool_lock:
+            fork_point, discarded_blocks = self.bc.mergeChain(remote_chain)
+            # if blocks are acquired from remote, remove them from mempool to avoid to mine them again
+            if fork_point is not None:
+                for remote_idx in range(fork_point + 1, len(self.bc.chain)):
+                    for entry in self.bc.chain[remote_idx].entries():
+                        self.mempool.discard(entry)
+            # re-mine discarded blocks, and the blocks of a rejected remote fork that aren't on the local chain yet;
+            # e.g. a donation its sender can no longer cover on the new tip is dropped
+            for block in discarded_blocks if fork_point is not None else remote_chain:
+                for entry in block.entries():
+                    self._admit(entry)
+        self._log("[Worker] remote chain merged" if fork_point is not None else "[Worker] remote is shorter, reject to merge")
+        return fork_point
 
 if __name__ == '__main__':
     # print("test recieve mined block from peer")
@@ -1,4 +1,9 @@
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
@@ -45,19 +50,30 @@ def sign_data(data, private_key):
     else:
         raise ValueError("public_key must be either a file path or bytes")
 
-    private_key = serialization.load_pem_private_key(
+    return sign_with_key(load_private_key(private_key_bytes), data)
+
+def load_private_key(private_key_bytes):
+    return serialization.load_pem_private_key(
         private_key_bytes,
         password=None,
         backend=default_backend()
     )
 
-    signature = private_key.sign(
+# sign with an already parsed private key
+def sign_with_key(private_key, data):
+    return private_key.sign(
         data,
         rsa_padding.PKCS1v15(),
         hashes.SHA256()
     )
 
-    return signature
+# parsing a PEM key costs more than verifying a signature with it, and posts come from a few authors
+@lru_cache(maxsize=1024)
+def load_public_key(public_key_bytes):
+    return serialization.load_pem_public_key(
+        public_key_bytes,
+        backend=default_backend()
+    )
 
 def verify_signature(data, signature, public_key):
     if isinstance(public_key, str) and os.path.exists(public_key):
@@ -68,10 +84,10 @@ def verify_signature(data, signature, public_key):
     else:
         raise ValueError("public_key must be either a file path or bytes")
 
-    public_key = serialization.load_pem_public_key(
-        public_key_bytes,
-        backend=default_backend()
-    )
+    try:
+        public_key = load_public_key(public_key_bytes)
+    except ValueError: # not a PEM public key
+        return False
 
     try:
         public_key.verify(
@@ -84,6 +100,60 @@ def verify_signature(data, signature, public_key):
     except InvalidSignature:
         return False
 
+class SignatureVerifier():
+    """
+    Verifies post signatures on a thread pool, off the threads that receive the posts.
+    Signatures that verified once are remembered by (key hash, hash of signature and data), so a
+    post that reaches the node again, e.g. relayed by several peers, isn't verified again.
+    Only successful verifications are cached.
+    """
+    def __init__(self, workers=2, cache_size=65536):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verifier")
+        self.lock = threading.Lock()
+        self.verified = OrderedDict() # (key hash, signed content hash) -> None, least recently used first
+        self.cache_size = cache_size
+
+    @staticmethod
+    def _cache_key(data, signature, public_key_bytes):
+        return sha256(public_key_bytes).digest(), sha256(signature + data).digest()
+
+    def _cached(self, cache_key):
+        with self.lock:
+            if cache_key in self.verified:
+                self.verified.move_to_end(cache_key)
+                return True
+            return False
+
+    def _verify(self, data, signature, public_key_bytes, cache_key):
+        if not verify_signature(data, signature, public_key_bytes):
+            return False
+        with self.lock:
+            self.verified[cache_key] = None
+            if len(self.verified) > self.cache_size:
+                self.verified.popitem(last=False)
+        return True
+
+    def verify(self, data, signature, public_key_bytes):
+        """verify on the calling thread"""
+        cache_key = self._cache_key(data, signature, public_key_bytes)
+        return self._cached(cache_key) or self._verify(data, signature, public_key_bytes, cache_key)
+
+    def submit(self, data, signature, public_key_bytes):
+        """verify on the pool; return a Future of the result, already done on a cache hit"""
+        cache_key = self._cache_key(data, signature, public_key_bytes)
+        if self._cached(cache_key):
+            future = Future()
+            future.set_result(True)
+            return future
+        return self.executor.submit(self._verify, data, signature, public_key_bytes, cache_key)
+
+    def verify_many(self, items):
+        """verify a batch of (data, signature, public_key_bytes) concurrently; return the results in order"""
+        return [future.result() for future in [self.submit(*item) for item in items]]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
 if __name__ == '__main__':
     generate_rsa_key_pair("private_key.pem", "public_key.pem")
     data = b"Important message"
@@ -25,7 +25,19 @@ def main():
     parser_node.add_argument('--node_port', type=int, required=True, help='Port for the node to listen on')
     parser_node.add_argument('--tracker_addr', type=str, required=True, help='IP address of p2p tracker')
     parser_node.add_argument('--tracker_port', type=int, required=True, help='Port of the p2p tracker')
-    parser_node.add_argument('--heartbeat_interval', type=int, required=True, help='Interval in seconds for sending heartbeat to tracker')
+    parser_node.add_argument('--heartbeat_interval', type=int, required=True, help='Seconds between heartbeats to the tracker; a heartbeat is sent right away when the tip changes, and idle nodes back off up to 8 times longer')
+    parser_node.add_argument('--mining_processes', type=int, default=1, help='Number of processes searching for nonces (0 for all cores)')
+    parser_node.add_argument('--data_dir', type=str, default=None, help='Directory to persist the blockchain in (in-memory only if omitted)')
+    parser_node.add_argument('--gossip_fanout', type=int, default=8, help='Number of peers each new post or block is announced to (0 for all peers)')
+    parser_node.add_argument('--mempool_size', type=int, default=10000, help='Max number of posts waiting to be mined; new posts are dropped when it is full')
+    parser_node.add_argument('--mempool_bytes', type=int, default=16 * 1024 * 1024, help='Max total size of the posts waiting to be mined; new posts are dropped when it is reached')
+    parser_node.add_argument('--mempool_ttl', type=int, default=3600, help='Seconds a post may wait to be mined before it is dropped')
+    parser_node.add_argument('--max_block_posts', type=int, default=64, help='Max number of posts mined together in one block')
+    parser_node.add_argument('--max_block_bytes', type=int, default=1024 * 1024, help='Max total size of the posts in one block')
+    parser_node.add_argument('--batch_wait', type=float, default=0, help='Seconds mining waits for more posts when there are too few for a full block')
+    parser_node.add_argument('--target_outbound', type=int, default=8, help='Number of peers the node dials and keeps, longest chains first')
+    parser_node.add_argument('--max_inbound', type=int, default=24, help='Max number of peers that dialed the node it keeps connected')
+    parser_node.add_argument('--reward_key', type=str, default='public_key.pem', help='Public key whose account is paid the reward of each block the node mines')
     parser_node.set_defaults(func=run_node)
 
     # Tracker service
@@ -40,6 +52,9 @@ def main():
     parser_web.add_argument('--tracker_addr', type=str, required=True, help='IP address of p2p tracker')
     parser_web.add_argument('--tracker_port', type=int, required=True, help='Port of the p2p tracker')
     parser_web.add_argument('--interval', type=int, required=True, help='Interval in minutes for the webserver to update connected node')
+    parser_web.add_argument('--pool_size', type=int, default=3, help='Number of longest-chain nodes the webserver spreads its connections over')
+    parser_web.add_argument('--connections_per_node', type=int, default=2, help='Max number of connections from the webserver to each node')
+    parser_web.add_argument('--signing_processes', type=int, default=os.cpu_count() or 1, help='Number of processes signing posts with the default key pair (all cores by default, 0 to sign on the request thread)')
     parser_web.set_defaults(func=run_webserver)
 
     args = parser.parse_args()
@@ -1,8 +1,15 @@
+import asyncio
 import struct
 import socket
 
 HEADER_FORMAT = 'cQ'  # 'c' for character, 'Q' for 8-byte unsigned integer (Big Endian by default)
 
+# A tagged message (`#`) carries a request id followed by a whole packed message. Responses to a tagged
+# request are tagged with the same id, so many requests can be in flight on one connection.
+TAG_TYPE = '#'
+REQUEST_ID_FORMAT = '>I'
+REQUEST_ID_SIZE = struct.calcsize(REQUEST_ID_FORMAT)
+
 class Message:
     def __init__(self, type_char, payload):
         self.type_char = type_char.encode('utf-8')
@@ -27,13 +34,25 @@ class Message:
 
         return cls(type_char.decode('utf-8'), payload), rest
 
+    def tag(self, request_id):
+        return Message(TAG_TYPE, struct.pack(REQUEST_ID_FORMAT, request_id) + self.pack())
+
+    @classmethod
+    def untag(cls, payload):
+        """return (request id, message) of a tagged message's payload"""
+        if len(payload) < REQUEST_ID_SIZE:
+            raise ValueError("Tagged message is too short for a request id", len(payload))
+        request_id, = struct.unpack_from(REQUEST_ID_FORMAT, payload)
+        msg, _ = cls.unpack(payload[REQUEST_ID_SIZE:])
+        return request_id, msg
+
     @classmethod
     def recv_from(cls, sock):
         header_size = struct.calcsize(HEADER_FORMAT)
         try:
             header = sock.recv(header_size)
         except ConnectionResetError:
-            pass
+            raise ConnectionAbortedError("Connection reset by the other end of the socket")
 
         if len(header) == 0:
             raise ConnectionAbortedError("Connection closed by the other end of the socket")
@@ -51,6 +70,20 @@ class Message:
 
         return cls(type_char.decode('utf-8'), bytes(payload))
 
+    @classmethod
+    async def read_from(cls, reader):
+        """Receive one message from an asyncio StreamReader"""
+        header_size = struct.calcsize(HEADER_FORMAT)
+        try:
+            header = await reader.readexactly(header_size)
+            type_char, payload_size = struct.unpack(HEADER_FORMAT, header)
+            payload = await reader.readexactly(payload_size)
+        except asyncio.IncompleteReadError:
+            raise ConnectionAbortedError("Connection closed by the other end of the stream")
+        except ConnectionResetError:
+            raise ConnectionAbortedError("Connection reset by the other end of the stream")
+        return cls(type_char.decode('utf-8'), payload)
+
 if __name__ == '__main__':
     # Create a pair of connected sockets
     sock1, sock2 = socket.socketpair()
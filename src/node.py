@@ -1,89 +1,181 @@
-import socket
-import select
+import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .blockchain import Worker
-from .p2p import P2PClient
+from .blockchain import Worker, ROOT_HASH, BATCH_WAIT, ENTRY_TTL, GOSSIP_FANOUT, MAX_BLOCK_BYTES, MAX_BLOCK_POSTS, MAX_BYTES, MAX_ENTRIES, MAX_QUERY_RESULTS, QUERY_AUTHOR, QUERY_TEXT, decode_query, encode_results, hash
+from .p2p import MAX_INBOUND, TARGET_OUTBOUND, P2PClient, PeerManager, TaggedConnection, create_dispatcher
 from .message import Message
-from .crypto import SIGNATURE_LEN
+
+APP_REQUEST_WORKERS = 8 # threads handling tagged requests from apps concurrently
+TIP_NOTIFY_INTERVAL = 1 # seconds between checks that the notifier should stop
 
 class Node(Worker):
-    def __init__(self, p2p_addr, tracker_addr, node_addr=None, app_sockets=None, enable_mining=True, name="default", log_filepath=None, heartbeat_interval=5):
-        super().__init__(enable_mining, name, log_filepath)
-        self.p2p_client = P2PClient(p2p_addr, tracker_addr, node_addr, self._peer_join, self._peer_leave, self._get_chain_len, heartbeat_interval)
-        if app_sockets == None:
-            app_sockets = []
-        self.app_sockets = set(app_sockets)
+    def __init__(self, p2p_addr, tracker_addr, node_addr=None, app_sockets=None, enable_mining=True, name="default", log_filepath=None, heartbeat_interval=5, mining_processes=1, data_dir=None, gossip_fanout=GOSSIP_FANOUT, mempool_size=MAX_ENTRIES, mempool_bytes=MAX_BYTES, mempool_ttl=ENTRY_TTL, max_block_posts=MAX_BLOCK_POSTS, max_block_bytes=MAX_BLOCK_BYTES, batch_wait=BATCH_WAIT, target_outbound=TARGET_OUTBOUND, max_inbound=MAX_INBOUND, reward_account=None):
+        super().__init__(enable_mining, name, log_filepath, mining_processes, data_dir, gossip_fanout, mempool_size=mempool_size, mempool_bytes=mempool_bytes, mempool_ttl=mempool_ttl, max_block_posts=max_block_posts, max_block_bytes=max_block_bytes, batch_wait=batch_wait, reward_account=reward_account)
+        self.app_sockets = set() # Connections to apps
         self.app_sockets_lock = threading.Lock()
+        # the P2P client keeps a bounded set of peers, picked with the ratings the worker gives them
+        self.peer_manager = PeerManager(target_outbound, max_inbound)
+        # the P2P client shares the worker's transport, so tracker, peer and app connections run on one event loop
+        self.p2p_client = P2PClient(p2p_addr, tracker_addr, node_addr, self._peer_join, self._peer_leave, self._heartbeat_state, heartbeat_interval, self.transport, self.peer_manager)
+        self.app_dispatcher = create_dispatcher(f"{name}-apps")
+        self.app_requests = ThreadPoolExecutor(max_workers=APP_REQUEST_WORKERS, thread_name_prefix=f"{name}-app-requests")
+        # apps that subscribed (`U`) to the tip are sent a `W` each time it changes
+        self.subscribers = set()
+        self.tip_changed = threading.Event()
+        self.bc.on_tip_change = self._on_tip_change
+        self.notifier_thread = threading.Thread(target=self._notify_subscribers, daemon=True)
+        self.notifier_thread.start()
+        for app_sock in app_sockets or []:
+            self._app_join(self.transport.wrap(app_sock))
 
         self.node_addr = node_addr
         if self.node_addr: # expose the node server to web-server
-            self.server_socket = self.create_server(node_addr)
-            self._app_recv_thread = threading.Thread(target=self._app_recv_handler)
-            self._app_recv_thread.start()
+            self.server = self.transport.serve(node_addr, self._app_join)
+            self._log(f"[Node] app server listening on {node_addr[0]}:{node_addr[1]}")
 
-    def _app_recv_handler(self):
-        while True:
+    def _app_join(self, app_conn):
+        self._log(f"[Node] Accept new app connection from {app_conn.peername}")
+        with self.app_sockets_lock:
+            self.app_sockets.add(app_conn)
+        app_conn.start(self._app_recv_handler, self._app_leave, self.app_dispatcher)
+
+    def _app_leave(self, app_conn):
+        with self.app_sockets_lock:
+            self.app_sockets.discard(app_conn)
+            self.subscribers = {subscriber for subscriber in self.subscribers if getattr(subscriber, 'conn', subscriber) is not app_conn}
+
+    def _app_recv_handler(self, app_conn, recv_msg):
+        self._log(f"[Node] Recieved message with type {recv_msg.type_char}")
+        if recv_msg.type_char == b'#':
+            # tagged requests run concurrently, and their responses go back tagged with the request's id,
+            # so a slow request doesn't hold up the ones behind it on the same connection
+            request_id, request = Message.untag(recv_msg.payload)
+            if request.type_char == b'#':
+                raise TypeError("Tagged messages can't be nested")
+            self.app_requests.submit(self._app_request, TaggedConnection(app_conn, request_id), request)
+        elif recv_msg.type_char == b'A':
+            # validate the post from app, and announce it to peers
+            self._relay_post(recv_msg.payload)
+        elif recv_msg.type_char == b'P':
+            with self.pool_lock:
+                local_chain_msg = Message('C', self.bc.encode())
+            app_conn.send(local_chain_msg)
+        elif recv_msg.type_char == b'G':
+            # the webserver keeps its own copy of the chain up to date the same way peers sync
+            app_conn.send(self._get_blocks(recv_msg.payload))
+        elif recv_msg.type_char == b'E':
+            self.exports.submit(self._export_chain, app_conn)
+        elif recv_msg.type_char == b'Q':
+            app_conn.send(self._query_posts(recv_msg.payload))
+        elif recv_msg.type_char == b'Y':
+            # balance of an account at the tip
+            account = recv_msg.payload.decode('utf-8')
+            with self.pool_lock:
+                balance = self.bc.ledger.balance(account)
+                height = self.bc.height
+            app_conn.send(Message('Z', balance.to_bytes(8, 'big') + height.to_bytes(4, 'big')))
+        elif recv_msg.type_char == b'U':
+            # the subscription's request id tags every notification, starting with the current tip
             with self.app_sockets_lock:
-                ready_to_read, _, _ = select.select(list(self.app_sockets) + [self.server_socket], [], [], 0.1)
-            # nothing to read and asked to stop => terminate
-            if len(ready_to_read) == 0 and not self.running.get():
-                return
-            for sock in ready_to_read:
-                if sock is self.server_socket:
-                    app_sock, addr = self.server_socket.accept()
-                    self._log(f"[Node] Accept new app connection from {addr}")
-                    with self.app_sockets_lock:
-                        self.app_sockets.add(app_sock)
-                else:
-                    try:
-                        recv_msg = Message.recv_from(sock)
-                        self._log(f"[Node] Recieved message with type {recv_msg.type_char}")
-                        if recv_msg.type_char == b'A':
-                            public_key_msg, data = Message.unpack(recv_msg.payload)
-                            public_key_bytes = public_key_msg.payload
-                            signature = data[:SIGNATURE_LEN]
-                            block_data = data[SIGNATURE_LEN:]
-                            self._log(block_data)
-                            self._new_pending_block(signature, public_key_bytes, block_data)
-
-                            # forward the post from app to all peers
-                            forward_msg = Message('N', recv_msg.payload)
-                            with self.peer_socket_lock:
-                                for peer_sock in self.peer_sockets:
-                                    peer_sock.sendall(forward_msg.pack())
-                        elif recv_msg.type_char == b'P':
-                            with self.pool_lock:
-                                local_chain_msg = Message('C', self.bc.encode())
-                            sock.sendall(local_chain_msg.pack())
-                    except ConnectionAbortedError:
-                        with self.app_sockets_lock:
-                            self.app_sockets.remove(sock)
-
-    def create_server(self, node_addr):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(node_addr)
-        server_socket.listen(32)
-        self._log(f"[Node] app server listening on {node_addr[0]}:{node_addr[1]}")
-        return server_socket
+                self.subscribers.add(app_conn)
+            app_conn.send(self._tip_message())
+
+    def _on_tip_change(self):
+        self.tip_changed.set()
+        self.p2p_client.tip_changed()
+
+    # what the heartbeats tell the tracker, read without waiting on pool_lock
+    def _heartbeat_state(self):
+        with self.app_sockets_lock:
+            app_connections = len(self.app_sockets)
+        return {
+            'chain_len': self._get_chain_len(),
+            'tip_hash': self.bc.tip_hash,
+            'mempool_depth': len(self.mempool),
+            'app_connections': app_connections,
+            'peers': self._get_num_peers()
+        }
+
+    def _tip_message(self):
+        """`W`: the tip's hash (raw, zeros for an empty chain) and the chain's height"""
+        with self.pool_lock:
+            tip_hash, height = self.bc.tip_hash or ROOT_HASH, self.bc.height
+        return Message('W', bytes.fromhex(tip_hash) + height.to_bytes(4, 'big'))
+
+    # push the tip to subscribers whenever it changes; changes in a burst, e.g. a merge, are sent as one
+    def _notify_subscribers(self):
+        while self.running.get():
+            if not self.tip_changed.wait(TIP_NOTIFY_INTERVAL):
+                continue
+            self.tip_changed.clear()
+            with self.app_sockets_lock:
+                subscribers = list(self.subscribers)
+            if not subscribers:
+                continue
+            tip_msg = self._tip_message()
+            for subscriber in subscribers:
+                subscriber.send(tip_msg)
+
+    def _query_posts(self, payload):
+        """answer a query for posts by author or by words with `R`, newest posts first"""
+        kind, argument, limit, before = decode_query(payload)
+        limit = min(limit, MAX_QUERY_RESULTS)
+        with self.pool_lock:
+            if kind == QUERY_AUTHOR:
+                heights = self.bc.post_index.by_author(argument, limit, before)
+            elif kind == QUERY_TEXT:
+                heights = self.bc.post_index.search(argument, limit, before)
+            else:
+                raise TypeError("Invalid query kind", kind)
+            results = [(height, self.bc.encode(height, height + 1)) for height in heights]
+        return Message('R', encode_results(results))
+
+    def _app_request(self, tagged_conn, request):
+        try:
+            self._app_recv_handler(tagged_conn, request)
+        except Exception as e:
+            print(f"[ERROR] Failed to handle request {tagged_conn.request_id} ({request.type_char}) from {tagged_conn.peername}: {e!r}")
 
     def __del__(self):
         self.stop()
         return super().__del__()
 
     def stop(self):
-        super().stop()
         self.p2p_client.stop()
-        if self.node_addr:
-            self._app_recv_thread.join()
+        self.running.set(False)
+        self.tip_changed.set()
+        self.notifier_thread.join()
+        super().stop()
+        self.app_dispatcher.shutdown(wait=True)
+        self.app_requests.shutdown(wait=True)
 
 def run_node(args):
+    # block rewards are paid to the account of the node's public key, if it has one
+    reward_account = None
+    if args.reward_key and os.path.exists(args.reward_key):
+        with open(args.reward_key, 'rb') as key_file:
+            reward_account = hash(key_file.read())
+    else:
+        print(f"No public key at {args.reward_key}, mining without rewards")
     node = Node(
         p2p_addr=('0.0.0.0', args.p2p_port), 
         node_addr=('0.0.0.0', args.node_port), 
         tracker_addr=(args.tracker_addr, args.tracker_port),
-        heartbeat_interval=args.heartbeat_interval
+        heartbeat_interval=args.heartbeat_interval,
+        mining_processes=args.mining_processes,
+        data_dir=args.data_dir,
+        gossip_fanout=args.gossip_fanout,
+        mempool_size=args.mempool_size,
+        mempool_bytes=args.mempool_bytes,
+        mempool_ttl=args.mempool_ttl,
+        max_block_posts=args.max_block_posts,
+        max_block_bytes=args.max_block_bytes,
+        batch_wait=args.batch_wait,
+        target_outbound=args.target_outbound,
+        max_inbound=args.max_inbound,
+        reward_account=reward_account
     )
     try:
         print("Node started. Press Ctrl+C to stop.")
@@ -1,2 +1,4 @@
 from .tracker import *
-from .client import *
\ No newline at end of file
+from .client import *
+from .peers import *
+from .transport import *
\ No newline at end of file
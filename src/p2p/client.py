@@ -28,85 +28,169 @@
 
 # p2pnode.py
 import socket
-import select
 import threading
 import requests
 import time
 
 from ..utils import AtomicBool
 from ..message import Message
+from .peers import PeerManager
+from .tracker import encode_heartbeat
+from .transport import Transport, create_dispatcher
+
+PEER_MAINTAIN_INTERVAL = 5 # seconds between refreshes of the candidates' chain lengths from the tracker
+ROTATE_INTERVAL = 60 # seconds between rotations of the lowest scoring outbound peer
+TOP_PEERS_FACTOR = 4 # the tracker is asked for the top target_outbound * TOP_PEERS_FACTOR peers
+MAX_HEARTBEAT_BACKOFF = 8 # an idle node's heartbeat interval grows up to this many times heartbeat_interval
+MIN_HEARTBEAT_GAP = 0.2 # seconds between two heartbeats, so that a burst of tip changes sends one
 
 class P2PClient:
-    def __init__(self, addr, tracker_addr, node_addr, join_handler, leave_handler, get_chain_len_cb, heartbeat_interval=5):
+    def __init__(self, addr, tracker_addr, node_addr, join_handler, leave_handler, get_state_cb, heartbeat_interval=5, transport=None, peer_manager=None):
         self.heartbeat_interval = heartbeat_interval
         self.stop_event = threading.Event()
+        self.heartbeat_wakeup = threading.Event() # set when the tip changes, to send a heartbeat right away
         self.running = AtomicBool(True)
         self.tracker_addr = tracker_addr
         if node_addr == None:
             node_addr = ('0.0.0.0', 0)
         self.node_addr = node_addr
+        # the peers to dial, and which ones to keep, are picked by the peer manager (usually the node's)
+        self.peer_manager = peer_manager or PeerManager()
+        self.peer_manager.port = addr[1]
         # self.peer_sockets = set()  # Stores TCP connections to peers
 
         self.join_handler = join_handler
         self.leave_handler = leave_handler
-        self.get_chain_len_cb = get_chain_len_cb
+        self.get_state_cb = get_state_cb # returns the keyword arguments of encode_heartbeat() but interval
 
-        # 1st. create connector socket
-        self.connector_socket = self.create_connector_socket(addr[0], addr[1])
+        # connections are served by the given transport (usually the node's), or by one of our own
+        self.own_transport = transport is None
+        self.transport = transport or Transport("p2p-transport")
+        self.dispatcher = create_dispatcher("p2p-client")
+        # 1st. listen for connections from other peers
+        self.connector_server = self.create_connector_server(addr[0], addr[1])
         # 2nd. connect to tracker
-        self.tracker_socket = self.connect_to_tracker()
+        self.tracker_conn = self.connect_to_tracker()
         # 3rd. submit registration to tracker with the connector port
-        self.event_thread = threading.Thread(target=self._event_handler)
-        self.event_thread.start()
-        self.tracker_socket.sendall(Message('R', addr[1].to_bytes(2, 'big') + socket.inet_aton(node_addr[0]) + node_addr[1].to_bytes(2, 'big')).pack())
+        self.tracker_conn.start(self._tracker_handler, self._tracker_leave, self.dispatcher)
+        self.tracker_conn.send(Message('R', addr[1].to_bytes(2, 'big') + socket.inet_aton(node_addr[0]) + node_addr[1].to_bytes(2, 'big')))
         # 4th. heartbeat to tracker
         self.heartbeat_thread = threading.Thread(target=self._heartbeat_handler)
         self.heartbeat_thread.start()
+        # 5th. keep the outbound side of the peer set filled with the best candidates
+        self.maintain_thread = threading.Thread(target=self._maintain_peers)
+        self.maintain_thread.start()
 
         # self.self_addr = self.get_internal_ip()
 
-    def _event_handler(self):
-        """Receives messages from a socket."""
+    def _tracker_handler(self, tracker_conn, recv_msg):
+        """
+        At the beginning, recieve the list of peers from tracker (`L`). Afterwards the tracker pushes the
+        peers that join (`J`) and leave (`V`), and answers our requests for the longest-chain peers (`P`).
+        They are candidates that the maintenance thread dials as the outbound side needs them.
+        """
+        if recv_msg.type_char == b'P':
+            chain_lens = {}
+            for j in range(0, len(recv_msg.payload), 10):
+                peer_addr = (socket.inet_ntoa(recv_msg.payload[j:j+4]), int.from_bytes(recv_msg.payload[j+4:j+6], 'big'))
+                chain_lens[peer_addr] = int.from_bytes(recv_msg.payload[j+6:j+10], 'big')
+            self.peer_manager.update_candidates(chain_lens)
+            return
+        if recv_msg.type_char not in (b'L', b'J', b'V'):
+            raise TypeError("Client recieve message of unexpected type from tracker", recv_msg.type_char)
+        peer_addrs = []
+        for j in range(0, len(recv_msg.payload), 6):
+            peer_ip_addr = socket.inet_ntoa(recv_msg.payload[j:j+4])
+            peer_port = int.from_bytes(recv_msg.payload[j+4:j+6], 'big')
+            peer_addrs.append((peer_ip_addr, peer_port))
+        if recv_msg.type_char == b'V':
+            self.peer_manager.discard_candidates(peer_addrs)
+        else:
+            self.peer_manager.add_candidates(peer_addrs)
+
+    def _tracker_leave(self, tracker_conn):
+        if self.running.get():
+            self._log("[ERROR] Disconnected from tracker. P2P client is down.")
+
+    def _accept_peer(self, peer_conn):
+        """Accept incoming connections from other peers through the connector server, within the inbound limit"""
+        victim = self.peer_manager.add_inbound(peer_conn)
+        if victim is peer_conn:
+            self._log(f"[INFO] Refused P2P connection from {peer_conn.peername}: too many inbound peers")
+            peer_conn.close()
+            return
+        if victim is not None:
+            self._log(f"[INFO] Evicted inbound peer {victim.peername} for {peer_conn.peername}")
+            victim.close()
+        self._log(f"[INFO] Incoming P2P connection from {peer_conn.peername}")
+        self.join_handler(peer_conn)
+
+    def _maintain_peers(self):
+        """dial candidates while the outbound side isn't full, and rotate out the lowest scoring outbound peer"""
+        last_refresh = last_rotation = time.monotonic()
+        self._request_top_peers()
         while self.running.get():
-            ready_to_read, _, _ = select.select([self.tracker_socket, self.connector_socket], [], [], 0.1)
-            for sock in ready_to_read:
-                # At the beginning, recieve and connect to the list of peers from tracker
-                if sock is self.tracker_socket:
-                    try:
-                        peer_list_msg = Message.recv_from(sock)
-                        if peer_list_msg.type_char != b'L':
-                            raise TypeError("Client recieve message other than type `L` from tracker")
-                        for j in range(0, len(peer_list_msg.payload), 6):
-                            peer_ip_addr = socket.inet_ntoa(peer_list_msg.payload[j:j+4])
-                            peer_port = int.from_bytes(peer_list_msg.payload[j+4:j+6], 'big')
-                            self.connect_to_peer((peer_ip_addr, peer_port))
-                    except ConnectionAbortedError:
-                        self._log("[ERROR] Disconnected from tracker. P2P client is down.")
-                        return
-                # Listen and accept incoming connections from other peers through connector socket
-                elif sock is self.connector_socket:
-                    peer_sock, addr = sock.accept()
-                    self._log(f"[INFO] Incoming P2P connection from {addr}")
-                    # self.peer_sockets.add(peer_sock)
-                    self.join_handler(peer_sock)
+            now = time.monotonic()
+            if now - last_refresh >= PEER_MAINTAIN_INTERVAL:
+                last_refresh = now
+                self._request_top_peers()
+            if now - last_rotation >= ROTATE_INTERVAL:
+                last_rotation = now
+                victim = self.peer_manager.to_rotate()
+                if victim is not None:
+                    self._log(f"[INFO] Rotating out low scoring peer {victim.peername}")
+                    victim.close()
+            for peer_addr in self.peer_manager.to_dial():
+                if not self.running.get():
+                    break
+                self.connect_to_peer(peer_addr)
+            self.peer_manager.changed.wait(PEER_MAINTAIN_INTERVAL)
+            self.peer_manager.changed.clear()
+
+    def _request_top_peers(self):
+        top_k = self.peer_manager.target_outbound * TOP_PEERS_FACTOR
+        self.tracker_conn.send(Message('O', top_k.to_bytes(4, 'big')))
+
+    def tip_changed(self):
+        self.heartbeat_wakeup.set()
 
     def _heartbeat_handler(self):
+        """
+        Send the node's state to the tracker (`H`) as soon as its tip changes, and every interval otherwise.
+        The interval starts at heartbeat_interval, and doubles with each heartbeat that has the same tip as
+        the previous one, up to MAX_HEARTBEAT_BACKOFF times heartbeat_interval. Each heartbeat says when the
+        next one is due at the latest, so the tracker knows when the state is stale.
+        """
+        interval = self.heartbeat_interval
+        last_tip = None
+        sent = False
         while self.running.get():
             try:
-                length = self.get_chain_len_cb()
-                self.tracker_socket.sendall(Message('H', length.to_bytes(4, 'big')).pack())
-                self.stop_event.wait(10)
+                # a change of tip from now on wakes the next wait, and is part of the state read right after
+                self.heartbeat_wakeup.clear()
+                state = self.get_state_cb()
+                if sent and state.get('tip_hash') == last_tip:
+                    interval = min(interval * 2, self.heartbeat_interval * MAX_HEARTBEAT_BACKOFF)
+                else:
+                    interval = self.heartbeat_interval
+                last_tip = state.get('tip_hash')
+                self.tracker_conn.send(Message('H', encode_heartbeat(interval=interval, **state)))
+                sent = True
+                sent_at = time.monotonic()
+                # the next heartbeat is due `interval` after this one; a tip change brings it forward, but no
+                # closer than MIN_HEARTBEAT_GAP
+                self.heartbeat_wakeup.wait(interval)
+                self.stop_event.wait(max(0, sent_at + MIN_HEARTBEAT_GAP - time.monotonic()))
             except KeyboardInterrupt:
                 print("Stopped sending messages.")
             except Exception as e:
                 print(f"An error occurred: {e}")
+                self.stop_event.wait(self.heartbeat_interval)
 
-    def create_connector_socket(self, host, port):
-        connector_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        connector_socket.bind((host, port))
-        connector_socket.listen(32)
+    def create_connector_server(self, host, port):
+        connector_server = self.transport.serve((host, port), self._accept_peer)
         self._log(f"P2P client listening on {host}:{port}")
-        return connector_socket
+        return connector_server
 
     def _log(self, *args):
         for arg in args:
@@ -115,34 +199,44 @@ class P2PClient:
     def connect_to_tracker(self):
         """Establishes a TCP connection to the tracker."""
         try:
-            tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tracker_socket.connect(self.tracker_addr)
+            tracker_conn = self.transport.connect(self.tracker_addr)
             self._log("[INFO] Connected to tracker.")
-            return tracker_socket
+            return tracker_conn
         except Exception as e:
             print(f"[ERROR] Failed to connect to tracker: {e}")
             return None
 
     def connect_to_peer(self, peer_addr):
-        """Establishes a TCP connection to a peer."""
+        """Establishes a TCP connection to a peer, and says which address we listen on (`F` hello)."""
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((peer_addr[0], peer_addr[1]))
-            self._log(f"[INFO] Connected to peer at {peer_addr}.")
-            self.join_handler(peer_socket)
-            # self.peer_sockets.add(peer_socket)
+            peer_conn = self.transport.connect(peer_addr)
         except Exception as e:
+            self.peer_manager.dial_failed(peer_addr)
             print(f"[ERROR] Failed to connect to peer {peer_addr}: {e}")
+            return
+        self._log(f"[INFO] Connected to peer at {peer_addr}.")
+        duplicate = self.peer_manager.add_outbound(peer_conn, peer_addr)
+        if duplicate is not None:
+            # the peer dialed us meanwhile
+            duplicate.close()
+            if duplicate is peer_conn:
+                return
+        self.join_handler(peer_conn)
+        self.peer_manager.ping(peer_conn)
+        peer_conn.send(Message('F', self.peer_manager.port.to_bytes(2, 'big')))
 
     def stop(self):
         self.running.set(False)
         self.stop_event.set()
-        # for peer_sock in self.peer_sockets:
-        #     peer_sock.close()
-        self.event_thread.join()
+        self.heartbeat_wakeup.set()
+        self.peer_manager.changed.set()
         self.heartbeat_thread.join()
-        self.connector_socket.close()
-        self.tracker_socket.close()
+        self.maintain_thread.join()
+        self.transport.call_soon(self.connector_server.close)
+        self.tracker_conn.close()
+        self.dispatcher.shutdown(wait=True)
+        if self.own_transport:
+            self.transport.close()
 
     def get_internal_ip():
         """
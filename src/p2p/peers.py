@@ -0,0 +1,234 @@
+# peers.py
+import random
+import threading
+import time
+
+TARGET_OUTBOUND = 8 # connections a node dials and keeps open
+MAX_INBOUND = 24 # connections a node accepts from peers that dialed it
+MIN_PEER_AGE = 30 # seconds a peer is kept before it may be rotated out or evicted
+ROTATE_SCORE = 1.0 # outbound peers scoring below this are replaced by a fresh candidate
+LATENCY_SCALE = 1.0 # seconds of round trip that cost a peer a whole point of score
+LATENCY_WEIGHT = 0.3 # weight of a new round trip in a peer's average latency
+
+class PeerInfo:
+    def __init__(self, addr, outbound, now):
+        self.addr = addr # listen address of the peer, once known (from its hello if it dialed us)
+        self.outbound = outbound
+        self.connected_at = now
+        self.latency = None # average round trip, in seconds
+        self.ping_sent_at = None # when the request of a pending round trip was sent
+        self.valid_blocks = 0
+        self.invalid_blocks = 0
+        self.height = 0 # length of the peer's chain, as far as we know
+
+class PeerManager:
+    """
+    Keeps a node's peer set bounded: up to target_outbound peers the node dials, and max_inbound peers
+    that dialed it, so the sockets and broadcasts of a node don't grow with the network.
+    - candidates are the peers the tracker knows, with the chain length of their heartbeats; the longest
+      chains are dialed first.
+    - each peer is scored by its rate of valid blocks, its chain height against the best known one, and
+      its round-trip latency (see score()). The lowest scoring outbound peer is rotated out when it falls
+      below ROTATE_SCORE, and a full inbound side evicts its lowest scorer for a newcomer.
+    - a peer that dialed us says which address it listens on (`F` hello), so that we don't dial it back.
+    Thread-safe: the P2P client dials and accepts, and the worker's dispatcher rates the peers.
+    """
+    def __init__(self, target_outbound=TARGET_OUTBOUND, max_inbound=MAX_INBOUND, min_age=MIN_PEER_AGE):
+        self.target_outbound = target_outbound
+        self.max_inbound = max_inbound
+        self.min_age = min_age
+        self.port = None # our own listen port, set by the P2P client
+        self.lock = threading.Lock()
+        self.peers = {} # connection -> PeerInfo
+        self.addrs = {} # listen address -> connection
+        self.dialing = set() # addresses being dialed
+        self.candidates = {} # listen address -> chain length from the tracker
+        self.changed = threading.Event() # set when a peer leaves or candidates arrive, to top up the outbound side
+
+    def _count(self, outbound):
+        return sum(1 for info in self.peers.values() if info.outbound == outbound)
+
+    def num_outbound(self):
+        with self.lock:
+            return self._count(True)
+
+    def num_inbound(self):
+        with self.lock:
+            return self._count(False)
+
+    def _score(self, info, best_height):
+        valid_rate = (info.valid_blocks + 1) / (info.valid_blocks + info.invalid_blocks + 2)
+        height = max(info.height, self.candidates.get(info.addr, 0))
+        height_score = height / best_height if best_height else 1
+        latency_penalty = min(info.latency / LATENCY_SCALE, 1) if info.latency is not None else 0
+        return valid_rate + height_score - latency_penalty
+
+    def _best_height(self):
+        return max([info.height for info in self.peers.values()] + list(self.candidates.values()) + [0])
+
+    def score(self, conn):
+        """between -1 and 2: valid block rate (0.5 without blocks) + height / best known height - latency / LATENCY_SCALE"""
+        with self.lock:
+            return self._score(self.peers[conn], self._best_height())
+
+    def _worst(self, outbound, now):
+        best_height = self._best_height()
+        old_enough = [(self._score(info, best_height), conn) for conn, info in self.peers.items()
+            if info.outbound == outbound and now - info.connected_at >= self.min_age]
+        return min(old_enough, key=lambda x: x[0], default=(None, None))
+
+    def add_outbound(self, conn, addr, now=None):
+        """register a connection we dialed; return the connection to close if the peer dialed us meanwhile"""
+        with self.lock:
+            self.dialing.discard(addr)
+            self.peers[conn] = PeerInfo(addr, True, time.monotonic() if now is None else now)
+            return self._claim(addr, conn, ours=True)
+
+    def _dialed_by_us_wins(self, conn, addr):
+        # of two connections between the same nodes, the one dialed by the lower address is kept;
+        # both ends compare the same two addresses, so they close the same connection
+        sockname = getattr(conn, 'sockname', None)
+        return sockname is None or (sockname[0], self.port) < addr
+
+    def _claim(self, addr, conn, ours):
+        """make conn the connection to addr; return the connection to close if there already was one"""
+        other = self.addrs.get(addr)
+        if other is None or other is conn:
+            self.addrs[addr] = conn
+            return None
+        if self._dialed_by_us_wins(conn, addr) != ours:
+            self.peers.pop(conn, None)
+            return conn
+        self._remove(other)
+        self.addrs[addr] = conn
+        return other
+
+    def add_inbound(self, conn, now=None):
+        """
+        register a connection a peer dialed; return the connection to close, if any: the lowest
+        scoring inbound peer when the inbound side is full, or conn itself if all of them are too recent
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            victim = None
+            if self._count(False) >= self.max_inbound:
+                _, victim = self._worst(False, now)
+                if victim is None:
+                    return conn
+                self._remove(victim)
+            self.peers[conn] = PeerInfo(None, False, now)
+            return victim
+
+    def hello(self, conn, addr):
+        """
+        handle the hello of a peer, which carries its listen address. Return (reply, close): whether to
+        answer with our own hello, and a connection to close if both ends dialed each other.
+        """
+        with self.lock:
+            info = self.peers.get(conn)
+            if info is None:
+                return False, None
+            if info.outbound:
+                # the answer to our hello
+                self._pong(info)
+                return False, None
+            info.addr = addr
+            duplicate = self._claim(addr, conn, ours=False)
+            return duplicate is not conn, duplicate
+
+    def remove(self, conn):
+        with self.lock:
+            self._remove(conn)
+
+    def _remove(self, conn):
+        info = self.peers.pop(conn, None)
+        if info is None:
+            return
+        if info.addr is not None and self.addrs.get(info.addr) is conn:
+            del self.addrs[info.addr]
+        if info.outbound and info.latency is None and info.ping_sent_at is not None:
+            # closed before it answered our hello, e.g. its inbound side is full: don't dial it again
+            # until the tracker lists it again
+            self.candidates.pop(info.addr, None)
+        self.changed.set()
+
+    def ping(self, conn, now=None):
+        """a request the peer answers right away was sent, e.g. a hello or a block sync"""
+        with self.lock:
+            info = self.peers.get(conn)
+            if info is not None and info.ping_sent_at is None:
+                info.ping_sent_at = time.monotonic() if now is None else now
+
+    def pong(self, conn, now=None):
+        with self.lock:
+            info = self.peers.get(conn)
+            if info is not None:
+                self._pong(info, now)
+
+    def _pong(self, info, now=None):
+        if info.ping_sent_at is None:
+            return
+        rtt = (time.monotonic() if now is None else now) - info.ping_sent_at
+        info.ping_sent_at = None
+        info.latency = rtt if info.latency is None else (1 - LATENCY_WEIGHT) * info.latency + LATENCY_WEIGHT * rtt
+
+    def record_block(self, conn, valid, height=None):
+        """a block (or a synced chain) from the peer was valid or not; height is its chain's length, if known"""
+        with self.lock:
+            info = self.peers.get(conn)
+            if info is None:
+                return
+            if valid:
+                info.valid_blocks += 1
+            else:
+                info.invalid_blocks += 1
+            if height is not None:
+                info.height = max(info.height, height)
+
+    def add_candidates(self, addrs):
+        with self.lock:
+            for addr in addrs:
+                self.candidates.setdefault(addr, 0)
+        self.changed.set()
+
+    def discard_candidates(self, addrs):
+        with self.lock:
+            for addr in addrs:
+                self.candidates.pop(addr, None)
+
+    def update_candidates(self, chain_lens):
+        """chain lengths of the longest-chain peers, from the tracker"""
+        with self.lock:
+            self.candidates.update(chain_lens)
+        self.changed.set()
+
+    def to_dial(self):
+        """the candidates to dial to fill the outbound side, longest chains first; they count as dialing"""
+        with self.lock:
+            missing = self.target_outbound - self._count(True) - len(self.dialing)
+            if missing <= 0:
+                return []
+            free = [addr for addr in self.candidates if addr not in self.addrs and addr not in self.dialing]
+            # peers with the same chain length are picked at random, so that nodes don't all dial the same ones
+            random.shuffle(free)
+            free.sort(key=lambda addr: self.candidates[addr], reverse=True)
+            self.dialing.update(free[:missing])
+            return free[:missing]
+
+    def dial_failed(self, addr):
+        with self.lock:
+            self.dialing.discard(addr)
+            # the tracker lists it again if it is still around
+            self.candidates.pop(addr, None)
+
+    def to_rotate(self, now=None):
+        """the lowest scoring outbound peer, if it scores below ROTATE_SCORE and another candidate could replace it"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if not any(addr not in self.addrs for addr in self.candidates):
+                return None
+            score, conn = self._worst(True, now)
+            if conn is None or score >= ROTATE_SCORE:
+                return None
+            self._remove(conn)
+            return conn
@@ -13,26 +13,193 @@
 # None specified, but typical events for a Tracker might include things like "onPeerJoin" and "onPeerLeave" to handle nodes connecting to and disconnecting from the network.
 
 # tracker.py
+import heapq
+import itertools
 import socket
-import select
+import struct
 import threading
 import time
 
 from ..message import Message
-from ..utils import AtomicBool
+from .transport import Transport, create_dispatcher
+
+PEER_ENTRY_LEN = 6 # 4 bytes ip address + 2 bytes port
+TRACKER_BACKLOG = 1024 # pending connections, so that a join storm isn't refused
+TRACKER_QUEUE_SIZE = 4096 # messages waiting to be sent to one client, e.g. the deltas of a join storm
+
+# `H` heartbeat: chain length, tip hash (raw, zeros for an empty chain), mempool depth, app connections,
+# peers, and the milliseconds until the next heartbeat at the latest. A bare 4-byte chain length is accepted too.
+HEARTBEAT_FORMAT = '>I32sIHHI'
+HEARTBEAT_STRUCT = struct.Struct(HEARTBEAT_FORMAT)
+DEFAULT_STALE_AFTER = 30 # seconds after which the state of a client that didn't say when it reports again is stale
+STALE_GRACE = 2 # heartbeats a client may miss before its state is stale
+ROUTE_OVERSAMPLE = 4 # `T` ranks the top k * ROUTE_OVERSAMPLE chains by freshness and load
+MAX_ROUTE_LAG = 1 # blocks a node may be behind the longest chain and still be routed to first
+
+def encode_heartbeat(chain_len, tip_hash=None, mempool_depth=0, app_connections=0, peers=0, interval=0):
+    tip = bytes.fromhex(tip_hash) if tip_hash else bytes(32)
+    return HEARTBEAT_STRUCT.pack(chain_len, tip, min(mempool_depth, 2 ** 32 - 1), min(app_connections, 2 ** 16 - 1), min(peers, 2 ** 16 - 1), int(interval * 1000))
+
+def decode_heartbeat(payload):
+    """return (chain_len, tip_hash or None, mempool_depth, app_connections, peers, interval or None)"""
+    if len(payload) == 4:
+        return int.from_bytes(payload, 'big'), None, 0, 0, 0, None
+    chain_len, tip, mempool_depth, app_connections, peers, interval_ms = HEARTBEAT_STRUCT.unpack(payload)
+    return chain_len, tip.hex() if any(tip) else None, mempool_depth, app_connections, peers, interval_ms / 1000
+
+class PeerList:
+    """
+    The encoded entries (ip + p2p port) of the registered peers, back to back, ready to be sent as
+    an `L` message. Entries are added at the end and removed by moving the last entry into their slot,
+    so a join or a leave costs O(1) however many peers there are.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.slots = {} # key -> index of its entry
+        self.keys = [] # key of each entry, in buffer order
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def add(self, key, entry):
+        self.slots[key] = len(self.keys)
+        self.keys.append(key)
+        self.buffer += entry
+
+    def remove(self, key):
+        """remove the key's entry and return it"""
+        entry = self.entry(key)
+        idx = self.slots.pop(key)
+        start = idx * PEER_ENTRY_LEN
+        last_key = self.keys.pop()
+        if last_key is not key:
+            self.buffer[start:start + PEER_ENTRY_LEN] = self.buffer[-PEER_ENTRY_LEN:]
+            self.keys[idx] = last_key
+            self.slots[last_key] = idx
+        del self.buffer[-PEER_ENTRY_LEN:]
+        return entry
+
+    def entry(self, key):
+        start = self.slots[key] * PEER_ENTRY_LEN
+        return bytes(self.buffer[start:start + PEER_ENTRY_LEN])
+
+    def encode(self):
+        return bytes(self.buffer)
+
+class ChainHeap:
+    """
+    The registered clients ordered by chain length, longest first, as a binary max-heap with the
+    position of each key, so that a heartbeat moves its client in O(log N), and the top k are read
+    in O(k log k) by walking the heap from its root, without sorting all clients.
+    Clients with the same chain length are in order of registration.
+    top() is O(k log k) rather than O(k): the first k slots of the heap array are not the k longest
+    chains, and callers need them ranked. Its cost doesn't depend on N, and k is small (a few times
+    a webserver's pool size), so the log k factor is a handful of comparisons.
+    """
+    def __init__(self):
+        self.heap = [] # [-chain_len, registration order, key]
+        self.positions = {} # key -> index in heap
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def push(self, key, chain_len):
+        self.heap.append([-chain_len, next(self.counter), key])
+        self.positions[key] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
+
+    def update(self, key, chain_len):
+        idx = self.positions[key]
+        old = -self.heap[idx][0]
+        if chain_len == old:
+            return
+        self.heap[idx][0] = -chain_len
+        if chain_len > old:
+            self._sift_up(idx)
+        else:
+            self._sift_down(idx)
+
+    def remove(self, key):
+        idx = self.positions.pop(key)
+        last = self.heap.pop()
+        if idx < len(self.heap):
+            self.heap[idx] = last
+            self.positions[last[2]] = idx
+            self._sift_up(idx)
+            self._sift_down(self.positions[last[2]])
+
+    def top(self, k):
+        """the keys of the k longest chains, longest first"""
+        keys = []
+        candidates = [(self.heap[0][:2], 0)] if self.heap else []
+        while candidates and len(keys) < k:
+            _, idx = heapq.heappop(candidates)
+            keys.append(self.heap[idx][2])
+            for child in (2 * idx + 1, 2 * idx + 2):
+                if child < len(self.heap):
+                    heapq.heappush(candidates, (self.heap[child][:2], child))
+        return keys
+
+    def _sift_up(self, idx):
+        # move the item up through a hole, instead of swapping it with each parent
+        heap, positions = self.heap, self.positions
+        item = heap[idx]
+        while idx > 0:
+            parent = (idx - 1) // 2
+            if not item[:2] < heap[parent][:2]:
+                break
+            heap[idx] = heap[parent]
+            positions[heap[idx][2]] = idx
+            idx = parent
+        heap[idx] = item
+        positions[item[2]] = idx
+
+    def _sift_down(self, idx):
+        heap, positions = self.heap, self.positions
+        item = heap[idx]
+        end = len(heap)
+        child = 2 * idx + 1
+        while child < end:
+            if child + 1 < end and heap[child + 1][:2] < heap[child][:2]:
+                child += 1
+            if not heap[child][:2] < item[:2]:
+                break
+            heap[idx] = heap[child]
+            positions[heap[idx][2]] = idx
+            idx = child
+            child = 2 * idx + 1
+        heap[idx] = item
+        positions[item[2]] = idx
 
 class Tracker:
+    """
+    Keeps the list of registered peers, and serves it on the asyncio transport the nodes use.
+    - `R` registers a client: it gets the current peer list (`L`), and every other registered client
+      is pushed a `J` with its entry. When a registered client disconnects, the others are pushed a `V`.
+    - `H` heartbeats carry a client's chain length, tip and load, and `T` asks for the top-k nodes to route a
+      webserver to (`S`): the longest chains, kept in order by ChainHeap rather than sorted for each request,
+      ranked by how up to date and how busy they are (see _get_client_list()).
+      Clients ask for the top-k longest-chain peers with `O`, to pick whom to dial (`P`: entry and chain length).
+    Messages, and disconnections, are handled one at a time on a dispatcher thread, so no lock is needed.
+    """
     def __init__(self, host, port, log_filepath=None):
         self.log_lock = threading.Lock()
         self.log_file = open(f"{log_filepath}.log", 'w') if log_filepath else None
-        self.running = AtomicBool(True)
         self.connected_sockets = {} # Map from connected but haven't registered clients to their address
-        self.clients_sockets = {} # Map from peer's socket to peer's (address, port, chain_len)
-        # self.clients_lock = threading.Lock()
-        # self.has_client_cond = threading.Condition(self.clients_lock)
-        self.server_socket = self.create_server_socket(host, port)
-        self.event_thread = threading.Thread(target=self._event_handler)
-        self.event_thread.start()
+        self.clients_sockets = {} # Map from peer's connection to peer's (address, port, chain_len, node_addr)
+        self.peer_list = PeerList() # entries of the registered clients
+        self.chain_heap = ChainHeap() # registered clients by chain length
+        self.client_states = {} # Map from peer's connection to its (tip_hash, mempool_depth, app_connections, peers, stale_at)
+        self.transport = Transport("tracker-transport", TRACKER_QUEUE_SIZE)
+        self.dispatcher = create_dispatcher("tracker")
+        self.server = self.create_server(host, port)
 
     def _log(self, *args):
         if self.log_file:
@@ -43,90 +210,122 @@ class Tracker:
             for arg in args:
                 print(f"{arg}")
 
-    def _event_handler(self):
-        """Handle each client connection in a separate thread."""
-        while self.running.get():
-            ready_to_read, _, _ = select.select(list(self.clients_sockets.keys()) + list(self.connected_sockets.keys()) + [self.server_socket], [], [], 0.1)
-            for sock in ready_to_read:
-                if sock is self.server_socket:
-                    clnt_sock, addr = sock.accept() # step 1
-                    self._log(f"[INFO] Connection from {addr}")
-                    self.connected_sockets[clnt_sock] = addr[0]
-                else:
-                    try:
-                        recv_msg = Message.recv_from(sock)
-                        # Client Registration for its previous connection
-                        if recv_msg.type_char == b'R':
-                            if len(recv_msg.payload) != 8:
-                                raise ValueError("Registration message should has 2 bytes (size of the port number)")
-                            
-                            # form and respond with current peer list
-                            current_peer_list = b''
-                            for peer_addr, peer_port, _, _ in self.clients_sockets.values():
-                                if peer_port == None: # Don't include non-registered clients
-                                    continue
-                                current_peer_list += socket.inet_aton(peer_addr)
-                                current_peer_list += peer_port.to_bytes(2, 'big')
-                            clnt_sock.sendall(Message('L', current_peer_list).pack()) # step 3
-
-                            # register this socket to client list
-                            port_num = int.from_bytes(recv_msg.payload[:2], 'big')
-                            node_addr_bytes = recv_msg.payload[2:]
-                            if sock in self.clients_sockets:
-                                self._log("[WARNING] Multiple registration from registered client")
-                                self.clients_sockets[sock] = (self.clients_sockets[sock][0], port_num, 0, node_addr_bytes)
-                            elif sock in self.connected_sockets:
-                                # move from not-registered pool to clients list
-                                self._log(f"[INFO] Registration from {self.connected_sockets[sock]}")
-                                self.clients_sockets[sock] = (self.connected_sockets[sock], port_num, 0, node_addr_bytes)
-                                del self.connected_sockets[sock]
-                            else:
-                                self._log("[ERROR] Registration from not connected client")
-                        # Client periodical heartbeat
-                        elif recv_msg.type_char == b'H':
-                            clietn_chain_len = int.from_bytes(recv_msg.payload, 'big')
-                            if sock in self.clients_sockets:
-                                self._log(f"[INFO] Heartbeat from {self.clients_sockets[sock][0]}:{self.clients_sockets[sock][1]}")
-                                self.clients_sockets[sock] = (self.clients_sockets[sock][0], self.clients_sockets[sock][1], clietn_chain_len, self.clients_sockets[sock][3])
-                            else:
-                                self._log("[ERROR] Heartbeat from not registered client")
-                        # Respond with the top-k longest chain owner's node addr
-                        elif recv_msg.type_char == b'T':
-                            top_k = int.from_bytes(recv_msg.payload, 'big')
-                            top_k_list = self._get_client_list(top_k)
-                            sock.sendall(Message('S', b''.join(top_k_list)).pack())
-                        
-                    except ConnectionAbortedError:
-                        if sock in self.clients_sockets:
-                            self._log(f"[INFO] Disconnected from {self.clients_sockets[sock][0]}:{self.clients_sockets[sock][1]}")
-                            del self.clients_sockets[sock]
-                        if sock in self.connected_sockets:
-                            self._log(f"[INFO] Disconnected from {self.connected_sockets[sock]}")
-                            del self.connected_sockets[sock]
-                    except ConnectionResetError:
-                        self._log("[WARNING] Connection was reset by the client.")
+    def _accept(self, conn):
+        # on the loop's thread: hand over to the dispatcher, where all of the tracker's state is changed
+        self.dispatcher.submit(self._join, conn)
+
+    def _join(self, conn):
+        self._log(f"[INFO] Connection from {conn.peername}")
+        self.connected_sockets[conn] = conn.peername[0]
+        conn.start(self._recv_handler, self._leave, self.dispatcher)
+
+    def _leave(self, conn):
+        try:
+            self.dispatcher.submit(self._disconnected, conn)
+        except RuntimeError: # the tracker is stopping
+            pass
+
+    def _disconnected(self, conn):
+        if conn in self.clients_sockets:
+            self._log(f"[INFO] Disconnected from {self.clients_sockets[conn][0]}:{self.clients_sockets[conn][1]}")
+            del self.clients_sockets[conn]
+            entry = self.peer_list.remove(conn)
+            self.chain_heap.remove(conn)
+            self.client_states.pop(conn, None)
+            self.transport.broadcast(self.peer_list.keys, Message('V', entry))
+        if conn in self.connected_sockets:
+            self._log(f"[INFO] Disconnected from {self.connected_sockets[conn]}")
+            del self.connected_sockets[conn]
+
+    def _recv_handler(self, conn, recv_msg):
+        # Client Registration for its previous connection
+        if recv_msg.type_char == b'R':
+            if len(recv_msg.payload) != 8:
+                raise ValueError("Registration message should have 8 bytes (p2p port and node address)")
+            port_num = int.from_bytes(recv_msg.payload[:2], 'big')
+            node_addr_bytes = recv_msg.payload[2:]
+            if conn in self.clients_sockets:
+                self._log("[WARNING] Multiple registration from registered client")
+                addr, _, chain_len, _ = self.clients_sockets[conn]
+                entry = self.peer_list.remove(conn)
+                self.chain_heap.remove(conn)
+                self.transport.broadcast(self.peer_list.keys, Message('V', entry))
+            elif conn in self.connected_sockets:
+                # move from not-registered pool to clients list
+                self._log(f"[INFO] Registration from {self.connected_sockets[conn]}")
+                addr, chain_len = self.connected_sockets.pop(conn), 0
+            else:
+                self._log("[ERROR] Registration from not connected client")
+                return
+            # respond with the current peer list, then let the other peers know about the new one
+            peer_list_msg = Message('L', self.peer_list.encode())
+            entry = socket.inet_aton(addr) + port_num.to_bytes(2, 'big')
+            self.transport.broadcast(self.peer_list.keys, Message('J', entry))
+            self.clients_sockets[conn] = (addr, port_num, chain_len, node_addr_bytes)
+            self.peer_list.add(conn, entry)
+            self.chain_heap.push(conn, chain_len)
+            conn.send(peer_list_msg) # step 3
+        # Client periodical heartbeat
+        elif recv_msg.type_char == b'H':
+            client_chain_len, tip_hash, mempool_depth, app_connections, peers, interval = decode_heartbeat(recv_msg.payload)
+            if conn in self.clients_sockets:
+                addr, port_num, _, node_addr_bytes = self.clients_sockets[conn]
+                self._log(f"[INFO] Heartbeat from {addr}:{port_num}")
+                self.clients_sockets[conn] = (addr, port_num, client_chain_len, node_addr_bytes)
+                self.chain_heap.update(conn, client_chain_len)
+                stale_at = time.monotonic() + (STALE_GRACE * interval if interval else DEFAULT_STALE_AFTER)
+                self.client_states[conn] = (tip_hash, mempool_depth, app_connections, peers, stale_at)
+            else:
+                self._log("[ERROR] Heartbeat from not registered client")
+        # Respond with the top-k longest chain owner's node addr
+        elif recv_msg.type_char == b'T':
+            top_k = int.from_bytes(recv_msg.payload, 'big')
+            top_k_list = self._get_client_list(top_k)
+            conn.send(Message('S', b''.join(top_k_list)))
+        # Respond with the p2p address and chain length of the top-k longest chain peers, but the asking one
+        elif recv_msg.type_char == b'O':
+            top_k = int.from_bytes(recv_msg.payload, 'big')
+            top_peers = [peer for peer in self.chain_heap.top(top_k + 1) if peer is not conn][:top_k]
+            conn.send(Message('P', b''.join(self.peer_list.entry(peer) + self.clients_sockets[peer][2].to_bytes(4, 'big') for peer in top_peers)))
 
     def stop(self):
-        self.running.set(False)
-        self.event_thread.join()
-        self.server_socket.close()
-        for clnt_sock in self.clients_sockets:
-            clnt_sock.close()
+        self.transport.close()
+        self.dispatcher.shutdown(wait=True)
         if self.log_file:
             self.log_file.close()
 
-    def _get_client_list(self, top_k=None):
+    def _get_client_list(self, top_k=None, now=None):
+        """
+        node addresses of the top_k clients to route webservers to. The top_k * ROUTE_OVERSAMPLE longest
+        chains are ranked by height first: the nodes at most MAX_ROUTE_LAG blocks behind the longest chain
+        come before the others. Then come the ones whose last heartbeat isn't stale, then the least busy
+        (app connections, then mempool depth), then the longest chains. Among chains of the same length,
+        the ones on the tip most of the longest chains have go first.
+        """
         if top_k == None:
             top_k = len(self.clients_sockets)
-        top_k_list = sorted(self.clients_sockets.values(), key=lambda x: x[2], reverse=True)[:top_k]
+        now = time.monotonic() if now is None else now
+        candidates = self.chain_heap.top(top_k * ROUTE_OVERSAMPLE)
+        if not candidates:
+            return []
+        best_len = self.clients_sockets[candidates[0]][2]
+        tips = [self.client_states[conn][0] for conn in candidates if conn in self.client_states and self.clients_sockets[conn][2] == best_len]
+        best_tip = max(set(tips), key=tips.count) if tips else None
+
+        def rank(conn):
+            chain_len = self.clients_sockets[conn][2]
+            tip_hash, mempool_depth, app_connections, _, stale_at = self.client_states.get(conn, (None, 0, 0, 0, 0))
+            behind = best_len - chain_len > MAX_ROUTE_LAG
+            minority_tip = chain_len == best_len and tip_hash != best_tip
+            return (behind, now > stale_at, app_connections, mempool_depth, -chain_len, minority_tip)
+        # sorting a handful of candidates; the heap already picked them out of all clients
+        top_k_list = [self.clients_sockets[conn] for conn in sorted(candidates, key=rank)[:top_k]]
         return [socket.inet_aton(addr) + node_addr[4:] for addr, _, _, node_addr in top_k_list]
 
-    def create_server_socket(self, host, port):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((host, port))
-        server_socket.listen(32)
+    def create_server(self, host, port):
+        server = self.transport.serve((host, port), self._accept, backlog=TRACKER_BACKLOG)
         self._log(f"Tracker listening on {host}:{port}")
-        return server_socket
+        return server
 
 def run_tracker(args):
     tracker = Tracker(host=args.tracker_addr, port=args.tracker_port)
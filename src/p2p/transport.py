@@ -0,0 +1,259 @@
+# transport.py
+import asyncio
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from ..message import Message
+
+MAX_QUEUE_SIZE = 1024 # default bound of a connection's write queue, in messages
+
+# what a connection does with a message that doesn't fit in its write queue
+OVERFLOW_DROP = 'drop' # discard the message
+OVERFLOW_DISCONNECT = 'disconnect' # close the connection, e.g. a peer that stopped reading
+
+class Connection:
+    """
+    A message stream over one TCP (or socketpair) connection, driven by a Transport's event loop.
+    - send() is thread-safe and never blocks: the message is put on the connection's bounded write
+      queue, and a writer task drains the queue into the socket. A slow peer only fills its own queue;
+      once the queue is full, the overflow policy drops the message or disconnects the peer.
+    - send_wait() is for responses streamed in many messages, which must not be dropped: it waits
+      until the message has been written, so a stream has one message in flight at a time.
+    - incoming messages are handed to on_message(conn, msg) on the dispatcher given to start(),
+      one at a time; the connection stops reading until the handler returns.
+    """
+    def __init__(self, transport, reader, writer, max_queue_size=MAX_QUEUE_SIZE, overflow=OVERFLOW_DROP):
+        self.transport = transport
+        self.reader = reader
+        self.writer = writer
+        self.peername = writer.get_extra_info('peername')
+        self.sockname = writer.get_extra_info('sockname')
+        self.write_queue = asyncio.Queue(max_queue_size)
+        self.overflow = overflow
+        # queue metrics
+        self.max_queue_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.queued = 0 # messages ever put on the write queue
+        self.written = 0 # messages handed to the socket, once there was room for them
+        self.closed = False
+        self._written = asyncio.Event() # set, and replaced, whenever the writer makes progress
+        self._on_close = None
+        self._tasks = [asyncio.ensure_future(self._write_loop())]
+
+    def __repr__(self):
+        return f"<Connection {self.peername}>"
+
+    def start(self, on_message, on_close=None, dispatcher=None):
+        """start reading; dispatcher is an executor shared by the handlers that must not run concurrently"""
+        self._on_close = on_close
+        self.transport.call_soon(self._start, on_message, dispatcher)
+
+    def _start(self, on_message, dispatcher):
+        if self.closed:
+            return
+        self._tasks.append(asyncio.ensure_future(self._read_loop(on_message, dispatcher)))
+
+    def send(self, msg):
+        data = msg.pack() if isinstance(msg, Message) else msg
+        self.transport.call_soon(self._enqueue, data)
+
+    def _enqueue(self, data):
+        if self.closed:
+            return
+        if self.write_queue.full():
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DISCONNECT:
+                print(f"[WARNING] Write queue of {self.peername} is full, disconnecting")
+                self._close()
+            return
+        self.write_queue.put_nowait(data)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.write_queue.qsize())
+
+    def send_wait(self, msg, timeout=None):
+        """send msg and block until it has been written to the socket; raise ConnectionAbortedError if the connection closes first"""
+        data = msg.pack() if isinstance(msg, Message) else msg
+        future = asyncio.run_coroutine_threadsafe(self._send_and_wait(data), self.transport.loop)
+        try:
+            future.result(timeout)
+        # not the builtin TimeoutError before python 3.11
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def _send_and_wait(self, data):
+        if self.closed:
+            raise ConnectionAbortedError("Connection is closed")
+        # wait for room in the queue instead of applying the overflow policy
+        await self.write_queue.put(data)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.write_queue.qsize())
+        target = self.queued
+        while not self.closed and self.written < target:
+            await self._written.wait()
+        if self.written < target:
+            raise ConnectionAbortedError("Connection closed before the message was written")
+
+    def _notify_written(self):
+        self._written.set()
+        self._written = asyncio.Event()
+
+    @property
+    def queue_depth(self):
+        return self.write_queue.qsize()
+
+    def stats(self):
+        return {'peer': self.peername, 'depth': self.queue_depth, 'max_depth': self.max_queue_depth, 'sent': self.sent, 'dropped': self.dropped}
+
+    async def _write_loop(self):
+        try:
+            while True:
+                chunks = [await self.write_queue.get()]
+                # coalesce whatever else was queued meanwhile into one write
+                while not self.write_queue.empty():
+                    chunks.append(self.write_queue.get_nowait())
+                self.writer.writelines(chunks)
+                self.sent += len(chunks)
+                await self.writer.drain()
+                self.written += len(chunks)
+                self._notify_written()
+        except (ConnectionError, OSError):
+            self._close()
+
+    async def _read_loop(self, on_message, dispatcher):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                msg = await Message.read_from(self.reader)
+                await loop.run_in_executor(dispatcher, self._dispatch, on_message, msg)
+        except (ConnectionError, OSError):
+            self._close()
+
+    def _dispatch(self, on_message, msg):
+        try:
+            on_message(self, msg)
+        except Exception as e:
+            print(f"[ERROR] Failed to handle message {msg.type_char} from {self.peername}: {e!r}")
+
+    def close(self):
+        self.transport.call_soon(self._close)
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        current_task = asyncio.current_task()
+        for task in self._tasks:
+            if task is not current_task:
+                task.cancel()
+        self.writer.close()
+        self._notify_written()
+        self.transport.connections.discard(self)
+        if self._on_close:
+            self._on_close(self)
+
+class TaggedConnection:
+    """Where the responses to one tagged (`#`) request go: its connection, tagged with the request's id."""
+    def __init__(self, conn, request_id):
+        self.conn = conn
+        self.request_id = request_id
+        self.peername = conn.peername
+
+    def __repr__(self):
+        return f"<TaggedConnection {self.peername} #{self.request_id}>"
+
+    def send(self, msg):
+        self.conn.send(msg.tag(self.request_id))
+
+    def send_wait(self, msg, timeout=None):
+        self.conn.send_wait(msg.tag(self.request_id), timeout)
+
+class Transport:
+    """
+    Asyncio event loop on a dedicated thread, multiplexing every connection of a node.
+    The loop sleeps until a socket is ready or a message is sent, so an idle node doesn't wake up.
+    Methods other than the Connection callbacks may be called from any thread but the loop's own.
+    """
+    def __init__(self, name="transport", max_queue_size=MAX_QUEUE_SIZE, overflow=OVERFLOW_DROP):
+        self.max_queue_size = max_queue_size
+        self.overflow = overflow
+        self.loop = asyncio.new_event_loop()
+        self.connections = set()
+        self.servers = []
+        self.closed = False
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def call_soon(self, callback, *args):
+        # once the loop is gone, every connection is closed already
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError: # the loop is closed
+            pass
+
+    def _run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def _connection(self, reader, writer):
+        conn = Connection(self, reader, writer, self.max_queue_size, self.overflow)
+        self.connections.add(conn)
+        return conn
+
+    def broadcast(self, conns, msg):
+        """
+        send msg to every connection in conns. The message is packed once, and the caller only
+        schedules a single callback on the loop, so the cost to the caller doesn't grow with the
+        number of peers and never waits on any of them.
+        """
+        data = msg.pack() if isinstance(msg, Message) else msg
+        self.call_soon(self._enqueue_all, list(conns), data)
+
+    def _enqueue_all(self, conns, data):
+        for conn in conns:
+            conn._enqueue(data)
+
+    def queue_stats(self):
+        """write queue metrics of every open connection"""
+        return [conn.stats() for conn in list(self.connections)]
+
+    def serve(self, addr, on_connection, backlog=32):
+        """listen on addr, and call on_connection(conn) (on the loop's thread) for each accepted connection"""
+        async def start_server():
+            return await asyncio.start_server(lambda reader, writer: on_connection(self._connection(reader, writer)), addr[0], addr[1], backlog=backlog)
+        server = self._run(start_server())
+        self.servers.append(server)
+        return server
+
+    def connect(self, addr, timeout=10):
+        async def open_connection():
+            return self._connection(*await asyncio.open_connection(addr[0], addr[1]))
+        return self._run(open_connection(), timeout)
+
+    def wrap(self, sock):
+        """adopt an already connected socket, e.g. one end of a socketpair"""
+        async def open_connection():
+            return self._connection(*await asyncio.open_connection(sock=sock))
+        return self._run(open_connection())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        async def shutdown():
+            for server in self.servers:
+                server.close()
+            tasks = [task for conn in self.connections for task in conn._tasks]
+            for conn in list(self.connections):
+                conn._close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._run(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+def create_dispatcher(name):
+    """a single thread on which message handlers run in arrival order"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
@@ -1,7 +1,9 @@
-from flask import Flask, jsonify, request, make_response, render_template, send_from_directory
+from flask import Flask, Response, jsonify, request, make_response, render_template, send_from_directory
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
 import base64
+import json
+import string
 
 
 from cryptography.hazmat.backends import default_backend
@@ -11,12 +13,15 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.exceptions import InvalidSignature
 
 from src.message import Message
-from src.blockchain import Blockchain
-from src.crypto import sign_data, verify_signature
+from src.blockchain import AUTHOR_LEN, MAX_QUERY_RESULTS, QUERY_AUTHOR, QUERY_TEXT, TX_DONATION, TX_MARKER, Block, PostIndex, decode_results, encode_query, encode_transaction, tokenize
+from src.crypto import verify_signature
 from .socket_manager import SocketManager
+from .keys import KeyManager
+from .chain_cache import ChainCache, stream_chain
+from .live_feed import LiveFeed
 
 app = Flask(__name__, static_folder='../../frontend/build/', static_url_path='')
-CORS(app, resources={r"/*": {"origins": "*"}}, send_wildcard=True, support_credentials=True)
+CORS(app, resources={r"/*": {"origins": "*"}}, send_wildcard=True, support_credentials=True, expose_headers=["ETag", "X-Next-Cursor"])
 
 def _build_cors_preflight_response():
     response = make_response()
@@ -30,6 +35,9 @@ def _corsify_actual_response(response):
     return response
 
 socket_manager = None
+key_manager = None
+chain_cache = None
+live_feed = None
 
 @app.route('/', methods=['GET'])
 def index():
@@ -37,27 +45,122 @@ def index():
 
 """
 curl -X GET http://localhost:5000/chain
+curl -X GET "http://localhost:5000/chain?limit=20&cursor=<X-Next-Cursor of the previous page>"
+curl -X GET http://localhost:5000/chain -H 'If-None-Match: "<ETag of the previous response>"'
 """
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    if not socket_manager.get_socket():
-        return jsonify({"error": "No connection available"}), 400
     try:
-        # Request the chain
-        socket_manager.get_socket().sendall(Message('P', b'').pack())
-        recv_msg = Message.recv_from(socket_manager.get_socket())
-        blockchain = Blockchain.decode(recv_msg.payload)
-        post_list = []
-        for block in blockchain.chain:
-            block_data = block.data.decode()
-            post_list.append({
-                "author": block_data[:64],
-                "content": block_data[64:]
-            })
-        return jsonify(post_list)  # Assuming Blockchain has a to_dict() method
+        # while the live feed is subscribed, the node pushes every change of its tip and the cache is already up to date
+        if live_feed is None or not live_feed.subscribed or chain_cache.tip_hash is None:
+            chain_cache.refresh()
+    except Exception as e:
+        # a copy that is a bit behind is still worth serving
+        if chain_cache.tip_hash is None:
+            return jsonify({"error": str(e)}), 400 if isinstance(e, ConnectionError) else 500
+        print(f"Failed to refresh the chain, serving the cached copy: {e}")
+
+    # pages only change when the tip does
+    etag = chain_cache.tip_hash or "empty"
+    if request.if_none_match.contains(etag):
+        return make_response('', 304)
+    try:
+        limit = request.args.get('limit', type=int)
+        posts, next_cursor = chain_cache.page(request.args.get('cursor'), limit)
+    except KeyError:
+        return jsonify({"error": "cursor is not on the chain"}), 400
+    response = jsonify(posts)
+    response.set_etag(etag)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+"""
+curl -X GET "http://localhost:5000/posts?author=<sha256 of the author's public key>&limit=20"
+curl -X GET "http://localhost:5000/posts?q=hello%20world&before=<X-Next-Cursor of the previous page>"
+"""
+@app.route('/posts', methods=['GET'])
+def query_posts():
+    # posts by one author, or posts containing every word of q, newest first
+    # limit counts blocks: the node answers with whole blocks, and a block may carry a batch of posts
+    if ('author' in request.args) == ('q' in request.args):
+        return jsonify({"error": "Exactly one of author and q is required"}), 400
+    limit = request.args.get('limit', default=20, type=int)
+    before = request.args.get('before', type=int)
+    if limit < 1 or (before is not None and before < 0):
+        return jsonify({"error": "limit must be positive, and before a height"}), 400
+    # the node answers with at most MAX_QUERY_RESULTS blocks, and a full page is what tells there may be more
+    limit = min(limit, MAX_QUERY_RESULTS)
+    if 'author' in request.args:
+        query = encode_query(QUERY_AUTHOR, request.args['author'], limit, before)
+    else:
+        query = encode_query(QUERY_TEXT, request.args['q'], limit, before)
+    try:
+        with socket_manager.connection() as conn:
+            recv_msg = conn.request(Message('Q', query))
+    except ConnectionError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    results = decode_results(recv_msg.payload)
+    words = tokenize(request.args['q']) if 'q' in request.args else None
+    posts = []
+    for height, encoded_block in results:
+        block = Block.decode(encoded_block)
+        # only the posts of a batch that match the query, newest first like the blocks
+        for position, entry in reversed(list(enumerate(block.entries()))):
+            author, post_words = PostIndex.post_terms(entry)
+            matches = author == request.args['author'] if words is None else words <= post_words
+            if not matches:
+                continue
+            post = ChainCache.decode_post(entry, block.hash(), position)
+            post["height"] = height
+            posts.append(post)
+    response = jsonify(posts)
+    # heights are the cursor: the next page holds the posts below the last block
+    if results and len(results) == limit:
+        response.headers['X-Next-Cursor'] = str(results[-1][0])
+    return response
+
+"""
+curl -N http://localhost:5000/chain/live
+Server-sent events, one per change of the chain: {"tip": <hash>, "removed": [<ids of posts a reorg removed>], "posts": [<new posts>]}
+Post ids are the cursors of /chain, see ChainCache.post_id().
+"""
+@app.route('/chain/live', methods=['GET'])
+def live_chain():
+    events = live_feed.listen()
+
+    def generate():
+        for event in events:
+            # a comment keeps idle connections open, and finds out when a browser has gone
+            yield ": keep-alive\n\n" if event is None else f"data: {json.dumps(event)}\n\n"
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+"""
+curl -X GET http://localhost:5000/chain/export
+"""
+@app.route('/chain/export', methods=['GET'])
+def export_chain():
+    # the export streams over its own connection, so it doesn't hold up /chain and /message
+    try:
+        sock = socket_manager.open_socket()
+    except OSError as e:
+        return jsonify({"error": str(e)}), 500
+    if not sock:
+        return jsonify({"error": "No connection available"}), 400
+
+    def generate():
+        # one post per line, written out as the node's chunks arrive
+        try:
+            for block in stream_chain(sock):
+                for post in ChainCache.decode_posts(block, block.hash()):
+                    yield json.dumps(post) + "\n"
+        finally:
+            sock.close()
+    return Response(generate(), mimetype='application/x-ndjson')
+
 """
 curl -X POST http://localhost:5000/message \
 -H "Content-Type: application/json" \
@@ -72,34 +175,94 @@ def post_message():
         if "post_content" not in data:
             return _corsify_actual_response(jsonify({"error": "post_content field is required"})), 400
         post_content = data["post_content"].encode('utf-8')
+        # transactions are only posted through /donate, signed by their sender
+        if post_content.startswith(TX_MARKER):
+            return _corsify_actual_response(jsonify({"error": "transactions must be posted to /donate"})), 400
+        return _submit_post(data, post_content)
 
-        if not socket_manager.get_socket():
-            return _corsify_actual_response(jsonify({"error": "No node connection available"})), 400
-        try:
-            if not "public_key" in data or not "signature" in data: # Sign by default keys pair
-                print("Not both public_key and signature provided, sign the block by default keys pair")
-                with open('public_key.pem', 'rb') as public_key_file:
-                    public_key_data = public_key_file.read()
-                signature = sign_data(post_content, 'private_key.pem')
-            else:
-                public_key_data = data["public_key"].encode()
-                signature = base64.b64decode(data["signature"].encode())
-                if not verify_signature(post_content, signature, public_key_data):
-                    return _corsify_actual_response(jsonify({"status": "invalid signature"})), 400
-
-            public_key_msg = Message('K', public_key_data).pack()
-
-            msg = Message('A', public_key_msg + signature + post_content)
-            socket_manager.get_socket().sendall(msg.pack())
-
-            return _corsify_actual_response(jsonify({"status": "message sent"})), 200
-        except Exception as e:
-            print(e)
-            return _corsify_actual_response(jsonify({"error": str(e)})), 500
+def _submit_post(data, post_content):
+    """sign post_content (or check the signature in data), and send it to a node"""
+    try:
+        if not "public_key" in data or not "signature" in data: # Sign by default keys pair
+            print("Not both public_key and signature provided, sign the block by default keys pair")
+            public_key_data, signature = key_manager.sign(post_content)
+        else:
+            public_key_data = data["public_key"].encode()
+            signature = base64.b64decode(data["signature"].encode())
+            if not verify_signature(post_content, signature, public_key_data):
+                return _corsify_actual_response(jsonify({"status": "invalid signature"})), 400
+
+        public_key_msg = Message('K', public_key_data).pack()
+
+        msg = Message('A', public_key_msg + signature + post_content)
+        with socket_manager.connection() as conn:
+            conn.send(msg)
+
+        return _corsify_actual_response(jsonify({"status": "message sent"})), 200
+    except ConnectionError as e:
+        return _corsify_actual_response(jsonify({"error": str(e)})), 400
+    except Exception as e:
+        print(e)
+        return _corsify_actual_response(jsonify({"error": str(e)})), 500
+
+"""
+curl -X POST http://localhost:5000/donate \
+-H "Content-Type: application/json" \
+-d '{"recipient": "<sha256 of the recipient's public key>", "amount": 10, "reference": "<32 random bytes in hex>", "public_key": "<sender's public key>", "signature": "<base64 signature>"}'
+A donation spends the sender's coins, so it must be signed by the sender: the signature is over the
+transaction, see encode_transaction(). Unlike posts, donations are never signed with the default keys.
+"""
+@app.route('/donate', methods=["POST", "OPTIONS"])
+def donate():
+    if request.method == "OPTIONS": # CORS preflight
+        return _build_cors_preflight_response()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or "recipient" not in data or "amount" not in data:
+        return _corsify_actual_response(jsonify({"error": "recipient and amount fields are required"})), 400
+    recipient = data["recipient"]
+    amount = data["amount"]
+    # the recipient is packed as 64 bytes and the amount as an unsigned 64-bit integer; a bool is an int
+    # to isinstance, but not an amount
+    if not _is_key_hash(recipient) or type(amount) is not int or not 0 < amount < 2 ** 64:
+        return _corsify_actual_response(jsonify({"error": "recipient must be a key hash, and amount a positive integer"})), 400
+    if any(not isinstance(data.get(field), str) for field in ("public_key", "signature", "reference")):
+        return _corsify_actual_response(jsonify({"error": "public_key, signature and reference fields are required"})), 400
+    try:
+        reference = bytes.fromhex(data["reference"])
+    except ValueError:
+        reference = b''
+    if len(reference) != 32:
+        return _corsify_actual_response(jsonify({"error": "reference must be 32 bytes in hex"})), 400
+    return _submit_post(data, encode_transaction(TX_DONATION, recipient, amount, reference))
+
+def _is_key_hash(value):
+    """whether value is the sha256 hex digest of a public key, as accounts are named"""
+    return isinstance(value, str) and len(value) == AUTHOR_LEN and all(c in string.hexdigits for c in value)
+
+"""
+curl -X GET http://localhost:5000/balance/<sha256 of the account's public key>
+"""
+@app.route('/balance/<account>', methods=['GET'])
+def get_balance(account):
+    try:
+        with socket_manager.connection() as conn:
+            recv_msg = conn.request(Message('Y', account.encode('utf-8')))
+    except ConnectionError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "account": account,
+        "balance": int.from_bytes(recv_msg.payload[:8], 'big'),
+        "height": int.from_bytes(recv_msg.payload[8:12], 'big')
+    })
 
 def run_webserver(args):
-    global socket_manager
-    socket_manager = SocketManager((args.tracker_addr, args.tracker_port))
+    global socket_manager, key_manager, chain_cache, live_feed
+    socket_manager = SocketManager((args.tracker_addr, args.tracker_port), args.pool_size, args.connections_per_node)
+    chain_cache = ChainCache(socket_manager.connection)
+    live_feed = LiveFeed(socket_manager, chain_cache)
+    key_manager = KeyManager(signing_processes=args.signing_processes)
     scheduler = BackgroundScheduler()
     scheduler.add_job(func=socket_manager.update_connection, trigger="interval", minutes=args.interval)
     scheduler.start()
@@ -107,3 +270,6 @@ def run_webserver(args):
         app.run(host='0.0.0.0', port=args.server_port, debug=True, use_reloader=False)  # Use reloader=False to not interfere with APScheduler
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+    live_feed.close()
+    key_manager.close()
+    socket_manager.close()
@@ -0,0 +1,162 @@
+import threading
+import time
+
+from src.message import Message
+from src.blockchain import AUTHOR_LEN, BLOCK_POST, BLOCK_TRANSACTION, EXPORT_ABORTED, EXPORT_MORE, ROOT_HASH, Blockchain, decode_transaction, locator_indices
+
+def stream_chain(sock):
+    """
+    generate the blocks of the node's whole chain, oldest first, from an export (`E` -> `X`...).
+    Chunks are read and decoded one at a time as the generator is consumed, so memory doesn't grow
+    with the chain. Nothing else may use sock until the generator is exhausted.
+    """
+    def chunks():
+        sock.sendall(Message('E', b'').pack())
+        while True:
+            recv_msg = Message.recv_from(sock)
+            if recv_msg.type_char != b'X':
+                raise TypeError("Expected chain export from node, got message of type", recv_msg.type_char)
+            flag = recv_msg.payload[:1]
+            if flag == EXPORT_ABORTED:
+                raise RuntimeError("The node's chain was reorganized during the export")
+            yield recv_msg.payload[1:]
+            if flag != EXPORT_MORE:
+                return
+    return Blockchain.iter_decode(chunks())
+
+class ChainCache():
+    """
+    The webserver's own copy of the node's chain, kept as decoded posts. A post is identified by its
+    block's hash and its position in the block, e.g. as the cursor of a page (see post_id).
+    refresh() asks the node for the blocks after the most recent block both copies share (`G` -> `B`,
+    like a peer sync), so an up-to-date copy costs one round trip, and only new blocks are validated
+    and decoded. Pages of posts are then served from memory.
+    After a refresh that changed the copy, on_change(removed, added) is called with the ids of the
+    posts that left the chain and the posts that joined it, e.g. to push them to browsers.
+    Refreshes run one at a time, and wait for the node without holding the lock readers take: each batch
+    of blocks is validated and decoded first, and the lock is only held to swap it in.
+    """
+    def __init__(self, connection, min_interval=1.0):
+        self.connection = connection # returns a context manager that yields a NodeConnection
+        self.min_interval = min_interval # seconds during which a refreshed copy is served as is
+        self.lock = threading.Lock() # guards the copy below; only refreshes change it
+        self.refresh_lock = threading.Lock() # held for a whole refresh
+        self.refreshed_at = None
+        self.validator = Blockchain()
+        self.hashes = [] # block hashes, oldest first
+        self.index = {} # block hash -> position in hashes
+        self.starts = [] # position in posts of each block's first post
+        self.posts = [] # decoded posts of all blocks
+        self.on_change = None
+        self._kept = 0 # during a refresh: number of posts from before it that are still on the chain
+        self._removed = [] # during a refresh: ids of the posts from before it that left the chain
+
+    @property
+    def tip_hash(self):
+        with self.lock:
+            return self.hashes[-1] if self.hashes else None
+
+    def refresh(self, force=False):
+        """sync with the node, unless the copy was refreshed less than min_interval ago and force is False"""
+        with self.refresh_lock:
+            if not force and self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.min_interval:
+                return
+            # the copy only changes during a refresh, so it can be read here without the lock
+            self._kept = len(self.posts)
+            self._removed = []
+            locator = [self.hashes[idx] for idx in locator_indices(len(self.hashes))]
+            with self.connection() as conn:
+                while True:
+                    recv_msg = conn.request(Message('G', b''.join(bytes.fromhex(block_hash) for block_hash in locator)))
+                    if recv_msg.type_char != b'B':
+                        raise TypeError("Expected blocks from node, got message of type", recv_msg.type_char)
+                    blocks = Blockchain.decode_blocks(recv_msg.payload[1:])
+                    self._apply(blocks)
+                    if recv_msg.payload[:1] != b'\x01':
+                        break
+                    locator = [self.hashes[-1]]
+            self.refreshed_at = time.monotonic()
+            added = self.posts[self._kept:]
+            if (self._removed or added) and self.on_change is not None:
+                self.on_change(self._removed, added)
+
+    def _apply(self, blocks):
+        """replace whatever follows the blocks' parent with the blocks; called during a refresh"""
+        if not blocks:
+            return
+        parent = blocks[0].previous_hash
+        fork_point = -1 if parent == ROOT_HASH else self.index.get(parent)
+        if fork_point is None or not self.validator.isValidSubchain(blocks):
+            raise ValueError("Node sent blocks that don't extend the cached chain")
+        block_hashes = [block.hash() for block in blocks]
+        block_posts = [self.decode_posts(block, block_hash) for block, block_hash in zip(blocks, block_hashes)]
+        with self.lock:
+            for block_hash in self.hashes[fork_point + 1:]:
+                del self.index[block_hash]
+            if fork_point + 1 < len(self.hashes):
+                cut = self.starts[fork_point + 1]
+                self._removed.extend(self.post_id(post) for post in self.posts[cut:self._kept])
+                self._kept = min(self._kept, cut)
+                del self.posts[cut:]
+            del self.hashes[fork_point + 1:]
+            del self.starts[fork_point + 1:]
+            for block_hash, posts in zip(block_hashes, block_posts):
+                self.index[block_hash] = len(self.hashes)
+                self.hashes.append(block_hash)
+                self.starts.append(len(self.posts))
+                self.posts.extend(posts)
+
+    @staticmethod
+    def decode_posts(block, block_hash):
+        """the decoded posts a block carries"""
+        return [ChainCache.decode_post(entry, block_hash, position) for position, entry in enumerate(block.entries())]
+
+    @staticmethod
+    def decode_post(entry, block_hash, position=0):
+        transaction = decode_transaction(entry)
+        if transaction is not None:
+            sender, kind, recipient, amount = transaction
+            return {
+                "author": sender,
+                "type": BLOCK_TRANSACTION,
+                "transaction": {"kind": kind.decode(errors='replace'), "recipient": recipient, "amount": amount},
+                "hash": block_hash,
+                "position": position
+            }
+        entry_data = entry.decode(errors='replace')
+        return {
+            "author": entry_data[:AUTHOR_LEN],
+            "type": BLOCK_POST,
+            "content": entry_data[AUTHOR_LEN:],
+            "hash": block_hash,
+            "position": position
+        }
+
+    @staticmethod
+    def post_id(post):
+        """the hash of the post's block, followed by `:position` for any but the first post of a batch"""
+        return post["hash"] if post["position"] == 0 else f"{post['hash']}:{post['position']}"
+
+    def _post_index(self, post_id):
+        """position in posts of the post with the id; KeyError if it isn't on the chain"""
+        block_hash, _, position = post_id.partition(':')
+        idx = self.index[block_hash]
+        end = self.starts[idx + 1] if idx + 1 < len(self.starts) else len(self.posts)
+        if position and not position.isdigit():
+            raise KeyError(post_id)
+        post_idx = self.starts[idx] + int(position or 0)
+        if post_idx >= end:
+            raise KeyError(post_id)
+        return post_idx
+
+    def page(self, cursor=None, limit=None):
+        """
+        return (posts, next_cursor): the `limit` posts right before the post with id `cursor`
+        (the newest posts without a cursor), oldest first, and the cursor of the page before them,
+        or None if there are no older posts. Raise KeyError for a cursor that isn't on the chain.
+        """
+        with self.lock:
+            end = self._post_index(cursor) if cursor is not None else len(self.posts)
+            start = 0 if limit is None else max(0, end - limit)
+            next_cursor = self.post_id(self.posts[start]) if start > 0 else None
+            return self.posts[start:end], next_cursor
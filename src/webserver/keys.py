@@ -0,0 +1,78 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.crypto import load_private_key, sign_with_key
+
+SIGNING_PROCESSES = os.cpu_count() or 1
+KEY_CHECK_INTERVAL = 1.0 # seconds between checks of the key files for changes
+
+# private keys parsed in a signing process: path -> (file version, key)
+_process_keys = {}
+
+def _file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def _sign_in_process(private_key_file, version, data):
+    cached = _process_keys.get(private_key_file)
+    if cached is None or cached[0] != version:
+        with open(private_key_file, 'rb') as key_file:
+            cached = (version, load_private_key(key_file.read()))
+        _process_keys[private_key_file] = cached
+    return sign_with_key(cached[1], data)
+
+class KeyManager():
+    """
+    The webserver's default key pair, used to sign posts that come without a signature.
+    Keys are read and parsed once and kept in memory; they are read again when either file changes
+    on disk, so keys can be rotated without restarting the webserver. The files are checked at most
+    once per check_interval seconds, not on every signature.
+    With signing_processes > 0, RSA signing runs on a process pool (each process keeps its own parsed
+    key), so concurrent requests sign in parallel instead of one after another.
+    """
+    def __init__(self, private_key_file='private_key.pem', public_key_file='public_key.pem', signing_processes=SIGNING_PROCESSES,
+                 check_interval=KEY_CHECK_INTERVAL):
+        self.private_key_file = private_key_file
+        self.public_key_file = public_key_file
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None # when the files were last checked for changes
+        self.private_key = None
+        self.public_key_bytes = None
+        self.executor = None
+        if signing_processes > 0:
+            self.executor = ProcessPoolExecutor(max_workers=signing_processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def _load(self):
+        """return (version, private key, public key bytes), reading the files again if they changed"""
+        now = time.monotonic()
+        with self.lock:
+            if self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return self.version, self.private_key, self.public_key_bytes
+        version = (_file_version(self.private_key_file), _file_version(self.public_key_file))
+        with self.lock:
+            self.checked_at = now
+            if version != self.version:
+                with open(self.private_key_file, 'rb') as key_file:
+                    self.private_key = load_private_key(key_file.read())
+                with open(self.public_key_file, 'rb') as key_file:
+                    self.public_key_bytes = key_file.read()
+                self.version = version
+                print(f"[INFO] Loaded signing keys from {self.private_key_file} and {self.public_key_file}")
+            return self.version, self.private_key, self.public_key_bytes
+
+    def sign(self, data):
+        """return (public key bytes, signature of data) with the current key pair"""
+        version, private_key, public_key_bytes = self._load()
+        if self.executor is None:
+            return public_key_bytes, sign_with_key(private_key, data)
+        signature = self.executor.submit(_sign_in_process, self.private_key_file, version[0], data).result()
+        return public_key_bytes, signature
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
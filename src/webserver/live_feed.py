@@ -0,0 +1,111 @@
+import queue
+import threading
+
+from src.message import Message
+
+RETRY_INTERVAL = 5 # seconds between attempts to subscribe to a node
+KEEPALIVE_INTERVAL = 15 # seconds between keep-alive comments to an idle browser
+MAX_QUEUED_EVENTS = 256 # events waiting to be sent to one browser before it is dropped
+
+class LiveFeed():
+    """
+    Pushes the changes of the chain to browsers, so that they don't poll /chain.
+    The webserver subscribes (`U`) to the tip of a node, which sends a `W` every time its tip changes;
+    the chain cache then syncs only the new blocks, and its changes (the ids of the posts a reorg
+    removed, and the posts that were added) are queued for every browser that listens.
+    If the subscription's connection closes, the pool's node list is updated right away and the
+    feed subscribes to another node.
+    A browser that falls MAX_QUEUED_EVENTS behind is dropped; it reconnects and reloads /chain.
+    """
+    def __init__(self, socket_manager, chain_cache, max_queued=MAX_QUEUED_EVENTS):
+        self.socket_manager = socket_manager
+        self.chain_cache = chain_cache
+        self.chain_cache.on_change = self._publish
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.listeners = set() # queues of the browsers listening
+        self.subscribed = False
+        self.running = True
+        self.wakeup = threading.Event() # the tip changed, or the subscription was lost
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _on_tip(self, response):
+        # runs on the connection's reader thread, so the sync itself happens on the feed's thread
+        if response is None:
+            self.subscribed = False
+        self.wakeup.set()
+
+    def _subscribe(self):
+        self.subscribed = True
+        try:
+            with self.socket_manager.connection() as conn:
+                conn.subscribe(Message('U', b''), self._on_tip)
+        except Exception as e:
+            self.subscribed = False
+            print(f"[WARNING] Failed to subscribe to a node's tip: {e}")
+            self.socket_manager.update_connection()
+
+    def _run(self):
+        while self.running:
+            if not self.subscribed:
+                self._subscribe()
+            self.wakeup.wait(None if self.subscribed else RETRY_INTERVAL)
+            self.wakeup.clear()
+            if not self.running or not self.subscribed:
+                continue
+            try:
+                self.chain_cache.refresh(force=True)
+            except Exception as e:
+                print(f"[WARNING] Failed to sync the chain after a tip change: {e}")
+
+    def _publish(self, removed, added):
+        # called by the chain cache while it holds its lock, so its tip is read directly
+        event = {"tip": self.chain_cache.hashes[-1] if self.chain_cache.hashes else None, "removed": removed, "posts": added}
+        with self.lock:
+            for listener in list(self.listeners):
+                if listener.qsize() >= self.max_queued:
+                    self._drop(listener)
+                else:
+                    listener.put_nowait(event)
+
+    def _drop(self, listener):
+        # each queue has one slot more than max_queued, for the None that ends its generator
+        self.listeners.discard(listener)
+        try:
+            listener.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def listen(self):
+        """
+        return a generator of the changes of the chain from now on, which yields None when nothing
+        happened for KEEPALIVE_INTERVAL seconds, and returns if the listener falls too far behind
+        """
+        listener = queue.Queue(self.max_queued + 1)
+        with self.lock:
+            self.listeners.add(listener)
+        return self._events(listener)
+
+    def _events(self, listener):
+        try:
+            while self.running:
+                try:
+                    event = listener.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield None
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            with self.lock:
+                self.listeners.discard(listener)
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        with self.lock:
+            for listener in list(self.listeners):
+                self._drop(listener)
@@ -1,68 +1,324 @@
+import itertools
+import queue
 import socket
 import threading
+from contextlib import contextmanager
 
-from src.message import Message
+from src.message import Message, REQUEST_ID_SIZE
 
-class SocketManager:
-    def __init__(self, tracker_addr):
-        self.node_socket = None
-        self.tracker_addr = tracker_addr
-        self.current_node_addr = None
+CONNECT_TIMEOUT = 5 # seconds to connect to the tracker or a node
+REQUEST_TIMEOUT = 30 # seconds to wait for the response to a request
+HEALTH_CHECK_INTERVAL = 5 # seconds between health checks of the pool
+PROBE_TIMEOUT = 2 # seconds a node has to answer the probe of a health check
+
+class NodeConnection:
+    """
+    One connection to a node, shared by concurrent requests. Each request is tagged (`#`) with an id,
+    and a reader thread hands every tagged response to the request with the same id, so requests are
+    pipelined on the connection and their responses may come back in any order.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.addr = sock.getpeername()
+        self.send_lock = threading.Lock()
         self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.pending = {} # request id -> callback its responses are passed to, with None once the connection closes
+        self.outstanding = 0 # requests in flight, for routing
+        self.closed = False
+        self.reader_thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader_thread.start()
 
-    def get_socket(self):
-        """Return the node_socket, reconnect if necessary."""
+    @classmethod
+    def connect(cls, addr):
+        sock = socket.create_connection(addr, timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        return cls(sock)
+
+    def _next_request_id(self):
         with self.lock:
-            if self.node_socket is None or self.is_socket_closed():
-                print("Reconnecting due to closed socket or first-time connection.")
-                self.update_connection()
-            return self.node_socket
+            return next(self.request_ids) % (1 << (8 * REQUEST_ID_SIZE))
 
-    def update_connection(self):
-        """Connects to the tracker and updates node_socket based on tracker's response."""
+    def _send(self, msg, request_id):
+        if self.closed:
+            raise ConnectionAbortedError("Connection to the node is closed")
+        data = msg.tag(request_id).pack()
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def send(self, msg):
+        """send a request that has no response, e.g. a post (`A`)"""
+        self._send(msg, self._next_request_id())
+
+    def request(self, msg, timeout=REQUEST_TIMEOUT):
+        """send a request and return its response"""
+        request_id = self._next_request_id()
+        responses = queue.Queue()
+        with self.lock:
+            self.pending[request_id] = responses.put
+        try:
+            self._send(msg, request_id)
+            response = responses.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No response from {self.addr} to request {request_id}")
+        finally:
+            with self.lock:
+                self.pending.pop(request_id, None)
+        if response is None:
+            raise ConnectionAbortedError("Connection to the node closed before the response arrived")
+        return response
+
+    def subscribe(self, msg, on_response):
+        """
+        send a request that is answered any number of times, e.g. a subscription to the tip (`U`).
+        on_response(response) runs on the reader thread, so it must not wait for another response;
+        it is called with None once the connection closes.
+        """
+        request_id = self._next_request_id()
+        with self.lock:
+            self.pending[request_id] = on_response
         try:
-            if self.node_socket:
-                self.node_socket.close()
-                self.node_socket = None
-
-            tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            tracker_socket.settimeout(5)  # Timeout for connecting to the tracker
-            tracker_socket.connect(self.tracker_addr)
-            tracker_socket.sendall(Message('T', (1).to_bytes(4, 'big')).pack())
+            self._send(msg, request_id)
+        except Exception:
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise
+
+    def _read_loop(self):
+        try:
+            while True:
+                recv_msg = Message.recv_from(self.sock)
+                if recv_msg.type_char != b'#':
+                    print(f"[WARNING] Ignoring untagged message {recv_msg.type_char} from {self.addr}")
+                    continue
+                request_id, response = Message.untag(recv_msg.payload)
+                with self.lock:
+                    on_response = self.pending.get(request_id)
+                # the response to a request that timed out is dropped
+                if on_response is not None:
+                    on_response(response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            with self.lock:
+                callbacks = list(self.pending.values())
+            for on_response in callbacks:
+                on_response(None)
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR) # wakes up the reader
+        except OSError:
+            pass
+        self.sock.close()
+
+class SocketManager:
+    """
+    A pool of connections from the webserver to the tracker's top-k longest-chain nodes.
+    Connections are shared: requests are multiplexed on them (see NodeConnection), so concurrent
+    requests don't wait for each other. A request goes to the node with the fewest requests in flight,
+    and to that node's connection with the fewest requests in flight.
+    A background thread replaces connections that closed, keeping connections_per_node connections
+    to each node, and probes each node with a cheap request; a node that can't be reached, or doesn't
+    answer its probe within probe_timeout, is dropped until the next update_connection() brings it back.
+    """
+    def __init__(self, tracker_addr, pool_size=3, connections_per_node=2, health_check_interval=HEALTH_CHECK_INTERVAL, probe_timeout=PROBE_TIMEOUT):
+        self.tracker_addr = tracker_addr
+        self.pool_size = pool_size # number of nodes to spread requests over
+        self.connections_per_node = connections_per_node
+        self.health_check_interval = health_check_interval
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.nodes = [] # addresses of the nodes requests go to, longest chain first
+        self.conns = {} # node addr -> open NodeConnections
+        self.outstanding = {} # node addr -> number of requests in flight
+        self.connecting = {} # node addr -> number of connections being opened
+        self.running = True
+        self.wakeup = threading.Event() # cuts the wait for the next health check short
+        self.health_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self.health_thread.start()
+
+    def _request_top_nodes(self):
+        """ask the tracker for the addresses of the pool_size nodes with the longest chains"""
+        tracker_socket = socket.create_connection(self.tracker_addr, timeout=CONNECT_TIMEOUT)
+        try:
+            tracker_socket.sendall(Message('T', self.pool_size.to_bytes(4, 'big')).pack())
             recv_msg = Message.recv_from(tracker_socket)
+        finally:
             tracker_socket.close()
+        if recv_msg.type_char != b'S':
+            raise TypeError("Expected node list from tracker, got message of type", recv_msg.type_char)
+        payload = recv_msg.payload
+        return [(socket.inet_ntoa(payload[i:i + 4]), int.from_bytes(payload[i + 4:i + 6], 'big')) for i in range(0, len(payload) - 5, 6)]
 
-            if recv_msg.type_char == b'S':
-                addr = socket.inet_ntoa(recv_msg.payload[:4])
-                port_num = int.from_bytes(recv_msg.payload[4:6], 'big')
-                self.current_node_addr = (addr, port_num)
-                print(f"[INFO] Trying to connect to node at {self.current_node_addr}")
-
-                self.node_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.node_socket.connect(self.current_node_addr)
-                print(f"[INFO] Node connection changed to {self.current_node_addr}")
+    def update_connection(self):
+        """Ask the tracker for the current top-k nodes; connections to nodes that left the top-k are closed once idle."""
+        try:
+            nodes = self._request_top_nodes()
         except Exception as e:
             print(f"Failed to update connection: {e}")
+            return
+        with self.lock:
+            for node in self.nodes:
+                if node not in nodes:
+                    print(f"[INFO] Node {node} left the top {self.pool_size}, closing its connections once idle")
+            for node in nodes:
+                if node not in self.nodes:
+                    print(f"[INFO] Adding node at {node} to the connection pool")
+                    self.conns.setdefault(node, [])
+                    self.outstanding.setdefault(node, 0)
+                    self.connecting.setdefault(node, 0)
+            self.nodes = nodes
+        self.wakeup.set()
 
-    def is_socket_closed(self):
-        """Check if the socket is closed by trying to read without blocking."""
-        if not self.node_socket:
-            return True
+    def _drop_node(self, node):
+        """stop routing to a node, e.g. one that refuses connections"""
+        if node in self.nodes:
+            print(f"[WARNING] Dropping node at {node} from the connection pool")
+            self.nodes = [addr for addr in self.nodes if addr != node]
+
+    def _acquire(self):
+        if not self.nodes:
+            self.update_connection()
+        with self.lock:
+            if not self.nodes:
+                raise ConnectionError("No node connection available")
+            node = min(self.nodes, key=lambda node: self.outstanding[node])
+            open_conns = [conn for conn in self.conns[node] if not conn.closed]
+            conn = min(open_conns, key=lambda conn: conn.outstanding) if open_conns else None
+            self.outstanding[node] += 1
+            if conn is not None:
+                conn.outstanding += 1
+            else:
+                self.connecting[node] += 1
+        if conn is None:
+            # the health check keeps connections open, so this only happens to a node that was just added
+            try:
+                conn = NodeConnection.connect(node)
+            except OSError:
+                with self.lock:
+                    self.connecting[node] -= 1
+                    self.outstanding[node] -= 1
+                    self._drop_node(node)
+                raise
+            with self.lock:
+                self.connecting[node] -= 1
+                self.conns[node].append(conn)
+                conn.outstanding += 1
+        return node, conn
+
+    def _release(self, node, conn):
+        with self.lock:
+            self.outstanding[node] -= 1
+            conn.outstanding -= 1
+        if conn.closed:
+            self.wakeup.set() # replace it in the background
+
+    @contextmanager
+    def connection(self):
+        """
+        with socket_manager.connection() as conn: response = conn.request(msg)
+        A NodeConnection to the least busy node.
+        """
+        node, conn = self._acquire()
         try:
-            self.node_socket.setblocking(0)
-            data = self.node_socket.recv(16, socket.MSG_DONTWAIT | socket.MSG_PEEK)
-            if len(data) == 0:
-                return True
-        except BlockingIOError:
-            return False  # No data available
-        except ConnectionResetError:
-            return True  # Socket was closed by the other end
+            yield conn
         finally:
-            self.node_socket.setblocking(1)  # Reset socket to blocking mode
-        return False
-
-    def close_socket(self):
-        """Close the current socket."""
-        if self.node_socket:
-            self.node_socket.close()
-            self.node_socket = None
+            self._release(node, conn)
+
+    def open_socket(self):
+        """Return a new socket, outside the pool, to the least busy node, for requests that keep the connection busy for long, e.g. an export."""
+        if not self.nodes:
+            self.update_connection()
+        with self.lock:
+            if not self.nodes:
+                return None
+            node = min(self.nodes, key=lambda node: self.outstanding[node])
+        sock = socket.create_connection(node, timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        return sock
+
+    def stats(self):
+        """per node: requests in flight and open connections"""
+        with self.lock:
+            return {node: {'outstanding': self.outstanding[node], 'open': len(self.conns[node])} for node in self.nodes}
+
+    def _probe(self, conn):
+        """whether the node answers a balance request (`Y`) for no account, i.e. its height, within probe_timeout"""
+        try:
+            conn.request(Message('Y', b''), self.probe_timeout)
+            return True
+        except (OSError, TimeoutError):
+            return False
+
+    def health_check(self):
+        """
+        forget connections that closed, close idle connections to nodes that left the pool, probe one
+        open connection of each node and drop the nodes that don't answer, then open connections up to
+        connections_per_node per node
+        """
+        with self.lock:
+            for node, conns in self.conns.items():
+                alive = []
+                for conn in conns:
+                    if conn.closed:
+                        print(f"[INFO] Connection to {node} was closed, replacing it")
+                    elif node not in self.nodes and conn.outstanding == 0:
+                        conn.close()
+                    else:
+                        alive.append(conn)
+                self.conns[node] = alive
+            probes = [(node, self.conns[node][0]) for node in self.nodes if self.conns[node]]
+        # an open connection may still lead to a node that hangs, so only an answer tells it is healthy
+        for node, conn in probes:
+            if self._probe(conn):
+                continue
+            print(f"[WARNING] Node at {node} didn't answer its health check")
+            with self.lock:
+                self._drop_node(node)
+                conns = self.conns[node]
+                self.conns[node] = []
+            for conn in conns:
+                conn.close()
+        with self.lock:
+            missing = [node for node in self.nodes for _ in range(self.connections_per_node - len(self.conns[node]) - self.connecting[node])]
+            for node in missing:
+                self.connecting[node] += 1
+        for node in missing:
+            conn = None
+            if node in self.nodes: # otherwise dropped after a failed connection attempt
+                try:
+                    conn = NodeConnection.connect(node)
+                except OSError as e:
+                    print(f"[WARNING] Failed to connect to node at {node}: {e}")
+            with self.lock:
+                self.connecting[node] -= 1
+                if conn is not None:
+                    self.conns[node].append(conn)
+                else:
+                    self._drop_node(node)
+
+    def _health_check_loop(self):
+        while self.running:
+            self.wakeup.wait(self.health_check_interval)
+            self.wakeup.clear()
+            if not self.running:
+                return
+            try:
+                self.health_check()
+            except Exception as e:
+                print(f"[ERROR] Health check of node connections failed: {e!r}")
+
+    def close(self):
+        """Close every connection of the pool."""
+        self.running = False
+        self.wakeup.set()
+        self.health_thread.join()
+        with self.lock:
+            for conns in self.conns.values():
+                for conn in conns:
+                    conn.close()
+            self.conns = {node: [] for node in self.conns}
+            self.nodes = []
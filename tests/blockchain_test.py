@@ -0,0 +1,317 @@
+import pytest
+import struct
+import sys
+import os
+from hashlib import sha256
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.blockchain import INDEX_FORMAT, Blockchain, Block, BlockStore, load_blockchain
+from src.blockchain import BLOCK_REWARD, COINBASE, TX_DONATION, TX_REWARD, Ledger, PostIndex, decode_batch, difficulty_target, encode_batch, encode_transaction, entry_hash, find_nonce, hash, merkle_root
+from src.crypto import SIGNATURE_LEN
+
+def build_chain(database):
+    bc = Blockchain()
+    for data in database:
+        bc.add(bc.mine(Block(data=data)))
+    return bc
+
+def test_block_hash_invalidated_on_mutation():
+    block = Block(data=b"hello")
+    original_hash = block.hash()
+    assert block.hash() == original_hash
+    block.nonce += 1
+    assert block.hash() != original_hash
+    block.nonce -= 1
+    assert block.hash() == original_hash
+    block.data = b"goodbye"
+    assert block.hash() != original_hash
+
+def test_binary_header_layout():
+    block = Block(previous_hash="ab" * 32, data=b"hello", nonce=0x01020304)
+    # previous hash | Merkle root (the sha256 of a single post) | big-endian nonce
+    assert block.header() == bytes.fromhex("ab" * 32) + sha256(b"hello").digest() + b"\x01\x02\x03\x04"
+    assert block.header().hex() == ("ab" * 32 + "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824" + "01020304")
+    assert block.hash() == sha256(block.header()).hexdigest()
+    assert block.hash() == "15d7fc0b13b58af07a4dba417dbd88fe8465d746657c9b288c2cb1137dd2144a"
+
+def test_difficulty_target():
+    assert difficulty_target(4) == bytes.fromhex("0001" + "00" * 30)
+    assert bytes.fromhex("0000" + "ff" * 30) < difficulty_target(4)
+    assert not bytes.fromhex("0001" + "00" * 30) < difficulty_target(4)
+    assert not bytes.fromhex("0000" + "ff" * 30) < difficulty_target(5)
+    # every digest meets difficulty 0
+    assert b"\xff" * 32 < difficulty_target(0)
+
+def test_find_nonce_matches_full_header_hash():
+    block = Block(previous_hash="ab" * 32, data=b"hello")
+    prefix, target = block.header_prefix(), difficulty_target(2)
+    nonce, tried = find_nonce(prefix, target)
+    assert (nonce, tried) == (37, 38)
+    # the midstate search finds the first nonce whose full header hashes below the target
+    block.nonce = nonce
+    assert sha256(block.header()).digest() < target
+    assert block.hash().startswith("00")
+    for other in range(nonce):
+        block.nonce = other
+        assert not sha256(block.header()).digest() < target
+    # a range without a valid nonce
+    assert find_nonce(prefix, target, 0, nonce) == (None, nonce)
+    assert find_nonce(prefix, target, nonce, 1) == (nonce, 1)
+
+def test_tip_follows_chain():
+    bc = build_chain([b"hello", b"goodbye", b"test"])
+    assert bc.height == 3
+    assert bc.tip_hash == bc.chain[-1].hash()
+
+    # a fork that is longer than the local subchain replaces it, and moves the tip
+    fork = Blockchain()
+    for block in bc.chain[:1]:
+        fork.add(block)
+    for data in [b"changed", b"changed again", b"longer than the other chain"]:
+        fork.add(fork.mine(Block(data=data)))
+    fork_point, discarded_blocks = bc.mergeChain(fork.chain)
+    assert fork_point == 0
+    assert len(discarded_blocks) == 2
+    assert bc.height == 4
+    assert bc.tip_hash == fork.tip_hash
+    assert bc.isValid()
+
+def test_merge_reports_the_fork_point():
+    bc = build_chain([b"hello", b"goodbye"])
+    # a longer chain that shares no block replaces the whole local chain: a merge at fork point -1
+    other = build_chain([b"other", b"chain", b"longer"])
+    fork_point, discarded_blocks = bc.mergeChain(other.chain)
+    assert fork_point == -1
+    assert [block.data for block in discarded_blocks] == [b"hello", b"goodbye"]
+    assert bc.tip_hash == other.tip_hash
+    # nothing is merged from a shorter chain
+    assert bc.mergeChain(build_chain([b"short"]).chain) == (None, [])
+    assert bc.tip_hash == other.tip_hash
+
+def test_equal_length_forks_pick_lower_tip():
+    base = build_chain([b"hello"])
+    forks = []
+    for data in [b"fork a", b"fork b"]:
+        fork = Blockchain()
+        fork.add(base.chain[0])
+        fork.add(fork.mine(Block(data=data)))
+        forks.append(fork)
+    lower, higher = sorted(forks, key=lambda fork: fork.tip_hash)
+    assert higher.isPreferredFork(0, 1, lower.tip_hash) and not lower.isPreferredFork(0, 1, higher.tip_hash)
+    # a longer fork wins whatever its tip
+    assert lower.isPreferredFork(0, 2, "f" * 64) and not lower.isPreferredFork(-1, 1, "0" * 64)
+    # whichever fork a node saw first, both end up on the one with the lower tip hash
+    assert higher.mergeChain(lower.chain[1:])[0] == 0
+    assert lower.mergeChain(higher.chain[1:])[0] is None
+    assert higher.tip_hash == lower.tip_hash
+
+def test_encode_decode_round_trip():
+    bc = build_chain([b"hello", b"goodbye", b"test"])
+    encoded = bc.encode()
+    decoded = Blockchain.decode(encoded)
+    assert decoded.encode() == encoded
+    assert decoded.tip_hash == bc.tip_hash
+    assert decoded.block_table == bc.block_table
+    assert decoded.block_hash_pool == bc.block_hash_pool
+    assert bc.encode(1, 2) == bc.chain[1].encode()
+
+    with pytest.raises(RuntimeError):
+        Blockchain.decode(encoded[:-1])
+    # a chain whose blocks don't link is rejected as a whole
+    with pytest.raises(RuntimeError):
+        Blockchain.decode(bc.chain[0].encode() + bc.chain[2].encode())
+
+def test_block_store_survives_restart(tmp_path):
+    bc = load_blockchain(tmp_path)
+    for data in [b"hello", b"goodbye", b"test"]:
+        bc.add(bc.mine(Block(data=data)))
+    memory_bc = build_chain([b"hello", b"goodbye", b"test"])
+    assert bc.encode() == memory_bc.encode()
+    bc.close()
+    # each index record ends with the Merkle root of the block's posts
+    index_bytes = (tmp_path / 'blocks.idx').read_bytes()
+    assert [record[-1] for record in struct.iter_unpack(INDEX_FORMAT, index_bytes)] == [merkle_root(block.entries()) for block in memory_bc.chain]
+
+    # simulate a crash in the middle of appending a block
+    with open(tmp_path / 'blocks.dat', 'ab') as log_file:
+        log_file.write(b'\x00' * 10)
+
+    # the lookup tables, the post index and the ledger come back without decoding the blocks below the tip
+    read_block = BlockStore.read_block
+    decoded = []
+    BlockStore.read_block = lambda store, idx: decoded.append(idx) or read_block(store, idx)
+    try:
+        reopened_bc = load_blockchain(tmp_path)
+    finally:
+        BlockStore.read_block = read_block
+    assert decoded == [2]
+    assert reopened_bc.height == 3
+    assert reopened_bc.tip_hash == memory_bc.tip_hash
+    assert reopened_bc.block_table == {block.hash(): i for i, block in enumerate(memory_bc.chain)}
+    assert reopened_bc.block_hash_pool == memory_bc.block_hash_pool
+    assert reopened_bc.post_index.tokens == memory_bc.post_index.tokens
+    assert reopened_bc.ledger.state() == memory_bc.ledger.state()
+    assert reopened_bc.encode() == memory_bc.encode()
+    assert reopened_bc.isValid()
+
+    # a reorg rewrites the tail of the store
+    fork = Blockchain()
+    fork.add(memory_bc.chain[0])
+    for data in [b"changed", b"changed again", b"longer than the other chain"]:
+        fork.add(fork.mine(Block(data=data)))
+    fork_point, _ = reopened_bc.mergeChain(fork.chain)
+    assert fork_point == 0
+    reopened_bc.close()
+    fork_bc = load_blockchain(tmp_path)
+    assert fork_bc.encode() == fork.encode()
+    assert fork_bc.block_hash_pool == fork.block_hash_pool
+    assert fork_bc.post_index.tokens == fork.post_index.tokens
+
+    # after a crash the saved state is behind the store, so the post index and the ledger are rebuilt
+    fork.add(fork.mine(Block(data=b"after the crash")))
+    fork_bc.add(fork.chain[-1])
+    fork_bc.chain.store.close()
+    (tmp_path / 'posts.idx').write_bytes((tmp_path / 'posts.idx').read_bytes()[:-1])
+    crashed_bc = load_blockchain(tmp_path)
+    assert crashed_bc.encode() == fork.encode()
+    assert crashed_bc.block_hash_pool == fork.block_hash_pool
+    assert crashed_bc.post_index.tokens == fork.post_index.tokens
+    assert crashed_bc.ledger.state() == fork.ledger.state()
+    crashed_bc.close()
+
+def test_post_index_follows_reorgs():
+    alice, bob = "a" * 64, "b" * 64
+    bc = build_chain([(alice + "Hello world").encode(), (bob + "hello again").encode(), (alice + "Goodbye, world").encode()])
+    assert bc.post_index.by_author(alice, 10) == [2, 0]
+    assert bc.post_index.by_author(alice, 1, before=2) == [0]
+    assert bc.post_index.search("hello", 10) == [1, 0]
+    assert bc.post_index.search("WORLD hello", 10) == [0]
+    assert bc.post_index.search("nothing", 10) == []
+
+    # the discarded blocks are rolled back, and the fork's blocks are indexed
+    fork = Blockchain()
+    fork.add(bc.chain[0])
+    for data in [bob + "a new world", bob + "world peace", bob + "the end"]:
+        fork.add(fork.mine(Block(data=data.encode())))
+    bc.mergeChain(fork.chain)
+    assert bc.post_index.by_author(alice, 10) == [0]
+    assert bc.post_index.by_author(bob, 10) == [3, 2, 1]
+    assert bc.post_index.search("world", 10) == [2, 1, 0]
+    assert "goodbye" not in bc.post_index.tokens
+    bc.remove(bc.chain[-1])
+    assert "end" not in bc.post_index.tokens
+
+    decoded = Blockchain.decode(bc.encode())
+    assert decoded.post_index.authors == bc.post_index.authors
+    assert decoded.post_index.tokens == bc.post_index.tokens
+
+def test_ledger_follows_reorgs():
+    alice, bob = hash(b"alice"), hash(b"bob")
+    keys = {alice: b"alice", bob: b"bob"}
+    def reward(recipient, reference):
+        return COINBASE.encode() + encode_transaction(TX_REWARD, recipient, BLOCK_REWARD, reference)
+    def donation(sender, recipient, amount, reference):
+        # the ledger only needs a donation to carry its sender's key; nodes check the signature before they take its block
+        return sender.encode() + encode_transaction(TX_DONATION, recipient, amount, reference) + b"s" * SIGNATURE_LEN + keys[sender]
+
+    bc = Blockchain()
+    # snapshots every 2 blocks, so that reorgs go below the latest snapshot
+    bc.ledger = Ledger(snapshot_interval=2, max_snapshots=2)
+    for data in [reward(alice, b"1" * 32), (alice + "hello").encode(), donation(alice, bob, 20, b"2" * 32),
+                 donation(bob, alice, 100, b"3" * 32), reward(alice, b"4" * 32)]:
+        bc.add(bc.mine(Block(data=data)))
+    # the donation bob can't cover moves nothing
+    assert bc.ledger.balance(alice) == 2 * BLOCK_REWARD - 20
+    assert bc.ledger.balance(bob) == 20
+    assert bc.ledger.can_donate(bob, 20) and not bc.ledger.can_donate(bob, 21)
+    assert bc.post_index.by_author(alice, 10) == [2, 1]
+
+    # a fork from the first block discards the donation, and rolls back past two snapshots
+    fork = Blockchain()
+    fork.add(bc.chain[0])
+    for data in [donation(alice, bob, 50, b"5" * 32), (bob + "world").encode(), (bob + "longer").encode(), (bob + "than it").encode(), (bob + "was").encode()]:
+        fork.add(fork.mine(Block(data=data)))
+    assert bc.mergeChain(fork.chain)[0] == 0
+    assert bc.ledger.balances == {alice: 0, bob: BLOCK_REWARD}
+    # a donation with a key that isn't the sender's moves nothing
+    forged = bc.mine(Block(data=bob.encode() + encode_transaction(TX_DONATION, alice, 10, b"6" * 32) + b"s" * SIGNATURE_LEN + keys[alice]))
+    bc.add(forged)
+    assert bc.ledger.balances == {alice: 0, bob: BLOCK_REWARD}
+    assert bc.ledger.height == bc.height
+    rebuilt = Blockchain.decode(bc.encode()).ledger
+    assert rebuilt.balances == bc.ledger.balances
+
+    bc.remove(bc.chain[-1])
+    assert bc.ledger.height == bc.height
+
+def test_remove_keeps_the_index_and_ledger_in_step():
+    alice = hash(b"alice")
+    def reward(reference):
+        return COINBASE.encode() + encode_transaction(TX_REWARD, alice, BLOCK_REWARD, reference)
+    bc = build_chain([reward(b"1" * 32), (alice + "hello").encode(), reward(b"2" * 32), (alice + "world").encode()])
+    removed = bc.chain[1]
+    bc.remove(removed)
+    assert [block.data for block in bc.chain] == [reward(b"1" * 32), reward(b"2" * 32), (alice + "world").encode()]
+    assert bc.block_table == {block.hash(): i for i, block in enumerate(bc.chain)}
+    assert entry_hash(removed.data) not in bc.block_hash_pool
+    # the same as indexing the remaining blocks from scratch
+    post_index, ledger = PostIndex(), Ledger()
+    for i, block in enumerate(bc.chain):
+        post_index.add(i, block)
+        ledger.apply(i, block)
+    assert bc.post_index.state() == post_index.state()
+    assert bc.ledger.height == bc.height
+    assert bc.ledger.balances == ledger.balances == {alice: 2 * BLOCK_REWARD}
+
+def test_batch_blocks():
+    alice, bob = hash(b"alice"), "b" * 64
+    reward = COINBASE.encode() + encode_transaction(TX_REWARD, alice, BLOCK_REWARD, b"1" * 32)
+    donation = alice.encode() + encode_transaction(TX_DONATION, bob, 30, b"2" * 32) + b"s" * SIGNATURE_LEN + b"alice"
+    entries = [reward, donation, (bob + "hello world").encode()]
+    assert decode_batch(encode_batch(entries)) == entries
+    assert encode_batch(entries[:1]) == reward
+
+    bc = build_chain([(alice + "first").encode()])
+    block = bc.mine(Block(data=encode_batch(entries)))
+    bc.add(block)
+    assert bc.isValid()
+    # the header commits to the posts through their Merkle root, which is the data hash of a single post
+    assert block.header_prefix()[32:] == merkle_root(entries)
+    assert bc.chain[0].header_prefix()[32:] == sha256(bc.chain[0].data).digest()
+    assert all(entry_hash(entry) in bc.block_hash_pool for entry in entries)
+    # the posts of a batch are applied in order, so the donation spends the reward before it
+    assert bc.ledger.balance(bob) == 30
+    assert bc.post_index.by_author(alice, 10) == [1, 0]
+    assert bc.post_index.search("hello", 10) == [1]
+
+    bc.remove(block)
+    assert bc.ledger.balances == {}
+    assert not any(entry_hash(entry) in bc.block_hash_pool for entry in entries)
+    assert bc.post_index.by_author(alice, 10) == [0]
+
+def test_misplaced_rewards_are_rejected():
+    alice, bob = "a" * 64, "b" * 64
+    def reward(reference, amount=BLOCK_REWARD):
+        return COINBASE.encode() + encode_transaction(TX_REWARD, alice, amount, reference)
+    post = (bob + "hello").encode()
+    bc = build_chain([post])
+    for entries in [[reward(b"1" * 32), reward(b"2" * 32)], [post, reward(b"1" * 32)], [reward(b"1" * 32, BLOCK_REWARD + 1)]]:
+        block = bc.mine(Block(data=encode_batch(entries)))
+        bc.add(block)
+        assert bc.height == 1
+        # nor is a longer fork with such a block merged
+        fork = Blockchain()
+        fork.add(bc.chain[0])
+        fork.chain.append(block)
+        fork._update_tip()
+        fork.chain.append(fork.mine(Block(data=post)))
+        assert bc.mergeChain(fork.chain) == (None, [])
+        assert not bc.isValidSubchain(fork.chain)
+
+    block = bc.mine(Block(data=encode_batch([reward(b"1" * 32), post])))
+    bc.add(block)
+    assert bc.height == 2 and bc.ledger.balance(alice) == BLOCK_REWARD
+
+if __name__ == '__main__':
+    test_tip_follows_chain()
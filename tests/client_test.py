@@ -9,6 +9,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src import Node
 from src.p2p import Tracker
+from src.p2p.tracker import decode_heartbeat
 from src.crypto import sign_data
 from src.message import Message
 
@@ -30,14 +31,48 @@ def test_node_sockets():
         node.stop()
     tracker.stop()
 
-def test_heartbeat_chain_length():
+def test_bounded_peer_set():
+    base_port = random.randint(49152, 65000)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    num_of_nodes = 10
+    target_outbound, max_inbound = 2, 3
+    nodes = []
+    for i in range(num_of_nodes):
+        nodes.append(Node(
+            log_filepath=f"node_{i}",
+            p2p_addr=('127.0.0.1', base_port + i + 1),
+            tracker_addr=('127.0.0.1', base_port),
+            heartbeat_interval=1,
+            target_outbound=target_outbound,
+            max_inbound=max_inbound))
+    time.sleep(num_of_nodes)
+    for node in nodes:
+        assert node.peer_manager.num_outbound() <= target_outbound
+        assert node.peer_manager.num_inbound() <= max_inbound
+        assert 0 < node._get_num_peers() <= target_outbound + max_inbound
+    # the nodes still form one network
+    reached = {base_port + 1}
+    frontier = [nodes[0]]
+    while frontier:
+        node = frontier.pop()
+        for _, port in list(node.peer_manager.addrs):
+            if port not in reached:
+                reached.add(port)
+                frontier.append(nodes[port - base_port - 1])
+    assert len(reached) == num_of_nodes
+    for node in nodes:
+        node.stop()
+    tracker.stop()
+
+def test_heartbeat_chain_length(key_files):
+    private_key_file, public_key_file = key_files
     base_port = random.randint(49152, 65000)
     tracker = Tracker('127.0.0.1', base_port, 'tracker')
     num_of_nodes = 7
     nodes = []
     node_ports = set()
-    with open('public_key.pem', 'rb') as public_key_file:
-        public_key_bytes = public_key_file.read()
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
     chain1_new = [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5", b"chain1_6", b"chain1_7", b"chain1_8", b"chain1_9", b"chain1_10"]
     for i in range(num_of_nodes):
         node_ports.add(base_port + 2 * i + 2)
@@ -50,7 +85,7 @@ def test_heartbeat_chain_length():
         # add some new blocks in peer1's chain
         database = chain1_new[:i]
         for data in database:
-            signature = sign_data(data, 'private_key.pem')
+            signature = sign_data(data, private_key_file)
             nodes[i]._new_pending_block(signature=signature, public_key_bytes=public_key_bytes, data=data)
 
     # time.sleep(2)
@@ -80,5 +115,59 @@ def test_heartbeat_chain_length():
         node.stop()
     tracker.stop()
 
+def test_heartbeat_on_tip_change(key_files):
+    private_key_file, public_key_file = key_files
+    base_port = random.randint(49152, 65000)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    # a heartbeat interval far longer than the test: only a change of tip can update the tracker in time
+    node = Node(
+        log_filepath="node_0",
+        p2p_addr=('127.0.0.1', base_port + 1),
+        node_addr=('127.0.0.1', base_port + 2),
+        tracker_addr=('127.0.0.1', base_port),
+        heartbeat_interval=60)
+    time.sleep(1)
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
+    data = b"heartbeat"
+    node._new_pending_block(signature=sign_data(data, private_key_file), public_key_bytes=public_key_bytes, data=data)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline and node.bc.height < 1:
+        time.sleep(0.1)
+    time.sleep(1)
+    (conn, (_, _, chain_len, _)), = tracker.clients_sockets.items()
+    assert chain_len == 1
+    tip_hash, mempool_depth, app_connections, peers, _ = tracker.client_states[conn]
+    assert tip_hash == node.bc.tip_hash
+    assert (mempool_depth, app_connections, peers) == (0, 0, 0)
+    node.stop()
+    tracker.stop()
+
+def test_heartbeats_keep_the_advertised_interval():
+    base_port = random.randint(49152, 65000)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    node = Node(
+        log_filepath="node_0",
+        p2p_addr=('127.0.0.1', base_port + 1),
+        node_addr=('127.0.0.1', base_port + 2),
+        tracker_addr=('127.0.0.1', base_port),
+        enable_mining=False,
+        heartbeat_interval=1)
+    tracker_conn = node.p2p_client.tracker_conn
+    sent = []
+    send = tracker_conn.send
+    def record(msg):
+        if msg.type_char == b'H':
+            sent.append((time.monotonic(), decode_heartbeat(msg.payload)[5]))
+        return send(msg)
+    tracker_conn.send = record
+    time.sleep(4)
+    node.stop()
+    tracker.stop()
+    # an idle node backs off, and each heartbeat comes when the previous one said it would
+    assert len(sent) >= 2
+    for (sent_at, interval), (next_sent_at, _) in zip(sent, sent[1:]):
+        assert abs(next_sent_at - sent_at - interval) < 0.1
+
 if __name__ == '__main__':
     test_heartbeat_chain_length()
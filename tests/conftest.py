@@ -0,0 +1,16 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.crypto import generate_rsa_key_pair
+
+@pytest.fixture(scope="session")
+def key_files(tmp_path_factory):
+    """(private key file, public key file) of a key pair generated for the test session"""
+    key_dir = tmp_path_factory.mktemp('keys')
+    private_key_file = str(key_dir / 'private_key.pem')
+    public_key_file = str(key_dir / 'public_key.pem')
+    generate_rsa_key_pair(private_key_file, public_key_file)
+    return private_key_file, public_key_file
@@ -0,0 +1,32 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.crypto import SignatureVerifier, generate_rsa_key_pair, load_public_key, sign_data
+
+def test_signature_verifier(tmp_path):
+    private_key_file = str(tmp_path / 'private_key.pem')
+    public_key_file = str(tmp_path / 'public_key.pem')
+    generate_rsa_key_pair(private_key_file, public_key_file)
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
+    verifier = SignatureVerifier()
+
+    posts = [b"hello", b"goodbye", b"test"]
+    signatures = [sign_data(post, private_key_file) for post in posts]
+    items = list(zip(posts, signatures, [public_key_bytes] * len(posts)))
+    # a post with another post's signature
+    items.append((b"forged", signatures[0], public_key_bytes))
+    assert verifier.verify_many(items) == [True, True, True, False]
+    assert len(verifier.verified) == 3
+    # the key was parsed once for all posts
+    assert load_public_key.cache_info().currsize >= 1
+
+    # verified signatures are answered from the cache
+    assert verifier.submit(*items[0]).done()
+    assert verifier.verify(*items[0])
+    assert not verifier.verify(*items[3])
+    assert not verifier.verify(posts[0], signatures[0], b"not a key")
+    verifier.close()
@@ -13,7 +13,8 @@ from src.message import Message
 from src.blockchain import Blockchain
 from src.crypto import sign_data
 
-def test_two_nodes():
+def test_two_nodes(key_files):
+    private_key_file, public_key_file = key_files
     app_send1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     app_send2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -23,12 +24,14 @@ def test_two_nodes():
         log_filepath="node_1",
         p2p_addr=('127.0.0.1', base_port + 1), 
         node_addr=('127.0.0.1', base_port + 3), 
-        tracker_addr=('127.0.0.1', base_port))
+        tracker_addr=('127.0.0.1', base_port),
+        max_block_posts=1) # one post per block, so that chain lengths count posts
     node2 = Node(
         log_filepath="node_2",
         p2p_addr=('127.0.0.1', base_port + 2), 
         node_addr=('127.0.0.1', base_port + 4), 
-        tracker_addr=('127.0.0.1', base_port))
+        tracker_addr=('127.0.0.1', base_port),
+        max_block_posts=1)
     
     time.sleep(3)
     assert node1._get_num_peers() == 1
@@ -39,11 +42,11 @@ def test_two_nodes():
 
     # base blocks in both peers
     database = [b"hello", b"goodbye", b"test"]
-    with open('public_key.pem', 'rb') as public_key_file:
-        public_key_bytes = public_key_file.read()
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
     public_key_msg = Message('K', public_key_bytes).pack()
     for data in database:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         app_send1.sendall(msg.pack())
         app_send2.sendall(msg.pack())
@@ -57,13 +60,13 @@ def test_two_nodes():
     # add some new blocks in peer1's chain
     chain1_new = [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5"]
     for data in chain1_new:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         app_send1.sendall(msg.pack())
 
     # send a new post to node2
     post = b"post block"
-    signature = sign_data(post, 'private_key.pem')
+    signature = sign_data(post, private_key_file)
     msg = Message('A', public_key_msg + signature + post)
     app_send2.sendall(msg.pack())
 
@@ -77,7 +80,8 @@ def test_two_nodes():
     node2.stop()
     tracker.stop()
 
-def test_multi_nodes():
+def test_multi_nodes(key_files):
+    private_key_file, public_key_file = key_files
     base_port = random.randint(49152, 65000)
     tracker = Tracker('127.0.0.1', base_port, 'tracker')
     num_nodes = 7
@@ -89,18 +93,19 @@ def test_multi_nodes():
             log_filepath=f"node_{i}",
             p2p_addr=('127.0.0.1', base_port + 1 + i * 2), 
             node_addr=('127.0.0.1', base_port + 2 + i * 2), 
-            tracker_addr=('127.0.0.1', base_port)))
+            tracker_addr=('127.0.0.1', base_port),
+            max_block_posts=1)) # one post per block, so that chain lengths count posts
         app_socks[i].connect(('127.0.0.1', base_port + 2 + i * 2))
         time.sleep(i)
         assert nodes[i]._get_num_peers() == i
 
     # base blocks in both peers
     database = [b"hello", b"goodbye", b"test"]
-    with open('public_key.pem', 'rb') as public_key_file:
-        public_key_bytes = public_key_file.read()
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
     public_key_msg = Message('K', public_key_bytes).pack()
     for data in database:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         for app_send_sock in app_socks:
             app_send_sock.sendall(msg.pack())
@@ -112,7 +117,7 @@ def test_multi_nodes():
     # add new blocks to randomly-chosen node
     chain_new = [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5"]
     for data in chain_new:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         random_node_idx = random.randint(0, num_nodes - 1)
         app_socks[random_node_idx].sendall(msg.pack())
@@ -127,7 +132,8 @@ def test_multi_nodes():
         node.stop()
     tracker.stop()
 
-def test_pull_chain_from_longest_node():
+def test_pull_chain_from_longest_node(key_files):
+    private_key_file, public_key_file = key_files
     base_port = random.randint(49152, 65000)
     tracker_addr = ('127.0.0.1', base_port)
     tracker = Tracker('127.0.0.1', base_port, 'tracker')
@@ -145,11 +151,11 @@ def test_pull_chain_from_longest_node():
 
     # base blocks in both peers
     database = [b"hello", b"goodbye", b"test"]
-    with open('public_key.pem', 'rb') as public_key_file:
-        public_key_bytes = public_key_file.read()
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
     public_key_msg = Message('K', public_key_bytes).pack()
     for data in database:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         for app_send_sock in app_socks:
             app_send_sock.sendall(msg.pack())
@@ -161,7 +167,7 @@ def test_pull_chain_from_longest_node():
     # add new blocks to randomly-chosen node
     chain_new = [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5"]
     for data in chain_new:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         msg = Message('A', public_key_msg + signature + data)
         random_node_idx = random.randint(0, num_nodes - 1)
         app_socks[random_node_idx].sendall(msg.pack())
@@ -0,0 +1,77 @@
+import pytest
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.p2p import PeerManager
+
+class FakeConnection:
+    def __init__(self, sockname=('127.0.0.1', 0)):
+        self.sockname = sockname
+
+def test_dial_longest_chains_first():
+    manager = PeerManager(target_outbound=2)
+    manager.add_candidates([('127.0.0.1', port) for port in range(1, 6)])
+    manager.update_candidates({('127.0.0.1', 4): 30, ('127.0.0.1', 2): 20})
+    assert manager.to_dial() == [('127.0.0.1', 4), ('127.0.0.1', 2)]
+    # both are being dialed, so the outbound side is full
+    assert manager.to_dial() == []
+    manager.add_outbound(FakeConnection(), ('127.0.0.1', 4))
+    manager.dial_failed(('127.0.0.1', 2))
+    assert manager.num_outbound() == 1
+    next_addr, = manager.to_dial()
+    assert next_addr not in (('127.0.0.1', 2), ('127.0.0.1', 4))
+
+def test_duplicate_connections_keep_the_lower_dialer():
+    # node 1 and node 2 dial each other at the same time: both close the connection node 2 dialed
+    node1, node2 = PeerManager(), PeerManager()
+    node1.port, node2.port = 1, 2
+    conn_1_to_2, conn_2_to_1 = FakeConnection(), FakeConnection()
+    assert node1.add_outbound(conn_1_to_2, ('127.0.0.1', 2)) is None
+    assert node2.add_outbound(conn_2_to_1, ('127.0.0.1', 1)) is None
+    assert node1.add_inbound(conn_2_to_1) is None
+    assert node2.add_inbound(conn_1_to_2) is None
+    assert node1.hello(conn_2_to_1, ('127.0.0.1', 2)) == (False, conn_2_to_1)
+    assert node2.hello(conn_1_to_2, ('127.0.0.1', 1)) == (True, conn_2_to_1)
+    assert node1.addrs == {('127.0.0.1', 2): conn_1_to_2}
+    assert node2.addrs == {('127.0.0.1', 1): conn_1_to_2}
+
+    # the same when a dial completes after the peer's hello
+    node3 = PeerManager()
+    node3.port = 3
+    conn_2_to_3, conn_3_to_2 = FakeConnection(), FakeConnection()
+    assert node3.add_inbound(conn_2_to_3) is None
+    assert node3.hello(conn_2_to_3, ('127.0.0.1', 2)) == (True, None)
+    assert node3.add_outbound(conn_3_to_2, ('127.0.0.1', 2)) is conn_3_to_2
+    assert node3.addrs == {('127.0.0.1', 2): conn_2_to_3}
+    assert node3.num_outbound() == 0
+
+def test_inbound_limit_evicts_lowest_score():
+    manager = PeerManager(max_inbound=2, min_age=10)
+    first, second, third = FakeConnection(), FakeConnection(), FakeConnection()
+    assert manager.add_inbound(first, now=0) is None
+    assert manager.add_inbound(second, now=0) is None
+    # all inbound peers are too recent to be evicted
+    assert manager.add_inbound(third, now=5) is third
+    manager.record_block(first, False)
+    manager.record_block(second, True, height=10)
+    assert manager.score(second) > manager.score(first)
+    assert manager.add_inbound(third, now=20) is first
+    assert manager.num_inbound() == 2
+
+def test_rotate_low_scoring_outbound():
+    manager = PeerManager(target_outbound=2, min_age=10)
+    slow, good = FakeConnection(), FakeConnection()
+    manager.add_outbound(slow, ('127.0.0.1', 1), now=0)
+    manager.add_outbound(good, ('127.0.0.1', 2), now=0)
+    manager.ping(slow, now=0)
+    manager.pong(slow, now=0.9)
+    manager.record_block(slow, False)
+    manager.record_block(good, True, height=5)
+    # no other candidate to replace it with
+    assert manager.to_rotate(now=20) is None
+    manager.add_candidates([('127.0.0.1', 3)])
+    assert manager.to_rotate(now=5) is None
+    assert manager.to_rotate(now=20) is slow
+    assert manager.to_dial() == [('127.0.0.1', 3)]
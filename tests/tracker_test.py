@@ -8,6 +8,7 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.p2p import Tracker
+from src.p2p.tracker import ChainHeap, decode_heartbeat, encode_heartbeat
 from src.message import Message
 
 def test_tracker_join():
@@ -41,5 +42,111 @@ def test_tracker_join():
 
     tracker.stop()
 
+def register(base_port, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(('localhost', base_port))
+    sock.sendall(Message('R', port.to_bytes(2, 'big') + (b'\x00' * 6)).pack())
+    return sock
+
+def entry(port):
+    return socket.inet_aton('127.0.0.1') + port.to_bytes(2, 'big')
+
+def test_tracker_pushes_deltas():
+    base_port = random.randint(49152, 65000)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    time.sleep(0.5)
+    first = register(base_port, base_port + 1)
+    assert Message.recv_from(first).payload == b''
+    second = register(base_port, base_port + 2)
+    assert Message.recv_from(second).payload == entry(base_port + 1)
+    # the first peer is pushed the one that joined after it
+    joined = Message.recv_from(first)
+    assert joined.type_char == b'J'
+    assert joined.payload == entry(base_port + 2)
+    third = register(base_port, base_port + 3)
+    peer_list = Message.recv_from(third).payload
+    assert sorted(peer_list[i:i+6] for i in range(0, len(peer_list), 6)) == [entry(base_port + 1), entry(base_port + 2)]
+    assert Message.recv_from(first).payload == entry(base_port + 3)
+    assert Message.recv_from(second).payload == entry(base_port + 3)
+
+    # when the first peer leaves, the others are pushed its entry, and newcomers no longer get it
+    first.close()
+    for sock in (second, third):
+        left = Message.recv_from(sock)
+        assert left.type_char == b'V'
+        assert left.payload == entry(base_port + 1)
+    fourth = register(base_port, base_port + 4)
+    peer_list = Message.recv_from(fourth).payload
+    assert sorted(peer_list[i:i+6] for i in range(0, len(peer_list), 6)) == [entry(base_port + 2), entry(base_port + 3)]
+    assert len(tracker.clients_sockets) == 3
+
+    for sock in (second, third, fourth):
+        sock.close()
+    tracker.stop()
+
+def test_chain_heap_top_k():
+    rng = random.Random(1)
+    heap = ChainHeap()
+    chain_lens = {}
+    for i in range(200):
+        chain_lens[i] = rng.randint(0, 50)
+        heap.push(i, chain_lens[i])
+    for _ in range(1000):
+        key = rng.choice(list(chain_lens))
+        if rng.random() < 0.1:
+            heap.remove(key)
+            del chain_lens[key]
+            continue
+        chain_lens[key] = rng.randint(0, 50)
+        heap.update(key, chain_lens[key])
+    # the same order as a stable sort by chain length of the clients in registration order
+    expected = sorted(chain_lens, key=lambda key: chain_lens[key], reverse=True)
+    assert len(heap) == len(chain_lens)
+    assert heap.top(len(chain_lens) + 10) == expected
+    assert heap.top(5) == expected[:5]
+    assert heap.top(0) == []
+
+def test_heartbeat_encoding():
+    tip_hash = "ab" * 32
+    payload = encode_heartbeat(12, tip_hash, mempool_depth=7, app_connections=2, peers=5, interval=2.5)
+    assert decode_heartbeat(payload) == (12, tip_hash, 7, 2, 5, 2.5)
+    assert decode_heartbeat(encode_heartbeat(0)) == (0, None, 0, 0, 0, 0)
+    # a bare chain length is still a heartbeat
+    assert decode_heartbeat((3).to_bytes(4, 'big')) == (3, None, 0, 0, 0, None)
+
+def test_route_by_freshness_and_load():
+    base_port = random.randint(49152, 65000)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    time.sleep(0.5)
+    tip, fork = "11" * 32, "22" * 32
+    # (chain length, tip, mempool depth, app connections, interval) of the nodes:
+    # 0: longest chain but busy, 1: one block behind and idle, 2: longest chain on a fork,
+    # 3: longest chain but silent for too long, 4: far behind, 5: longest chain on the tip most nodes have
+    heartbeats = [(10, tip, 500, 9, 1), (9, "33" * 32, 0, 0, 1), (10, fork, 0, 0, 1), (10, tip, 0, 0, 0.001), (2, tip, 0, 0, 1),
+                  (10, tip, 0, 0, 1)]
+    socks = []
+    for i, (chain_len, tip_hash, mempool_depth, app_connections, interval) in enumerate(heartbeats):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('localhost', base_port))
+        node_addr = socket.inet_aton('127.0.0.1') + (base_port + 100 + i).to_bytes(2, 'big')
+        sock.sendall(Message('R', (base_port + 1 + i).to_bytes(2, 'big') + node_addr).pack())
+        Message.recv_from(sock)
+        sock.sendall(Message('H', encode_heartbeat(chain_len, tip_hash, mempool_depth, app_connections, 0, interval)).pack())
+        socks.append(sock)
+    time.sleep(0.5)
+    routed = [int.from_bytes(node_addr[4:], 'big') - base_port - 100 for node_addr in tracker._get_client_list(6)]
+    # up to date, fresh and idle first, longer chains before shorter ones; the fork is only passed by the node
+    # at the same height on the majority tip, and a stale node goes after the fresh ones
+    assert routed == [5, 2, 1, 0, 3, 4]
+    assert [int.from_bytes(node_addr[4:], 'big') - base_port - 100 for node_addr in tracker._get_client_list(1)] == [5]
+
+    for sock in socks:
+        sock.close()
+    tracker.stop()
+
 if __name__ == '__main__':
     test_tracker_join()
+    test_tracker_pushes_deltas()
+    test_chain_heap_top_k()
+    test_heartbeat_encoding()
+    test_route_by_freshness_and_load()
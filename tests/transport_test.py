@@ -0,0 +1,97 @@
+import pytest
+import concurrent.futures
+import socket
+import threading
+import time
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.p2p import Transport, create_dispatcher, OVERFLOW_DROP, OVERFLOW_DISCONNECT
+from src.message import Message
+
+def test_slow_peer_does_not_stall_others():
+    transport = Transport()
+    dispatcher = create_dispatcher("test")
+    slow_local, slow_remote = socket.socketpair()
+    fast_local, fast_remote = socket.socketpair()
+    slow_conn = transport.wrap(slow_local)
+    fast_conn = transport.wrap(fast_local)
+
+    # nobody reads from the slow peer, so its socket buffer fills up
+    payload = b'x' * (1 << 20)
+    start_time = time.perf_counter()
+    for _ in range(16):
+        slow_conn.send(Message('N', payload))
+        fast_conn.send(Message('N', b'hello'))
+    assert time.perf_counter() - start_time < 1
+
+    for _ in range(16):
+        assert Message.recv_from(fast_remote).payload == b'hello'
+
+    # messages from the remote end are handed to the handler in order
+    received = []
+    done = threading.Event()
+    def on_message(conn, msg):
+        received.append(msg.payload)
+        if len(received) == 3:
+            done.set()
+    closed = threading.Event()
+    fast_conn.start(on_message, lambda conn: closed.set(), dispatcher)
+    for data in [b'1', b'2', b'3']:
+        fast_remote.sendall(Message('M', data).pack())
+    assert done.wait(5)
+    assert received == [b'1', b'2', b'3']
+
+    fast_remote.close()
+    assert closed.wait(5)
+    transport.close()
+    dispatcher.shutdown()
+    slow_remote.close()
+
+def test_bounded_queue_overflow():
+    dropping = Transport(max_queue_size=4, overflow=OVERFLOW_DROP)
+    disconnecting = Transport(max_queue_size=4, overflow=OVERFLOW_DISCONNECT)
+    stalled_peers = []
+    conns = []
+    for transport in [dropping, disconnecting]:
+        local, remote = socket.socketpair()
+        stalled_peers.append(remote)
+        conns.append(transport.wrap(local))
+    closed = threading.Event()
+    conns[1].start(lambda conn, msg: None, lambda conn: closed.set())
+
+    # nobody reads the stalled peers, so their write queues fill up once the socket buffers do
+    payload = b'x' * (1 << 20)
+    for _ in range(64):
+        for transport, conn in zip([dropping, disconnecting], conns):
+            transport.broadcast([conn], Message('N', payload))
+    assert closed.wait(5)
+    assert conns[1].closed
+    time.sleep(0.5)
+    stats = dropping.queue_stats()[0]
+    assert not conns[0].closed
+    assert stats['depth'] <= 4 and stats['max_depth'] == 4
+    assert stats['dropped'] > 0
+    assert stats['sent'] + stats['depth'] + stats['dropped'] == 64
+
+    for transport in [dropping, disconnecting]:
+        transport.close()
+    for remote in stalled_peers:
+        remote.close()
+
+def test_send_wait_times_out():
+    transport = Transport(max_queue_size=4)
+    local, remote = socket.socketpair()
+    conn = transport.wrap(local)
+
+    # nobody reads the peer, so the message after the ones that fill the socket buffer is never written
+    payload = b'x' * (1 << 20)
+    for _ in range(4):
+        conn.send(Message('N', payload))
+    with pytest.raises(concurrent.futures.TimeoutError):
+        conn.send_wait(Message('N', payload), 0.5)
+
+    transport.close()
+    remote.close()
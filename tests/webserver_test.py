@@ -0,0 +1,338 @@
+import base64
+import contextlib
+import pytest
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import types
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.crypto import generate_rsa_key_pair, sign_data, verify_signature
+from src.webserver.keys import KeyManager
+from src.webserver.chain_cache import ChainCache, stream_chain
+from src.webserver.live_feed import LiveFeed
+from src.webserver.socket_manager import NodeConnection, SocketManager
+import src.webserver.app
+from src import Node
+from src.p2p import Tracker
+from src.message import Message
+from src.blockchain import BLOCK_REWARD, COINBASE, TX_DONATION, TX_REWARD, Block, Blockchain, decode_transaction, encode_batch, encode_transaction, hash
+
+# packages re-export names that shadow their modules, e.g. the Flask object `app`
+app_module = sys.modules['src.webserver.app']
+worker_module = sys.modules['src.blockchain.worker']
+
+@pytest.fixture
+def app_node():
+    """a node without mining, and the webserver's end of a connection to it"""
+    base_port = random.randint(49152, 65535)
+    tracker = Tracker('127.0.0.1', base_port, 'tracker')
+    node_sock, app_sock = socket.socketpair()
+    node = Node(
+        log_filepath="node1",
+        p2p_addr=('127.0.0.1', base_port + 1),
+        tracker_addr=('127.0.0.1', base_port),
+        app_sockets=[node_sock],
+        enable_mining=False)
+    yield node, app_sock
+    node.stop()
+    tracker.stop()
+
+@pytest.mark.parametrize("signing_processes", [0, 1])
+def test_key_manager_reloads_changed_keys(tmp_path, signing_processes):
+    private_key_file = str(tmp_path / 'private_key.pem')
+    public_key_file = str(tmp_path / 'public_key.pem')
+    generate_rsa_key_pair(private_key_file, public_key_file)
+    key_manager = KeyManager(private_key_file, public_key_file, signing_processes, check_interval=60)
+
+    public_key_bytes, signature = key_manager.sign(b"hello")
+    assert verify_signature(b"hello", signature, public_key_bytes)
+    first_private_key = key_manager.private_key
+    key_manager.sign(b"goodbye")
+    assert key_manager.private_key is first_private_key
+
+    # rotate the key pair on disk; it is picked up at the next check of the files
+    generate_rsa_key_pair(private_key_file, public_key_file)
+    os.utime(private_key_file, ns=(0, 0))
+    assert key_manager.sign(b"hello")[0] == public_key_bytes
+    key_manager.checked_at -= 60
+    new_public_key_bytes, signature = key_manager.sign(b"hello")
+    assert new_public_key_bytes != public_key_bytes
+    assert verify_signature(b"hello", signature, new_public_key_bytes)
+    assert not verify_signature(b"hello", signature, public_key_bytes)
+    key_manager.close()
+
+def test_chain_pages_follow_the_node(monkeypatch, app_node):
+    node, app_sock = app_node
+    author = b"a" * 64
+    for data in [b"hello", b"goodbye", b"test"]:
+        node.bc.add(node.bc.mine(Block(data=author + data)))
+    conn = NodeConnection(app_sock)
+    chain_cache = ChainCache(lambda: contextlib.nullcontext(conn), min_interval=0)
+    monkeypatch.setattr(app_module, 'chain_cache', chain_cache)
+    client = app_module.app.test_client()
+
+    response = client.get('/chain')
+    assert [post["content"] for post in response.get_json()] == ["hello", "goodbye", "test"]
+    etag = response.headers['ETag']
+    assert client.get('/chain', headers={'If-None-Match': etag}).status_code == 304
+
+    response = client.get('/chain?limit=2')
+    assert [post["content"] for post in response.get_json()] == ["goodbye", "test"]
+    response = client.get(f"/chain?limit=2&cursor={response.headers['X-Next-Cursor']}")
+    assert [post["content"] for post in response.get_json()] == ["hello"]
+    assert 'X-Next-Cursor' not in response.headers
+
+    # a reorg on the node replaces the tail of the cached copy
+    node.bc.remove(node.bc.chain[-1])
+    for data in [b"changed", b"changed again"]:
+        node.bc.add(node.bc.mine(Block(data=author + data)))
+    response = client.get('/chain', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert [post["content"] for post in response.get_json()] == ["hello", "goodbye", "changed", "changed again"]
+    assert client.get('/chain?cursor=' + '0' * 64).status_code == 400
+
+def test_pages_are_served_during_a_refresh(app_node):
+    node, app_sock = app_node
+    node.bc.add(node.bc.mine(Block(data=b"a" * 64 + b"hello")))
+    conn = NodeConnection(app_sock)
+    chain_cache = ChainCache(lambda: contextlib.nullcontext(conn), min_interval=0)
+    chain_cache.refresh()
+
+    # a node that is slow to answer holds up the refresh, but not the readers of the copy
+    answer = threading.Event()
+    class SlowConnection:
+        def request(self, msg):
+            answer.wait(10)
+            return conn.request(msg)
+    chain_cache.connection = lambda: contextlib.nullcontext(SlowConnection())
+    node.bc.add(node.bc.mine(Block(data=b"a" * 64 + b"goodbye")))
+    refresh = threading.Thread(target=chain_cache.refresh)
+    refresh.start()
+    time.sleep(0.2)
+    start = time.monotonic()
+    posts, _ = chain_cache.page()
+    assert [post["content"] for post in posts] == ["hello"]
+    assert chain_cache.tip_hash == node.bc.chain[0].hash()
+    assert time.monotonic() - start < 1
+    answer.set()
+    refresh.join()
+    assert [post["content"] for post in chain_cache.page()[0]] == ["hello", "goodbye"]
+
+def test_stream_chain_in_chunks(monkeypatch, app_node):
+    # every block goes in its own chunk
+    monkeypatch.setattr(worker_module, 'EXPORT_CHUNK_SIZE', 1)
+    node, app_sock = app_node
+    for data in [b"hello", b"goodbye", b"test"]:
+        node.bc.add(node.bc.mine(Block(data=b"a" * 64 + data)))
+
+    blocks = stream_chain(app_sock)
+    assert next(blocks) == node.bc.chain[0]
+    assert list(blocks) == node.bc.chain[1:]
+    # the socket is ready for the next request once the export is consumed
+    assert [block.hash() for block in stream_chain(app_sock)] == [block.hash() for block in node.bc.chain]
+    # a chain that doesn't link up is rejected
+    with pytest.raises(RuntimeError):
+        list(Blockchain.iter_decode([node.bc.encode(0, 1), node.bc.encode(2, 3)]))
+
+def test_requests_are_multiplexed(app_node):
+    node, app_sock = app_node
+    for data in [b"hello", b"goodbye", b"test"]:
+        node.bc.add(node.bc.mine(Block(data=b"a" * 64 + data)))
+    conn = NodeConnection(app_sock)
+
+    # requests from many threads share the connection, and each gets its own response
+    def get_blocks(idx, responses):
+        locator = bytes.fromhex(node.bc.chain[idx].hash())
+        responses[idx] = conn.request(Message('G', locator))
+    responses = {}
+    threads = [threading.Thread(target=get_blocks, args=(idx % 3, responses)) for idx in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for idx, response in responses.items():
+        assert response.type_char == b'B'
+        assert Blockchain.decode_blocks(response.payload[1:]) == node.bc.chain[idx + 1:]
+    assert not conn.pending
+
+    # a response is matched to its request even if an earlier one is still being served
+    assert conn.request(Message('P', b'')).payload == node.bc.encode()
+    # and a node answers the probe of a health check
+    socket_manager = SocketManager(('127.0.0.1', 0), health_check_interval=3600)
+    assert socket_manager._probe(conn)
+    socket_manager.close()
+    conn.close()
+    assert conn.closed
+
+def test_socket_manager_pool(monkeypatch):
+    servers = [socket.create_server(('127.0.0.1', 0)) for _ in range(2)]
+    nodes = [server.getsockname() for server in servers]
+    socket_manager = SocketManager(('127.0.0.1', 0), pool_size=2, connections_per_node=1, health_check_interval=3600, probe_timeout=0.2)
+    monkeypatch.setattr(socket_manager, '_request_top_nodes', lambda: nodes)
+    # the servers never answer, so they only pass health checks while the probe is skipped
+    monkeypatch.setattr(socket_manager, '_probe', lambda conn: True)
+
+    # concurrent requests go to different nodes
+    with socket_manager.connection() as conn1:
+        with socket_manager.connection() as conn2:
+            assert {conn1.addr, conn2.addr} == set(nodes)
+            assert all(stats['outstanding'] == 1 for stats in socket_manager.stats().values())
+            # and share a node's connection once every node is busy
+            with socket_manager.connection() as conn3:
+                assert conn3 in (conn1, conn2)
+    assert all(stats == {'outstanding': 0, 'open': 1} for stats in socket_manager.stats().values())
+
+    # connections closed by the node are replaced
+    for server in servers:
+        server.accept()[0].close()
+    time.sleep(0.1)
+    assert conn1.closed and conn2.closed
+    socket_manager.health_check()
+    with socket_manager.connection() as conn:
+        assert not conn.closed and conn not in (conn1, conn2)
+
+    # a node that refuses connections is dropped
+    servers[0].close()
+    servers[0] = None
+    for conn in socket_manager.conns[nodes[0]]:
+        conn.close()
+    socket_manager.health_check()
+    assert list(socket_manager.stats()) == [nodes[1]]
+
+    # a node that keeps its connection open but doesn't answer is dropped as well
+    monkeypatch.undo()
+    conn = socket_manager.conns[nodes[1]][0]
+    socket_manager.health_check()
+    assert socket_manager.stats() == {}
+    assert conn.closed
+    socket_manager.close()
+    servers[1].close()
+
+def test_query_posts_by_author_and_words(monkeypatch, app_node):
+    node, app_sock = app_node
+    alice, bob = b"a" * 64, b"b" * 64
+    for data in [alice + b"hello world", bob + b"hello there", alice + b"goodbye world"]:
+        node.bc.add(node.bc.mine(Block(data=data)))
+    conn = NodeConnection(app_sock)
+    monkeypatch.setattr(app_module, 'socket_manager', types.SimpleNamespace(connection=lambda: contextlib.nullcontext(conn)))
+    client = app_module.app.test_client()
+
+    response = client.get('/posts?author=' + 'a' * 64)
+    assert [(post["height"], post["content"]) for post in response.get_json()] == [(2, "goodbye world"), (0, "hello world")]
+    response = client.get('/posts?q=hello&limit=1')
+    assert [post["content"] for post in response.get_json()] == ["hello there"]
+    response = client.get(f"/posts?q=hello&limit=1&before={response.headers['X-Next-Cursor']}")
+    assert [post["content"] for post in response.get_json()] == ["hello world"]
+    assert client.get('/posts?q=world%20hello').get_json()[0]["content"] == "hello world"
+    assert client.get('/posts').status_code == 400
+    assert client.get('/posts?q=hello&limit=-1').status_code == 400
+    # a limit above what the node answers is clamped, so that a full page still has a next page
+    monkeypatch.setattr(app_module, 'MAX_QUERY_RESULTS', 1)
+    response = client.get('/posts?q=hello&limit=1000')
+    assert [post["content"] for post in response.get_json()] == ["hello there"]
+    assert response.headers['X-Next-Cursor'] == "1"
+
+def test_balance_and_transaction_posts(monkeypatch, app_node, key_files):
+    private_key_file, public_key_file = key_files
+    node, app_sock = app_node
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
+    node.bc.add(node.bc.mine(Block(data=COINBASE.encode() + encode_transaction(TX_REWARD, "a" * 64, BLOCK_REWARD, b"1" * 32))))
+    conn = NodeConnection(app_sock)
+    monkeypatch.setattr(app_module, 'socket_manager', types.SimpleNamespace(connection=lambda: contextlib.nullcontext(conn)))
+    client = app_module.app.test_client()
+
+    assert client.get('/balance/' + 'a' * 64).get_json() == {"account": "a" * 64, "balance": BLOCK_REWARD, "height": 1}
+    assert client.get('/balance/' + 'b' * 64).get_json()["balance"] == 0
+    post = client.get('/posts?author=' + COINBASE).get_json()[0]
+    assert post["type"] == "transaction"
+    assert post["transaction"] == {"kind": "R", "recipient": "a" * 64, "amount": BLOCK_REWARD}
+    assert client.post('/donate', json={"recipient": "b" * 64, "amount": -1}).status_code == 400
+    # malformed fields are refused up front rather than failing, or being truncated, when packed
+    for recipient, amount in [(64, 10), (["b"] * 64, 10), ("g" * 64, 10), ("é" * 64, 10), ("b" * 63, 10),
+                              ("b" * 64, "10"), ("b" * 64, 1.5), ("b" * 64, True), ("b" * 64, 2 ** 64), ("b" * 64, None)]:
+        assert client.post('/donate', json={"recipient": recipient, "amount": amount}).status_code == 400
+    assert client.post('/donate', json=["b" * 64, 10]).status_code == 400
+    # a transaction posted as a message would be signed with the webserver's keys
+    forged = encode_transaction(TX_DONATION, "b" * 64, int.from_bytes(b"11111111", 'big'), b"2" * 32).decode()
+    assert client.post('/message', json={"post_content": forged}).status_code == 400
+    # donations are never signed with the webserver's keys
+    assert client.post('/donate', json={"recipient": "b" * 64, "amount": 10}).status_code == 400
+    reference = os.urandom(32)
+    donation = {"recipient": "b" * 64, "amount": 10, "reference": reference.hex(), "public_key": public_key_bytes.decode(),
+                "signature": base64.b64encode(sign_data(encode_transaction(TX_DONATION, "b" * 64, 10, reference), private_key_file)).decode()}
+    assert client.post('/donate', json=dict(donation, amount=20)).status_code == 400
+    for field in ("reference", "public_key", "signature"):
+        assert client.post('/donate', json=dict(donation, **{field: 5})).status_code == 400
+    node.bc.add(node.bc.mine(Block(data=COINBASE.encode() + encode_transaction(TX_REWARD, hash(public_key_bytes), BLOCK_REWARD, b"2" * 32))))
+    assert client.post('/donate', json=donation).status_code == 200
+    time.sleep(0.5)
+    assert [decode_transaction(entry) for entry in node.mempool] == [(hash(public_key_bytes), TX_DONATION, "b" * 64, 10)]
+
+def test_batch_blocks_are_split_into_posts(monkeypatch, app_node):
+    node, app_sock = app_node
+    alice, bob = b"a" * 64, b"b" * 64
+    node.bc.add(node.bc.mine(Block(data=alice + b"hello")))
+    node.bc.add(node.bc.mine(Block(data=encode_batch([alice + b"hello world", bob + b"hello there", alice + b"bye"]))))
+    conn = NodeConnection(app_sock)
+    monkeypatch.setattr(app_module, 'chain_cache', ChainCache(lambda: contextlib.nullcontext(conn), min_interval=0))
+    monkeypatch.setattr(app_module, 'socket_manager', types.SimpleNamespace(connection=lambda: contextlib.nullcontext(conn)))
+    client = app_module.app.test_client()
+
+    response = client.get('/chain?limit=2')
+    assert [(post["content"], post["position"]) for post in response.get_json()] == [("hello there", 1), ("bye", 2)]
+    assert response.headers['X-Next-Cursor'] == node.bc.tip_hash + ":1"
+    response = client.get(f"/chain?limit=2&cursor={response.headers['X-Next-Cursor']}")
+    assert [post["content"] for post in response.get_json()] == ["hello", "hello world"]
+    assert client.get(f"/chain?cursor={node.bc.tip_hash}:3").status_code == 400
+
+    # only the posts of a block that match the query
+    assert [post["content"] for post in client.get('/posts?author=' + 'a' * 64).get_json()] == ["bye", "hello world", "hello"]
+    assert [post["content"] for post in client.get('/posts?q=hello&limit=1').get_json()] == ["hello there", "hello world"]
+
+def test_live_feed_pushes_changes(app_node):
+    node, app_sock = app_node
+    author = b"a" * 64
+    node.bc.add(node.bc.mine(Block(data=author + b"hello")))
+    conn = NodeConnection(app_sock)
+    chain_cache = ChainCache(lambda: contextlib.nullcontext(conn), min_interval=3600)
+    socket_manager = types.SimpleNamespace(connection=lambda: contextlib.nullcontext(conn), update_connection=lambda: None)
+    live_feed = LiveFeed(socket_manager, chain_cache)
+    events = live_feed.listen()
+
+    # subscribing sends the current tip, and the copy syncs
+    event = next(events)
+    assert event["tip"] == node.bc.tip_hash
+    assert [post["content"] for post in event["posts"]] == ["hello"] and event["removed"] == []
+    assert live_feed.subscribed
+
+    # each new tip is pushed, with only the new posts
+    with node.pool_lock:
+        node.bc.add(node.bc.mine(Block(data=author + b"world")))
+    event = next(events)
+    assert [post["content"] for post in event["posts"]] == ["world"] and event["removed"] == []
+    removed_hash = node.bc.tip_hash
+
+    # a reorg removes posts as well
+    fork = Blockchain()
+    fork.add(node.bc.chain[0])
+    for data in [b"fork 1", b"fork 2"]:
+        fork.add(fork.mine(Block(data=author + data)))
+    with node.pool_lock:
+        node.bc.mergeChain(fork.chain)
+    event = next(events)
+    assert event["removed"] == [removed_hash]
+    assert [post["content"] for post in event["posts"]] == ["fork 1", "fork 2"]
+    assert event["tip"] == node.bc.tip_hash
+
+    # losing the node's connection ends the subscription
+    conn.close()
+    time.sleep(0.2)
+    assert not live_feed.subscribed
+    live_feed.close()
+    assert list(events) == []
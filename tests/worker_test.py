@@ -1,31 +1,34 @@
+import concurrent.futures
+import concurrent.futures.process
 import pytest
 import socket
+import threading
 import time
 import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from src.blockchain import Worker
-from src.crypto import sign_data, generate_rsa_key_pair
-
-@pytest.fixture(scope="session")
-def generate_keys():
-    if not os.path.exists('public_key.pem') or not os.path.exists('private_key.pem'):
-        generate_rsa_key_pair()
+from src.blockchain import Worker, Blockchain, Block, ParallelMiner, entry_hash, hash
+from src.blockchain import BLOCK_REWARD, COINBASE, INV_POST, TX_DONATION, TX_REWARD, Mempool, decode_transaction, encode_transaction, transaction_signature
+from src.blockchain import worker as worker_module
+from src.crypto import SIGNATURE_LEN, sign_data
+from src.message import Message
 
 @pytest.mark.parametrize("iteration", range(1))
-def test_merge_longer_chain(iteration):
+def test_merge_longer_chain(iteration, key_files):
+    private_key_file, public_key_file = key_files
     sock1, sock2 = socket.socketpair()
-    node1 = Worker(enable_mining=True, name="node1", log_filepath="node1")
-    node2 = Worker(enable_mining=True, name="node2", log_filepath="node2")
+    # one post per block, so that chain lengths count posts
+    node1 = Worker(enable_mining=True, name="node1", log_filepath="node1", max_block_posts=1)
+    node2 = Worker(enable_mining=True, name="node2", log_filepath="node2", max_block_posts=1)
 
     # base blocks in both peers
     database = [b"hello", b"goodbye", b"test"]
-    with open('public_key.pem', 'rb') as public_key_file:
-        public_key_bytes = public_key_file.read()
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
     for data in database:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         node1._new_pending_block(signature=signature, public_key_bytes=public_key_bytes, data=data)
         node2._new_pending_block(signature=signature, public_key_bytes=public_key_bytes, data=data)
     
@@ -34,7 +37,7 @@ def test_merge_longer_chain(iteration):
     # add some new blocks in peer1's chain
     chain1_new = [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5"]
     for data in chain1_new:
-        signature = sign_data(data, 'private_key.pem')
+        signature = sign_data(data, private_key_file)
         node1._new_pending_block(signature=signature, public_key_bytes=public_key_bytes, data=data)
 
     # wait for peer1 mining complete 
@@ -46,7 +49,7 @@ def test_merge_longer_chain(iteration):
 
     # send a new post to node2
     post = b"post block"
-    signature = sign_data(post, 'private_key.pem')
+    signature = sign_data(post, private_key_file)
     node2._new_pending_block(signature=signature, public_key_bytes=public_key_bytes, data=post)
 
     """
@@ -77,5 +80,256 @@ def test_merge_longer_chain(iteration):
     node1.stop()
     node2.stop()
 
+def test_parallel_miner():
+    miner = ParallelMiner(processes=2, chunk_size=2 ** 12)
+    bc = Blockchain()
+    for data in [b"hello", b"goodbye", b"test"]:
+        mined_block = bc.mine(Block(data=data), miner)
+        assert mined_block is not None
+        bc.add(mined_block)
+    assert len(bc.chain) == 3
+    assert bc.isValid()
+    assert miner.hash_rate > 0
+
+    # a search that can't finish in time gives up once cancelled
+    threading.Timer(0.5, miner.cancel).start()
+    assert miner.mine(Block(data=b"cancelled"), difficulty=16) is None
+    # including a cancel that comes before the search starts, and only that search
+    miner.cancel()
+    assert miner.mine(Block(data=b"cancelled early"), difficulty=16) is None
+    assert miner.mine(Block(data=b"not cancelled"), difficulty=2) is not None
+    miner.close()
+
+def test_sync_suffix_in_batches(monkeypatch):
+    monkeypatch.setattr(worker_module, 'SYNC_BATCH_SIZE', 2)
+    sock1, sock2 = socket.socketpair()
+    node1 = Worker(enable_mining=False, name="node1", log_filepath="node1")
+    node2 = Worker(enable_mining=False, name="node2", log_filepath="node2")
+
+    # both nodes share the first blocks, then node1 grows a longer fork
+    for data in [b"hello", b"goodbye"]:
+        block = node1.bc.mine(Block(data=data))
+        node1.bc.add(block)
+        node2.bc.add(block)
+    for data in [b"chain1_1", b"chain1_2", b"chain1_3", b"chain1_4", b"chain1_5"]:
+        node1.bc.add(node1.bc.mine(Block(data=data)))
+    node2.bc.add(node2.bc.mine(Block(data=b"chain2_1")))
+
+    node1._peer_join(sock1)
+    peer2 = node2._peer_join(sock2)
+    node2._request_blocks(peer2)
+    time.sleep(1)
+
+    assert node2.bc.isValid()
+    assert node2.bc.height == node1.bc.height
+    assert node2.bc.tip_hash == node1.bc.tip_hash
+    assert list(node2.mempool) == [b"chain2_1"]
+    node1.stop()
+    node2.stop()
+
+def test_gossip_relays_posts_and_blocks(key_files):
+    private_key_file, public_key_file = key_files
+    # node1 - node2 - node3 in a line, so that node3 only learns about items through node2's relay
+    sock1, sock2 = socket.socketpair()
+    sock3, sock4 = socket.socketpair()
+    nodes = [Worker(enable_mining=False, name=f"node{i}", log_filepath=f"node{i}") for i in range(1, 4)]
+    nodes[0]._peer_join(sock1)
+    nodes[1]._peer_join(sock2)
+    nodes[1]._peer_join(sock3)
+    nodes[2]._peer_join(sock4)
+
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
+    data = b"gossip post"
+    payload = Message('K', public_key_bytes).pack() + sign_data(data, private_key_file) + data
+    nodes[0]._relay_post(payload)
+    time.sleep(1)
+    entry = next(iter(nodes[0].mempool))
+    for node in nodes:
+        assert list(node.mempool) == [entry]
+    # a pending post announced again isn't fetched again
+    assert nodes[1]._has_item(INV_POST, bytes.fromhex(entry_hash(entry)))
+
+    block = nodes[0].bc.mine(Block(data=entry))
+    nodes[0].bc.add(block)
+    nodes[0]._announce_block(block)
+    time.sleep(1)
+    for node in nodes:
+        assert node.bc.tip_hash == block.hash()
+    assert len(nodes[2].mempool) == 0
+    for node in nodes:
+        node.stop()
+
+def test_donations_need_funds():
+    node = Worker(enable_mining=False, name="node1", log_filepath="node1")
+    public_key_bytes = b"public key"
+    signature = b"s" * SIGNATURE_LEN
+    donation = encode_transaction(TX_DONATION, "b" * 64, 30, b"1" * 32)
+    assert node._add_pending_block(public_key_bytes, donation, signature) is None
+    # a signature over more than the transaction, or a transaction that doesn't decode, isn't accepted either
+    assert node._add_pending_block(public_key_bytes, donation + b"more", signature) is None
+    assert node._add_pending_block(public_key_bytes, donation[:-1], signature) is None
+    assert node._add_pending_block(public_key_bytes, encode_transaction(TX_REWARD, "b" * 64, BLOCK_REWARD, b"2" * 32), signature) is None
+
+    reward = COINBASE.encode() + encode_transaction(TX_REWARD, hash(public_key_bytes), BLOCK_REWARD, b"3" * 32)
+    node.bc.add(node.bc.mine(Block(data=reward)))
+    # a donation carries its signature and key, and isn't accepted without them
+    assert node._add_pending_block(public_key_bytes, donation) is None
+    entry = node._add_pending_block(public_key_bytes, donation, signature)
+    assert entry == hash(public_key_bytes).encode() + donation + signature + public_key_bytes
+    assert transaction_signature(entry) == (donation, signature, public_key_bytes)
+    # a donation under another sender's key, or of a sender with a key that isn't theirs, moves nothing
+    assert transaction_signature(b"d" * 64 + donation + signature + public_key_bytes) is None
+    assert node._admit(b"d" * 64 + donation + signature + public_key_bytes) is False
+    node.stop()
+
+def test_blocks_with_forged_donations_are_rejected(key_files):
+    private_key_file, public_key_file = key_files
+    node = Worker(enable_mining=False, name="node1", log_filepath="node1")
+    with open(public_key_file, 'rb') as key_file:
+        public_key_bytes = key_file.read()
+    sender = hash(public_key_bytes)
+    node.bc.add(node.bc.mine(Block(data=COINBASE.encode() + encode_transaction(TX_REWARD, sender, BLOCK_REWARD, b"1" * 32))))
+    donation = encode_transaction(TX_DONATION, "b" * 64, 30, b"2" * 32)
+    signature = sign_data(donation, private_key_file)
+
+    # another transfer under the signature of the donation, or the donation under another sender's name
+    for entry in [sender.encode() + encode_transaction(TX_DONATION, "c" * 64, 30, b"2" * 32) + signature + public_key_bytes,
+                  b"d" * 64 + donation + signature + public_key_bytes]:
+        node._Worker__mined_block(node.bc.mine(Block(data=entry)), None)
+        assert node.bc.height == 1
+    node._Worker__mined_block(node.bc.mine(Block(data=sender.encode() + donation + signature + public_key_bytes)), None)
+    assert node.bc.height == 2
+    assert node.bc.ledger.balance("b" * 64) == 30
+    node.stop()
+
+def test_rejected_fork_is_admitted_like_new_posts():
+    node = Worker(enable_mining=False, name="node1", log_filepath="node1")
+    alice = hash(b"alice").encode()
+    reward = COINBASE.encode() + encode_transaction(TX_REWARD, alice.decode(), BLOCK_REWARD, b"1" * 32)
+    donation = alice + encode_transaction(TX_DONATION, "b" * 64, 30, b"2" * 32) + b"s" * SIGNATURE_LEN + b"alice"
+    fork = Blockchain()
+    for data in [reward, donation, b"c" * 64 + b"forked post"]:
+        fork.add(fork.mine(Block(data=data)))
+    for data in [b"one", b"two", b"three", b"four"]:
+        node.bc.add(node.bc.mine(Block(data=data)))
+
+    # the shorter fork loses; alice has no funds on the local chain, so only the plain post is mined again
+    assert node._merge_remote_chain(fork.chain) is None
+    assert list(node.mempool) == [b"c" * 64 + b"forked post"]
+    node.stop()
+
+def test_mempool_order_and_bounds():
+    pool = Mempool(max_entries=3, max_bytes=1024, ttl=10)
+    donation = b"a" * 64 + encode_transaction(TX_DONATION, "b" * 64, 1, b"1" * 32)
+    assert pool.add(b"post 1", now=0)
+    assert pool.add(b"post 2", now=1)
+    assert not pool.add(b"post 1", now=2)
+    assert pool.add(donation, now=3)
+    # transactions first, then posts in arrival order
+    assert list(pool) == [donation, b"post 1", b"post 2"]
+    assert pool.peek(now=3) == donation
+
+    # a full pool rejects posts that rank last, and makes room for the ones that outrank them
+    assert not pool.add(b"post 3", now=4)
+    other_donation = b"a" * 64 + encode_transaction(TX_DONATION, "b" * 64, 1, b"2" * 32)
+    assert pool.add(other_donation, now=5)
+    assert list(pool) == [donation, other_donation, b"post 1"]
+    assert not pool.add(b"x" * 2048, now=5)
+
+    # stale entries are dropped
+    assert pool.peek(now=12) == donation
+    assert pool.peek(now=14) == other_donation
+    assert pool.peek(now=16) is None
+    assert pool.stats() == {'entries': 0, 'bytes': 0, 'evicted': 1, 'expired': 3}
+
+def test_posts_on_chain_are_not_pending():
+    node = Worker(enable_mining=False, name="node1", log_filepath="node1")
+    public_key_bytes = b"public key"
+    entry = node._add_pending_block(public_key_bytes, b"post")
+    assert list(node.mempool) == [entry]
+    node.bc.add(node.bc.mine(Block(data=entry)))
+    node.mempool.discard(entry)
+    assert node._add_pending_block(public_key_bytes, b"post") is None
+    assert len(node.mempool) == 0
+    node.stop()
+
+def test_posts_are_mined_in_batches():
+    node = Worker(enable_mining=True, name="node1", log_filepath="node1", max_block_posts=3, batch_wait=1)
+    entries = [node._add_pending_block(b"public key", data) for data in [b"one", b"two", b"three", b"four"]]
+    time.sleep(3)
+    # the first three posts fill a block, and the last one is mined on its own once batch_wait is over
+    assert [block.entries() for block in node.bc.chain] == [entries[:3], entries[3:]]
+    assert all(entry_hash(entry) in node.bc.block_hash_pool for entry in entries)
+    assert len(node.mempool) == 0
+    node.stop()
+
+def test_miner_is_rewarded_once_per_block():
+    node = Worker(enable_mining=True, name="node1", log_filepath="node1", reward_account="m" * 64)
+    entries = [node._add_pending_block(b"public key", data) for data in [b"one", b"two"]]
+    time.sleep(2)
+    assert node.bc.height == 1
+    reward, *posts = node.bc.chain[0].entries()
+    assert posts == entries
+    assert decode_transaction(reward) == (COINBASE, TX_REWARD, "m" * 64, BLOCK_REWARD)
+    assert node.bc.ledger.balance("m" * 64) == BLOCK_REWARD
+    node.stop()
+
+def test_failed_search_keeps_the_posts():
+    node = Worker(enable_mining=True, name="node1", log_filepath="node1")
+    def broken_mine(*args, **kwargs):
+        raise concurrent.futures.process.BrokenProcessPool("a mining process died")
+    node.miner.mine = broken_mine
+    entry = node._add_pending_block(b"public key", b"post")
+    time.sleep(2)
+    # the post is mined on a new miner
+    assert node.bc.height == 1
+    assert node.bc.chain[0].entries() == [entry]
+    assert len(node.mempool) == 0
+    assert node.worker_thread.is_alive()
+    node.stop()
+
+def test_posts_mined_elsewhere_are_dropped():
+    node = Worker(enable_mining=True, name="node1", log_filepath="node1")
+    node.bc.difficulty = 12
+    entry = node._add_pending_block(b"public key", b"post")
+    time.sleep(0.5)
+    # the post reaches the chain in another block while it is being mined: it is dropped, and mining goes on
+    node.bc.difficulty = 4
+    with node.pool_lock:
+        node.bc.add(node.bc.mine(Block(data=entry)))
+    time.sleep(1)
+    assert len(node.mempool) == 0
+    assert node.worker_thread.is_alive()
+    other = node._add_pending_block(b"public key", b"another post")
+    time.sleep(2)
+    assert node.bc.height == 2
+    assert node.bc.chain[1].entries() == [other]
+    node.stop()
+
+def test_mining_restarts_on_tip_change():
+    node = Worker(enable_mining=True, name="node1", log_filepath="node1")
+    # a search that would take far too long on its own
+    node.bc.difficulty = 12
+    entry = node._add_pending_block(b"public key", b"post")
+    time.sleep(0.5)
+    # another block extends the tip: the stale search stops, and the post is mined on the new tip
+    node.bc.difficulty = 4
+    with node.pool_lock:
+        node.bc.add(node.bc.mine(Block(data=b"other")))
+    time.sleep(2)
+    assert node.bc.height == 2
+    assert node.bc.chain[1].entries() == [entry]
+    assert node.bc.chain[1].previous_hash == node.bc.chain[0].hash()
+    assert node.worker_thread.is_alive()
+
+    # stopping interrupts a search as well
+    node.bc.difficulty = 12
+    node._add_pending_block(b"public key", b"another post")
+    time.sleep(0.5)
+    start = time.monotonic()
+    node.stop()
+    assert time.monotonic() - start < 2
+
 if __name__ == '__main__':
     test_merge_longer_chain(1)